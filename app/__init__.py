@@ -0,0 +1,4 @@
+from dotenv import load_dotenv
+
+# .env is read once, here, before any of the modules below the app package read their settings with os.getenv
+load_dotenv(".env")
@@ -0,0 +1,100 @@
+from sqlmodel import select, update
+from sqlmodel.ext.asyncio.session import AsyncSession
+from typing import Annotated, Callable
+from .batching import MicroBatcher
+from .models import AttendanceRecord, LectureSession, CourseAttendanceSummary, StudentCourseAttendance
+from collections import Counter
+from datetime import datetime
+import os
+
+# A full hall checks in within a couple of minutes, so instead of a commit per student the check-ins are written in batches
+ATTENDANCE_BATCH_SIZE: Annotated[int, "Flush once this many check-ins are waiting"] = int(
+    os.getenv("ATTENDANCE_BATCH_SIZE", 200))
+ATTENDANCE_BATCH_DELAY_MS: Annotated[float, "Flush at most this long after the first check-in in a batch arrived"] = float(
+    os.getenv("ATTENDANCE_BATCH_DELAY_MS", 50))
+
+
+def default_session_factory() -> AsyncSession:
+    from .database import async_engine
+    return AsyncSession(async_engine, expire_on_commit=False)
+
+
+class AttendanceWriter(MicroBatcher):
+    def __init__(self, max_batch_size: int = ATTENDANCE_BATCH_SIZE, max_delay_ms: float = ATTENDANCE_BATCH_DELAY_MS,
+                 session_factory: Callable[[], AsyncSession] = default_session_factory):
+        super().__init__(max_batch_size=max_batch_size,
+                         max_delay_seconds=max_delay_ms / 1000)
+        self.session_factory = session_factory
+
+    async def process_batch(self, records: list[AttendanceRecord]) -> list[bool]:
+        # Each result is True if the check-in was recorded and False if the student had already checked in to that lecture
+        from .database import get_dialect_insert
+        unique_records: dict[tuple[int, str], AttendanceRecord] = {}
+        for record in records:
+            unique_records.setdefault(
+                (record.lecture_session_id, record.matric_number), record)
+        async with self.session_factory() as session:
+            insert = get_dialect_insert(session)
+            statement = insert(AttendanceRecord).values([
+                {"lecture_session_id": record.lecture_session_id, "matric_number": record.matric_number,
+                 "checked_in_at": record.checked_in_at}
+                for record in unique_records.values()
+            ]).on_conflict_do_nothing(index_elements=[AttendanceRecord.lecture_session_id, AttendanceRecord.matric_number]
+                                      ).returning(AttendanceRecord.lecture_session_id, AttendanceRecord.matric_number)
+            result = await session.exec(statement)
+            inserted = {tuple(row) for row in result.all()}
+            if inserted:
+                await update_attendance_aggregates(session, [unique_records[key] for key in inserted])
+            await session.commit()
+        results = []
+        for record in records:
+            key = (record.lecture_session_id, record.matric_number)
+            # only the first of two identical check-ins in the same batch counts as the one that got recorded
+            results.append(key in inserted and unique_records[key] is record)
+        return results
+
+    async def record(self, lecture_session_id: int, matric_number: str) -> bool:
+        return await self.submit(AttendanceRecord(lecture_session_id=lecture_session_id, matric_number=matric_number.upper()))
+
+
+async def update_attendance_aggregates(session: AsyncSession, records: list[AttendanceRecord]):
+    # Bumps the counters the reports read from. This only runs for check-ins that were actually inserted, so the counters stay exact
+    from .database import get_dialect_insert
+    per_lecture_session = Counter(
+        record.lecture_session_id for record in records)
+    result = await session.exec(select(LectureSession.id, LectureSession.course_code).where(LectureSession.id.in_(list(per_lecture_session))))
+    course_codes: dict[int, str] = dict(result.all())
+    for lecture_session_id, count in per_lecture_session.items():
+        await session.exec(update(LectureSession).where(LectureSession.id == lecture_session_id).values(
+            attendance_count=LectureSession.attendance_count + count))
+
+    per_course = Counter()
+    per_student: dict[tuple[str, str], tuple[int, datetime]] = {}
+    for record in records:
+        course_code = course_codes.get(record.lecture_session_id)
+        if course_code is None:
+            continue
+        per_course[course_code] += 1
+        attended, last_checked_in_at = per_student.get(
+            (course_code, record.matric_number), (0, record.checked_in_at))
+        per_student[(course_code, record.matric_number)] = (
+            attended + 1, max(last_checked_in_at, record.checked_in_at))
+
+    insert = get_dialect_insert(session)
+    if per_course:
+        statement = insert(CourseAttendanceSummary).values(
+            [{"course_code": course_code, "sessions_held": 0, "check_ins": count} for course_code, count in per_course.items()])
+        await session.exec(statement.on_conflict_do_update(index_elements=[CourseAttendanceSummary.course_code], set_={
+            "check_ins": CourseAttendanceSummary.check_ins + statement.excluded.check_ins}))
+    if per_student:
+        statement = insert(StudentCourseAttendance).values([
+            {"course_code": course_code, "matric_number": matric_number,
+                "sessions_attended": attended, "last_checked_in_at": last_checked_in_at}
+            for (course_code, matric_number), (attended, last_checked_in_at) in per_student.items()
+        ])
+        await session.exec(statement.on_conflict_do_update(index_elements=[StudentCourseAttendance.course_code, StudentCourseAttendance.matric_number], set_={
+            "sessions_attended": StudentCourseAttendance.sessions_attended + statement.excluded.sessions_attended,
+            "last_checked_in_at": statement.excluded.last_checked_in_at}))
+
+
+attendance_writer = AttendanceWriter()
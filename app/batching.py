@@ -0,0 +1,66 @@
+from typing import Any
+import asyncio
+
+
+class MicroBatcher:
+    # Collects items submitted from many requests and hands them to process_batch together, either once max_batch_size items
+    # are waiting or max_delay_seconds after the first one arrived, whichever happens first.
+    # Every submit gets back a future that resolves to that item's result, so a request can still wait for its own outcome
+    def __init__(self, max_batch_size: int, max_delay_seconds: float):
+        self.max_batch_size = max_batch_size
+        self.max_delay_seconds = max_delay_seconds
+        self._pending: list[tuple[Any, asyncio.Future]] = []
+        self._timer: asyncio.TimerHandle | None = None
+        self._running: set[asyncio.Task] = set()
+        self.batches = 0
+        self.items = 0
+
+    async def process_batch(self, items: list) -> list:
+        # must return one result per item, in the same order
+        raise NotImplementedError
+
+    def submit(self, item) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((item, future))
+        if len(self._pending) >= self.max_batch_size:
+            self._flush_pending()
+        elif self._timer is None:
+            self._timer = loop.call_later(
+                self.max_delay_seconds, self._flush_pending)
+        return future
+
+    def _flush_pending(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, []
+        task = asyncio.get_running_loop().create_task(self._run_batch(pending))
+        self._running.add(task)
+        task.add_done_callback(self._running.discard)
+
+    async def _run_batch(self, pending: list[tuple[Any, asyncio.Future]]):
+        self.batches += 1
+        self.items += len(pending)
+        try:
+            results = await self.process_batch([item for item, _ in pending])
+        except Exception as err:
+            for _, future in pending:
+                if not future.done():
+                    future.set_exception(err)
+            return
+        for (_, future), result in zip(pending, results):
+            if not future.done():
+                future.set_result(result)
+
+    async def flush(self):
+        # sends whatever is waiting right away and waits for every batch still in progress, e.g. on shutdown
+        self._flush_pending()
+        if self._running:
+            await asyncio.gather(*self._running, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {"pending": len(self._pending), "batches_in_progress": len(self._running), "batches": self.batches, "items": self.items,
+                "average_batch_size": self.items / self.batches if self.batches else 0.0}
@@ -0,0 +1,155 @@
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from pydantic import ValidationError
+from typing import Annotated, AsyncIterable, AsyncIterator
+from .models import Student, StudentPydanticModel
+from .hashing import PasswordHasher, password_hasher
+import csv
+import json
+import os
+
+BULK_IMPORT_BATCH_SIZE: Annotated[int, "Rows per existence query and per multi-row insert"] = int(
+    os.getenv("BULK_IMPORT_BATCH_SIZE", 500))
+
+# Row is (line number in the upload, the parsed row or the reason it couldn't be parsed)
+Row = tuple[int, dict | str]
+
+
+def decode_line(line: bytes) -> str | UnicodeDecodeError:
+    # A spreadsheet saved as Latin-1 or Windows-1252 is the usual culprit. Only the lines that don't decode are rejected, not the whole upload
+    try:
+        return line.decode("utf-8").rstrip("\r")
+    except UnicodeDecodeError as err:
+        return err
+
+
+def undecodable_line_detail(err: UnicodeDecodeError) -> str:
+    return f"Not valid UTF-8 (byte {err.start} of the line). Save the file as UTF-8 and try again"
+
+
+async def aiter_lines(chunks: AsyncIterable[bytes]) -> AsyncIterator[str | UnicodeDecodeError]:
+    # The request body arrives in arbitrary chunks so a line can be split across two of them
+    pending = b""
+    async for chunk in chunks:
+        pending += chunk
+        *lines, pending = pending.split(b"\n")
+        for line in lines:
+            yield decode_line(line)
+    if pending:
+        yield decode_line(pending)
+
+
+async def parse_ndjson(lines: AsyncIterable[str | UnicodeDecodeError]) -> AsyncIterator[Row]:
+    line_number = 0
+    async for line in lines:
+        line_number += 1
+        if isinstance(line, UnicodeDecodeError):
+            yield line_number, undecodable_line_detail(line)
+            continue
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except json.JSONDecodeError as err:
+            yield line_number, f"Invalid JSON: {err}"
+            continue
+        yield line_number, row if isinstance(row, dict) else "Expected a JSON object"
+
+
+async def parse_csv(lines: AsyncIterable[str | UnicodeDecodeError]) -> AsyncIterator[Row]:
+    # The first line is the header. It needs at least matric_number and password, any other column is ignored.
+    # Quoted fields with newlines in them aren't supported, the registry exports don't have any
+    header: list[str] | None = None
+    header_error: str | None = None
+    line_number = 0
+    async for line in lines:
+        line_number += 1
+        if isinstance(line, UnicodeDecodeError):
+            if header is None and header_error is None:
+                # without the header none of the rows can be read, so they are all reported against it
+                header_error = "The header line is not valid UTF-8"
+            yield line_number, undecodable_line_detail(line)
+            continue
+        if not line.strip():
+            continue
+        if header_error is not None:
+            yield line_number, header_error
+            continue
+        values = next(csv.reader([line]))
+        if header is None:
+            header = [column.strip().lower() for column in values]
+            continue
+        if len(values) != len(header):
+            yield line_number, f"Expected {len(header)} columns, got {len(values)}"
+            continue
+        yield line_number, dict(zip(header, values))
+
+
+async def import_batch(session: AsyncSession, rows: list[Row], seen: set[str], hasher: PasswordHasher = password_hasher) -> list[dict]:
+    from .database import get_dialect_insert
+    report: dict[int, dict] = {}
+    candidates: dict[str, tuple[int, StudentPydanticModel]] = {}
+    for line_number, row in rows:
+        if isinstance(row, str):
+            report[line_number] = {"line": line_number, "matric_number": None,
+                                   "status": "invalid", "detail": row}
+            continue
+        try:
+            student = StudentPydanticModel.model_validate(
+                {"matric_number": row.get("matric_number"), "password": row.get("password")})
+        except ValidationError as err:
+            report[line_number] = {"line": line_number, "matric_number": row.get("matric_number"),
+                                   "status": "invalid", "detail": str(err.errors(include_url=False))}
+            continue
+        matric_number = student.matric_number.upper()
+        if matric_number in seen or matric_number in candidates:
+            report[line_number] = {"line": line_number, "matric_number": matric_number,
+                                   "status": "duplicate", "detail": "Appears earlier in the upload"}
+            continue
+        candidates[matric_number] = (line_number, student)
+    seen.update(candidates)
+
+    if candidates:
+        # one query for the whole batch instead of a session.get per student
+        result = await session.exec(select(Student.matric_number).where(Student.matric_number.in_(list(candidates))))
+        for matric_number in result.all():
+            line_number, _ = candidates.pop(matric_number)
+            report[line_number] = {"line": line_number, "matric_number": matric_number,
+                                   "status": "exists", "detail": "Student already exists."}
+
+    if candidates:
+        matric_numbers = list(candidates)
+        hashes = await hasher.hash_many([candidates[matric_number][1].password for matric_number in matric_numbers])
+        insert = get_dialect_insert(session)
+        # ON CONFLICT DO NOTHING covers a student created by someone else between the select above and this insert
+        statement = insert(Student).values([
+            {"matric_number": matric_number, "password": password_hash, "device_registered": False}
+            for matric_number, password_hash in zip(matric_numbers, hashes)
+        ]).on_conflict_do_nothing(index_elements=[Student.matric_number]).returning(Student.matric_number)
+        result = await session.exec(statement)
+        created = set(result.scalars().all())
+        await session.commit()
+        for matric_number in matric_numbers:
+            line_number, _ = candidates[matric_number]
+            if matric_number in created:
+                report[line_number] = {"line": line_number, "matric_number": matric_number,
+                                       "status": "created", "detail": None}
+            else:
+                report[line_number] = {"line": line_number, "matric_number": matric_number,
+                                       "status": "exists", "detail": "Student already exists."}
+    return [report[line_number] for line_number in sorted(report)]
+
+
+async def import_students(session: AsyncSession, rows: AsyncIterable[Row], batch_size: int = BULK_IMPORT_BATCH_SIZE, hasher: PasswordHasher = password_hasher) -> AsyncIterator[dict]:
+    # Yields one result per row as each batch is committed, so neither the upload nor the report ever has to be held in memory in full
+    seen: set[str] = set()
+    batch: list[Row] = []
+    async for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            for result in await import_batch(session, batch, seen, hasher):
+                yield result
+            batch = []
+    if batch:
+        for result in await import_batch(session, batch, seen, hasher):
+            yield result
@@ -0,0 +1,101 @@
+from sqlalchemy import delete, select
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlmodel.ext.asyncio.session import AsyncSession
+from typing import Annotated
+from .cache import TTLCache
+from .models import Challenge
+import os
+import time
+
+# memory is fine for a single uvicorn worker. Use database once there is more than one worker, because the verify request can land on a different process than the generate request
+CHALLENGE_STORE = os.getenv("CHALLENGE_STORE", "memory")
+CHALLENGE_TTL_SECONDS: Annotated[float, "How long a ceremony can stay pending. The browser gives up after the 60s timeout in the options anyway"] = float(
+    os.getenv("CHALLENGE_TTL_SECONDS", 120))
+CHALLENGE_STORE_MAX_ENTRIES = int(
+    os.getenv("CHALLENGE_STORE_MAX_ENTRIES", 100_000))
+
+
+class ChallengeStore:
+    # pop has to be an atomic get-and-delete so that a challenge can only ever be used once, even when two verify requests race each other
+    async def put(self, key: str, challenge: bytes, ttl: float | None = None):
+        raise NotImplementedError
+
+    async def pop(self, key: str) -> bytes | None:
+        raise NotImplementedError
+
+    async def get(self, key: str) -> bytes | None:
+        # Reads a challenge without using it up. Only for challenges that are handed out until they are verified, like the lecture check-in ones
+        raise NotImplementedError
+
+    async def put_many(self, challenges: dict[str, bytes], ttl: float | None = None):
+        for key, challenge in challenges.items():
+            await self.put(key, challenge, ttl)
+
+
+class InMemoryChallengeStore(ChallengeStore):
+    def __init__(self, ttl: float = CHALLENGE_TTL_SECONDS, max_entries: int = CHALLENGE_STORE_MAX_ENTRIES):
+        self.challenges = TTLCache(maxsize=max_entries, ttl=ttl)
+
+    async def put(self, key: str, challenge: bytes, ttl: float | None = None):
+        self.challenges.set(key, challenge, ttl)
+
+    async def pop(self, key: str) -> bytes | None:
+        # there is no await in here so nothing else can run between the get and the delete
+        return self.challenges.pop(key)
+
+    async def get(self, key: str) -> bytes | None:
+        return self.challenges.get(key)
+
+
+class DatabaseChallengeStore(ChallengeStore):
+    def __init__(self, engine: AsyncEngine, ttl: float = CHALLENGE_TTL_SECONDS, purge_every: int = 1000):
+        self.engine = engine
+        self.ttl = ttl
+        self.purge_every = purge_every
+        self._puts = 0
+
+    async def put(self, key: str, challenge: bytes, ttl: float | None = None):
+        await self.put_many({key: challenge}, ttl)
+
+    async def put_many(self, challenges: dict[str, bytes], ttl: float | None = None, batch_size: int = 300):
+        # a multi-row upsert per batch_size challenges, 3 parameters a row keeps it under sqlite's old limit of 999
+        from .database import get_dialect_insert
+        expires_at = time.time() + (self.ttl if ttl is None else ttl)
+        rows = [{"key": key, "challenge": challenge, "expires_at": expires_at} for key, challenge in challenges.items()]
+        async with AsyncSession(self.engine) as session:
+            insert = get_dialect_insert(session)
+            for start in range(0, len(rows), batch_size):
+                statement = insert(Challenge).values(rows[start:start + batch_size])
+                # starting a new ceremony replaces whatever was pending for the same key
+                statement = statement.on_conflict_do_update(index_elements=[Challenge.key], set_={
+                    "challenge": statement.excluded.challenge, "expires_at": statement.excluded.expires_at})
+                await session.exec(statement)
+            self._puts += 1
+            # abandoned ceremonies are never popped so every now and then we clear out the expired rows
+            if self._puts % self.purge_every == 0:
+                await session.exec(delete(Challenge).where(Challenge.expires_at <= time.time()))
+            await session.commit()
+
+    async def pop(self, key: str) -> bytes | None:
+        async with AsyncSession(self.engine) as session:
+            result = await session.exec(delete(Challenge).where(Challenge.key == key, Challenge.expires_at > time.time()).returning(Challenge.challenge))
+            challenge = result.scalar_one_or_none()
+            await session.commit()
+        return challenge
+
+    async def get(self, key: str) -> bytes | None:
+        async with AsyncSession(self.engine) as session:
+            result = await session.exec(select(Challenge.challenge).where(Challenge.key == key, Challenge.expires_at > time.time()))
+            return result.scalar_one_or_none()
+
+
+def create_challenge_store(kind: str = CHALLENGE_STORE) -> ChallengeStore:
+    if kind == "database":
+        from .database import async_engine
+        return DatabaseChallengeStore(async_engine)
+    if kind == "memory":
+        return InMemoryChallengeStore()
+    raise ValueError(f"Unknown CHALLENGE_STORE {kind!r}")
+
+
+challenge_store = create_challenge_store()
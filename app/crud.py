@@ -1,7 +1,25 @@
-from sqlmodel import Session, select
-from .models import Student, StudentPydanticModel, StudentUpdateModel
+from sqlmodel import Session, select, update, delete
+from sqlmodel.ext.asyncio.session import AsyncSession
+from .models import Student, StudentPydanticModel, StudentUpdateModel, StudentSnapshot, Credential, CredentialSnapshot, LectureSession, LectureSessionCreateModel, CourseAttendanceSummary, StudentCourseAttendance, TokenRevocation
+from .cache import TTLCache
+from .metrics import crud_seconds
 from sqlalchemy.exc import NoResultFound
-from typing import Optional
+from typing import Annotated, Optional
+from datetime import datetime, timedelta
+import os
+
+# A login ceremony reads the same student 3 or 4 times in a few seconds so we keep a short lived snapshot of it around.
+# Writes that go through this module update the cache as well, the TTL is only there to bound how stale another worker's write can make us
+STUDENT_CACHE_TTL_SECONDS = float(os.getenv("STUDENT_CACHE_TTL_SECONDS", 30))
+STUDENT_CACHE_MAX_ENTRIES = int(os.getenv("STUDENT_CACHE_MAX_ENTRIES", 10_000))
+student_cache: Annotated[TTLCache, "upper cased matric number -> StudentSnapshot"] = TTLCache(
+    maxsize=STUDENT_CACHE_MAX_ENTRIES, ttl=STUDENT_CACHE_TTL_SECONDS)
+# the devices a student has registered. Used to build the allow list for their options and to find the credential an assertion was made with
+credential_cache: Annotated[TTLCache, "upper cased matric number -> tuple of CredentialSnapshot"] = TTLCache(
+    maxsize=STUDENT_CACHE_MAX_ENTRIES, ttl=STUDENT_CACHE_TTL_SECONDS)
+# every check-in during a lecture looks up the same lecture session, and a lecture session doesn't change once it is opened
+lecture_session_cache: Annotated[TTLCache, "lecture session id -> LectureSession"] = TTLCache(
+    maxsize=1000, ttl=300)
 
 
 def create_student(session: Session, student: StudentPydanticModel) -> Student | None:
@@ -12,6 +30,7 @@ def create_student(session: Session, student: StudentPydanticModel) -> Student |
     if not session.get(Student, db_student.matric_number):
         session.add(db_student)
         session.commit()
+        student_cache.invalidate(db_student.matric_number)
         return db_student
     # if student already exists
     return None
@@ -28,12 +47,202 @@ def get_student(session: Session, matric_number: str) -> Optional[Student]:
         return None
 
 
-def update_student(session: Session, matric_number: str, update_data: StudentUpdateModel):
+def build_update_student_statement(matric_number: str, update_data: StudentUpdateModel, expected_sign_count: int | None = None):
+    # One UPDATE ... RETURNING instead of select, setattr, commit. expected_sign_count turns it into a compare-and-set on sign_count
+    # so that two logins racing each other can't both write their counter and lose one of the updates
+    statement = update(Student).where(Student.matric_number == matric_number).values(
+        **update_data.model_dump(exclude_unset=True)).returning(Student)
+    if expected_sign_count is not None:
+        statement = statement.where(
+            Student.sign_count == expected_sign_count)
+    return statement
+
+
+def update_student(session: Session, matric_number: str, update_data: StudentUpdateModel, expected_sign_count: int | None = None) -> Optional[Student]:
+    # returns None when there is no such student or when the expected_sign_count guard didn't match
     matric_number = matric_number.upper()
-    db_student = session.exec(select(Student).where(
-        Student.matric_number == matric_number)).one()
-    update_dict = update_data.model_dump(exclude_unset=True)
-    for column, value in update_dict.items():
-        setattr(db_student, column, value)
-    session.add(db_student)
+    db_student = session.exec(build_update_student_statement(
+        matric_number, update_data, expected_sign_count)).scalar_one_or_none()
     session.commit()
+    student_cache.invalidate(matric_number)
+    return db_student
+
+
+# The async versions below are what the endpoints use. The blocking ones above are only kept for scripts and anything still holding a sqlmodel Session
+@crud_seconds.timed("create_student")
+async def async_create_student(session: AsyncSession, student: StudentPydanticModel) -> Student | None:
+    from .hashing import password_hasher
+    student.matric_number = student.matric_number.upper()
+    # checking first so that we don't pay for a bcrypt hash when the student already exists
+    if await session.get(Student, student.matric_number):
+        return None
+    # bcrypt is cpu bound so it runs on the hashing pool instead of the event loop
+    student.password = await password_hasher.hash(student.password)
+    db_student = Student.model_validate(student)
+    session.add(db_student)
+    await session.commit()
+    student_cache.set(db_student.matric_number,
+                      StudentSnapshot.from_student(db_student))
+    return db_student
+
+
+@crud_seconds.timed("get_student")
+async def async_get_student(session: AsyncSession, matric_number: str) -> Optional[Student]:
+    matric_number = matric_number.upper()
+    result = await session.exec(select(Student).where(
+        Student.matric_number == matric_number))
+    return result.one_or_none()
+
+
+@crud_seconds.timed("get_student_snapshot")
+async def async_get_student_snapshot(session: AsyncSession, matric_number: str) -> Optional[StudentSnapshot]:
+    matric_number = matric_number.upper()
+    snapshot = student_cache.get(matric_number)
+    if snapshot is None:
+        db_student = await async_get_student(session, matric_number)
+        if db_student is None:
+            return None
+        snapshot = StudentSnapshot.from_student(db_student)
+        student_cache.set(matric_number, snapshot)
+    return snapshot
+
+
+@crud_seconds.timed("update_student")
+async def async_update_student(session: AsyncSession, matric_number: str, update_data: StudentUpdateModel, expected_sign_count: int | None = None) -> Optional[Student]:
+    # returns None when there is no such student or when the expected_sign_count guard didn't match
+    matric_number = matric_number.upper()
+    result = await session.exec(build_update_student_statement(matric_number, update_data, expected_sign_count))
+    db_student = result.scalar_one_or_none()
+    await session.commit()
+    if db_student is None:
+        # if it was the guard that failed then whatever we have cached is what lost the race
+        student_cache.invalidate(matric_number)
+        return None
+    # write-through so the next read in the ceremony doesn't have to go to the database
+    student_cache.set(matric_number, StudentSnapshot.from_student(db_student))
+    return db_student
+
+
+@crud_seconds.timed("get_student_credentials")
+async def async_get_student_credentials(session: AsyncSession, matric_number: str) -> tuple[CredentialSnapshot, ...]:
+    matric_number = matric_number.upper()
+    credentials = credential_cache.get(matric_number)
+    if credentials is None:
+        result = await session.exec(select(Credential).where(Credential.matric_number == matric_number).order_by(Credential.id))
+        credentials = tuple(CredentialSnapshot.from_credential(credential)
+                            for credential in result.all())
+        credential_cache.set(matric_number, credentials)
+    return credentials
+
+
+@crud_seconds.timed("get_students_credentials")
+async def async_get_students_credentials(session: AsyncSession, matric_numbers: list[str], batch_size: int = 500) -> dict[str, tuple[CredentialSnapshot, ...]]:
+    # The devices of a whole class at once, one IN query per batch_size students instead of one query each. Students without a device are left out
+    matric_numbers = sorted({matric_number.upper() for matric_number in matric_numbers})
+    credentials: dict[str, list[CredentialSnapshot]] = {}
+    for start in range(0, len(matric_numbers), batch_size):
+        result = await session.exec(select(Credential).where(Credential.matric_number.in_(matric_numbers[start:start + batch_size])).order_by(Credential.id))
+        for credential in result.all():
+            credentials.setdefault(credential.matric_number, []).append(
+                CredentialSnapshot.from_credential(credential))
+    for matric_number, student_credentials in credentials.items():
+        credential_cache.set(matric_number, tuple(student_credentials))
+    return {matric_number: tuple(student_credentials) for matric_number, student_credentials in credentials.items()}
+
+
+@crud_seconds.timed("get_course_roster")
+async def async_get_course_roster(session: AsyncSession, course_code: str) -> list[str]:
+    # There is no enrolment table, so the students who have checked in to this course before are the closest thing to its class list
+    result = await session.exec(select(StudentCourseAttendance.matric_number).where(StudentCourseAttendance.course_code == course_code.upper()))
+    return list(result.all())
+
+
+@crud_seconds.timed("get_credential")
+async def async_get_credential(session: AsyncSession, credential_id: bytes, matric_number: str | None = None) -> Optional[CredentialSnapshot]:
+    # When we already know whose credential it should be, their cached devices usually have it. Otherwise it is one lookup on the unique index
+    if matric_number is not None:
+        for credential in credential_cache.get(matric_number.upper(), ()):
+            if credential.credential_id == credential_id:
+                return credential
+    result = await session.exec(select(Credential).where(Credential.credential_id == credential_id))
+    credential = result.one_or_none()
+    return CredentialSnapshot.from_credential(credential) if credential else None
+
+
+@crud_seconds.timed("update_credential_sign_count")
+async def async_update_credential_sign_count(session: AsyncSession, credential: CredentialSnapshot, new_sign_count: int) -> bool:
+    # The counter may only go forward, checked against the database rather than `credential`, which can come from this worker's cache and be behind
+    # whatever another worker has accepted since. Authenticators that don't count report 0 every time, and 0 -> 0 is allowed for them.
+    # False means the stored counter is already at or past new_sign_count: the same count turning up twice is a cloned authenticator or a race lost
+    moves_forward = Credential.sign_count < new_sign_count if new_sign_count else Credential.sign_count == 0
+    result = await session.exec(update(Credential).where(Credential.id == credential.id, moves_forward).values(
+        sign_count=new_sign_count, last_used_at=datetime.utcnow()).returning(Credential.id))
+    updated = result.scalar_one_or_none() is not None
+    await session.commit()
+    credentials = credential_cache.get(credential.matric_number)
+    if not updated or credentials is None:
+        credential_cache.invalidate(credential.matric_number)
+        return updated
+    # write-through so the next ceremony still finds the credential in the cache with the right counter
+    credential_cache.set(credential.matric_number, tuple(CredentialSnapshot(id=cached.id, credential_id=cached.credential_id, matric_number=cached.matric_number,
+                                                                            public_key=cached.public_key, sign_count=new_sign_count, transports=cached.transports)
+                                                         if cached.id == credential.id else cached for cached in credentials))
+    return updated
+
+
+@crud_seconds.timed("delete_credential")
+async def async_delete_credential(session: AsyncSession, matric_number: str, credential_id: bytes) -> bool:
+    # for a lost or replaced device. The student is only unregistered once their last device is gone
+    matric_number = matric_number.upper()
+    result = await session.exec(delete(Credential).where(Credential.matric_number == matric_number, Credential.credential_id == credential_id).returning(Credential.id))
+    deleted = result.scalar_one_or_none() is not None
+    if deleted:
+        remaining = await session.exec(select(Credential.id).where(Credential.matric_number == matric_number).limit(1))
+        if remaining.first() is None:
+            await session.exec(update(Student).where(Student.matric_number == matric_number).values(device_registered=False))
+    await session.commit()
+    credential_cache.invalidate(matric_number)
+    student_cache.invalidate(matric_number)
+    return deleted
+
+
+@crud_seconds.timed("get_token_revocation")
+async def async_get_token_revocation(session: AsyncSession, matric_number: str) -> float | None:
+    result = await session.exec(select(TokenRevocation.revoked_at).where(TokenRevocation.matric_number == matric_number.upper()))
+    return result.one_or_none()
+
+
+@crud_seconds.timed("revoke_student_tokens")
+async def async_revoke_student_tokens(session: AsyncSession, matric_number: str, revoked_at: float):
+    # a later revocation replaces the earlier one, it covers every token the earlier one did
+    from .database import get_dialect_insert
+    insert = get_dialect_insert(session)
+    await session.exec(insert(TokenRevocation).values(matric_number=matric_number.upper(), revoked_at=revoked_at).on_conflict_do_update(
+        index_elements=[TokenRevocation.matric_number], set_={"revoked_at": revoked_at}))
+    await session.commit()
+
+
+@crud_seconds.timed("create_lecture_session")
+async def async_create_lecture_session(session: AsyncSession, lecture_session: LectureSessionCreateModel) -> LectureSession:
+    opened_at = datetime.utcnow()
+    db_lecture_session = LectureSession(course_code=lecture_session.course_code.upper(), title=lecture_session.title, opened_at=opened_at,
+                                        closes_at=opened_at + timedelta(minutes=lecture_session.duration_minutes))
+    session.add(db_lecture_session)
+    # the denominator for every attendance percentage in this course goes up with each lecture held
+    from .database import get_dialect_insert
+    insert = get_dialect_insert(session)
+    await session.exec(insert(CourseAttendanceSummary).values(course_code=db_lecture_session.course_code, sessions_held=1, check_ins=0).on_conflict_do_update(
+        index_elements=[CourseAttendanceSummary.course_code], set_={"sessions_held": CourseAttendanceSummary.sessions_held + 1}))
+    await session.commit()
+    lecture_session_cache.set(db_lecture_session.id, db_lecture_session)
+    return db_lecture_session
+
+
+@crud_seconds.timed("get_lecture_session")
+async def async_get_lecture_session(session: AsyncSession, lecture_session_id: int) -> Optional[LectureSession]:
+    db_lecture_session = lecture_session_cache.get(lecture_session_id)
+    if db_lecture_session is None:
+        db_lecture_session = await session.get(LectureSession, lecture_session_id)
+        if db_lecture_session is not None:
+            lecture_session_cache.set(lecture_session_id, db_lecture_session)
+    return db_lecture_session
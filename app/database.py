@@ -1,15 +1,178 @@
 from sqlmodel import create_engine, SQLModel
+from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from typing import Annotated
+import bisect
 import os
-from dotenv import load_dotenv
-
-load_dotenv(".env")
+import time
 
 postgres_db_url = os.getenv("DB_URL")
-engine = create_engine(url=postgres_db_url)
+
+# Connection pool settings. The defaults are what we run in production: a single uvicorn worker serving a lecture hall
+# needs more than sqlalchemy's default of 5 connections during a login storm, and requests should fail fast instead of
+# queueing for 30s when the pool is exhausted. pre-ping and recycle are there because the managed postgres drops idle connections.
+# Keep (DB_POOL_SIZE + DB_MAX_OVERFLOW) * number of workers below the server's max_connections
+DB_POOL_SIZE: Annotated[int, "Connections kept open per engine"] = int(
+    os.getenv("DB_POOL_SIZE", 10))
+DB_MAX_OVERFLOW: Annotated[int, "Extra connections that can be opened on top of DB_POOL_SIZE under load"] = int(
+    os.getenv("DB_MAX_OVERFLOW", 20))
+DB_POOL_TIMEOUT: Annotated[float, "Seconds to wait for a free connection before giving up"] = float(
+    os.getenv("DB_POOL_TIMEOUT", 5))
+DB_POOL_RECYCLE: Annotated[int, "Replace connections older than this many seconds"] = int(
+    os.getenv("DB_POOL_RECYCLE", 1800))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+
+
+class PoolMetrics:
+    # seconds. Anything above the last bucket only shows up in the count and max
+    buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+    def __init__(self):
+        self.checkouts = 0
+        self.timeouts = 0
+        self.checkout_seconds_total = 0.0
+        self.checkout_seconds_max = 0.0
+        self.bucket_counts = [0] * len(self.buckets)
+
+    def observe_checkout(self, seconds: float):
+        self.checkouts += 1
+        self.checkout_seconds_total += seconds
+        self.checkout_seconds_max = max(self.checkout_seconds_max, seconds)
+        index = bisect.bisect_left(self.buckets, seconds)
+        if index < len(self.buckets):
+            self.bucket_counts[index] += 1
+
+    def stats(self, pool) -> dict:
+        return {
+            "size": pool.size(),
+            "in_use": pool.checkedout(),
+            "idle": pool.checkedin(),
+            "overflow": max(pool.overflow(), 0),
+            "checkouts": self.checkouts,
+            "timeouts": self.timeouts,
+            "checkout_seconds_average": self.checkout_seconds_total / self.checkouts if self.checkouts else 0.0,
+            "checkout_seconds_max": self.checkout_seconds_max,
+            # cumulative, prometheus style
+            "checkout_seconds_buckets": {str(bound): sum(self.bucket_counts[:index + 1]) for index, bound in enumerate(self.buckets)},
+        }
+
+
+class InstrumentedPoolMixin:
+    # Times every checkout, including the wait for a free connection and the pre-ping, and counts the ones that timed out
+    metrics: PoolMetrics
+
+    def connect(self):
+        started = time.perf_counter()
+        try:
+            return super().connect()
+        except PoolTimeoutError:
+            self.metrics.timeouts += 1
+            raise
+        finally:
+            self.metrics.observe_checkout(time.perf_counter() - started)
+
+
+# the metrics live on the class because sqlalchemy builds a brand new pool instance whenever the engine is disposed
+class InstrumentedQueuePool(InstrumentedPoolMixin, QueuePool):
+    metrics = PoolMetrics()
+
+
+class InstrumentedAsyncAdaptedQueuePool(InstrumentedPoolMixin, AsyncAdaptedQueuePool):
+    metrics = PoolMetrics()
+
+
+def get_pool_options(db_url: str, poolclass: type) -> dict:
+    # sqlite (the tests, local dev) gets sqlalchemy's own pool choice because an in-memory database can't use a QueuePool
+    if db_url.startswith("sqlite"):
+        return {}
+    return {"poolclass": poolclass, "pool_size": DB_POOL_SIZE, "max_overflow": DB_MAX_OVERFLOW, "pool_timeout": DB_POOL_TIMEOUT,
+            "pool_recycle": DB_POOL_RECYCLE, "pool_pre_ping": DB_POOL_PRE_PING}
+
+
+def get_async_db_url(db_url: str) -> str:
+    # DB_URL is written for the blocking drivers (psycopg2 and pysqlite), so I am swapping in the async driver for the same database
+    scheme, separator, rest = db_url.partition("://")
+    driver = scheme.split("+")[0]
+    if driver in ("postgres", "postgresql"):
+        return "postgresql+asyncpg" + separator + rest
+    if driver == "sqlite":
+        return "sqlite+aiosqlite" + separator + rest
+    return db_url
+
+
+# The engines are made on first use rather than on import: creating one loads the database driver, and the blocking engine is only
+# kept around for create_db_and_tables and the get_session compatibility dependency, so most workers never need it. Every endpoint goes through async_engine
+_engines: dict = {}
+
+
+def get_engine():
+    if "sync" not in _engines:
+        _engines["sync"] = create_engine(
+            url=postgres_db_url, **get_pool_options(postgres_db_url, InstrumentedQueuePool))
+    return _engines["sync"]
+
+
+def get_async_engine():
+    if "async" not in _engines:
+        _engines["async"] = create_async_engine(url=get_async_db_url(postgres_db_url), **get_pool_options(
+            postgres_db_url, InstrumentedAsyncAdaptedQueuePool))
+    return _engines["async"]
+
+
+def __getattr__(name: str):
+    # keeps "from app.database import engine, async_engine" working
+    if name == "engine":
+        return get_engine()
+    if name == "async_engine":
+        return get_async_engine()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+async def dispose_engines():
+    # closes the pooled connections on shutdown. An engine can still be used afterwards, it just opens new connections
+    if "async" in _engines:
+        await _engines["async"].dispose()
+    if "sync" in _engines:
+        _engines["sync"].dispose()
+
+
+def get_pool_stats() -> dict:
+    stats = {}
+    # only the engines that have been created, asking for the stats shouldn't open a pool
+    for name, engine in sorted(_engines.items()):
+        pool = engine.pool
+        if isinstance(pool, InstrumentedPoolMixin):
+            stats[name] = pool.metrics.stats(pool)
+        elif isinstance(pool, QueuePool):
+            stats[name] = {"size": pool.size(), "in_use": pool.checkedout(), "idle": pool.checkedin(),
+                           "overflow": max(pool.overflow(), 0)}
+        else:
+            # NullPool/StaticPool/SingletonThreadPool (sqlite) don't track checkouts
+            stats[name] = {"pool": type(pool).__name__}
+    return stats
+
+
+async def get_async_session():
+    # expire_on_commit=False so that the objects we return from crud can still be read after the commit without another round-trip
+    async with AsyncSession(get_async_engine(), expire_on_commit=False) as session:
+        yield session
+
+
+def get_dialect_insert(session: AsyncSession):
+    # postgres and sqlite both support ON CONFLICT and RETURNING but sqlalchemy only exposes them on the dialect specific insert
+    if session.get_bind().dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert
 
 
 def create_db_and_tables():
-    SQLModel.metadata.create_all(engine)
+    # the models have to be imported so that their tables are registered on SQLModel.metadata
+    import app.models  # noqa: F401
+    SQLModel.metadata.create_all(get_engine())
 
 
 if __name__ == "__main__":
@@ -0,0 +1,174 @@
+from sqlalchemy import func
+from sqlmodel import select, update
+from sqlmodel.ext.asyncio.session import AsyncSession
+from typing import Annotated, Callable
+from .batching import MicroBatcher
+from .models import Student, Credential
+from collections import Counter, deque
+from dataclasses import dataclass
+from datetime import datetime
+from uuid import UUID
+import os
+import time
+
+# Enrolment days are the only time every student registers at once, so the successful registrations are written in batches like the check-ins
+REGISTRATION_BATCH_SIZE: Annotated[int, "Flush once this many verified registrations are waiting"] = int(
+    os.getenv("REGISTRATION_BATCH_SIZE", 100))
+REGISTRATION_BATCH_DELAY_MS: Annotated[float, "Flush at most this long after the first registration in a batch arrived"] = float(
+    os.getenv("REGISTRATION_BATCH_DELAY_MS", 50))
+ENROLMENT_RATE_WINDOW_SECONDS: Annotated[float, "The enrolment progress rates are averaged over this many seconds"] = float(
+    os.getenv("ENROLMENT_RATE_WINDOW_SECONDS", 300))
+
+# what process_batch says happened to each registration
+REGISTERED = "registered"
+STUDENT_NOT_FOUND = "student_not_found"
+CREDENTIAL_ALREADY_REGISTERED = "credential_already_registered"
+USER_HANDLE_CONFLICT = "user_handle_conflict"
+
+
+# The pending registration is the challenge followed by the user handle the options were generated with. Nothing is written to the database until the
+# ceremony is verified, so a student who gives up half way (or asks for options five times) costs nothing but a challenge store entry
+def pack_pending_registration(registration_challenge: bytes, user_id: UUID) -> bytes:
+    return registration_challenge + user_id.bytes
+
+
+def unpack_pending_registration(pending: bytes) -> tuple[bytes, UUID | None]:
+    # a bare challenge is a ceremony started before the user handle was kept here. The handle was written to the student back then
+    if len(pending) <= 32:
+        return pending, None
+    return pending[:-16], UUID(bytes=pending[-16:])
+
+
+@dataclass(frozen=True)
+class VerifiedRegistration:
+    matric_number: str
+    user_id: UUID | None
+    credential_id: bytes
+    public_key: bytes
+    sign_count: int
+    transports: str | None
+
+
+class EnrolmentProgress:
+    # Counters for the admins watching an enrolment drive. They are per process, like the rest of the metrics
+    def __init__(self, window_seconds: float = ENROLMENT_RATE_WINDOW_SECONDS, clock=time.monotonic):
+        self.window_seconds = window_seconds
+        self.clock = clock
+        self.ceremonies_started = 0
+        self.outcomes = Counter()
+        self._recent_starts: deque[float] = deque()
+        self._recent_registrations: deque[float] = deque()
+
+    def _trim(self, timestamps: deque, now: float):
+        while timestamps and timestamps[0] <= now - self.window_seconds:
+            timestamps.popleft()
+
+    def ceremony_started(self):
+        now = self.clock()
+        self.ceremonies_started += 1
+        self._recent_starts.append(now)
+        self._trim(self._recent_starts, now)
+
+    def record(self, outcome: str):
+        now = self.clock()
+        self.outcomes[outcome] += 1
+        if outcome == REGISTERED:
+            self._recent_registrations.append(now)
+            self._trim(self._recent_registrations, now)
+
+    def stats(self) -> dict:
+        now = self.clock()
+        self._trim(self._recent_starts, now)
+        self._trim(self._recent_registrations, now)
+        minutes = self.window_seconds / 60
+        return {"ceremonies_started": self.ceremonies_started, **{outcome: self.outcomes[outcome] for outcome in (REGISTERED, STUDENT_NOT_FOUND, CREDENTIAL_ALREADY_REGISTERED, USER_HANDLE_CONFLICT)},
+                "ceremonies_started_per_minute": len(self._recent_starts) / minutes, "registrations_per_minute": len(self._recent_registrations) / minutes}
+
+    def reset(self):
+        self.ceremonies_started = 0
+        self.outcomes.clear()
+        self._recent_starts.clear()
+        self._recent_registrations.clear()
+
+
+def default_session_factory() -> AsyncSession:
+    from .database import async_engine
+    return AsyncSession(async_engine, expire_on_commit=False)
+
+
+class RegistrationWriter(MicroBatcher):
+    def __init__(self, max_batch_size: int = REGISTRATION_BATCH_SIZE, max_delay_ms: float = REGISTRATION_BATCH_DELAY_MS,
+                 session_factory: Callable[[], AsyncSession] = default_session_factory, progress: EnrolmentProgress | None = None):
+        super().__init__(max_batch_size=max_batch_size,
+                         max_delay_seconds=max_delay_ms / 1000)
+        self.session_factory = session_factory
+        self.progress = progress or EnrolmentProgress()
+
+    async def process_batch(self, registrations: list[VerifiedRegistration]) -> list[str]:
+        # One transaction for the whole batch: a locking read of the students, one multi-row insert of the credentials and one executemany update of the students
+        from .database import get_dialect_insert
+        from .crud import student_cache, credential_cache
+        async with self.session_factory() as session:
+            # FOR UPDATE so that another worker's batch can't give one of these students a different user handle between the read and the update (sqlite just leaves it out)
+            result = await session.exec(select(Student.matric_number, Student.user_id).where(
+                Student.matric_number.in_({registration.matric_number for registration in registrations})).with_for_update())
+            user_ids: dict[str, UUID | None] = dict(result.all())
+            outcomes: list[str] = []
+            accepted: dict[bytes, VerifiedRegistration] = {}
+            for registration in registrations:
+                if registration.matric_number not in user_ids:
+                    outcomes.append(STUDENT_NOT_FOUND)
+                    continue
+                user_id = user_ids[registration.matric_number]
+                # Every device of a student has to carry the same user handle. Two ceremonies started before either finished get different ones, the first to be written wins
+                if registration.user_id is not None and user_id is not None and registration.user_id != user_id:
+                    outcomes.append(USER_HANDLE_CONFLICT)
+                    continue
+                if registration.credential_id in accepted:
+                    outcomes.append(CREDENTIAL_ALREADY_REGISTERED)
+                    continue
+                user_ids[registration.matric_number] = user_id or registration.user_id
+                accepted[registration.credential_id] = registration
+                outcomes.append(REGISTERED)
+            inserted: set[bytes] = set()
+            if accepted:
+                insert = get_dialect_insert(session)
+                created_at = datetime.utcnow()
+                result = await session.exec(insert(Credential).values([
+                    {"credential_id": registration.credential_id, "matric_number": registration.matric_number, "public_key": registration.public_key,
+                     "sign_count": registration.sign_count, "transports": registration.transports, "created_at": created_at}
+                    for registration in accepted.values()
+                ]).on_conflict_do_nothing(index_elements=[Credential.credential_id]).returning(Credential.credential_id))
+                inserted = {credential_id for credential_id, in result.all()}
+            registered_students = {accepted[credential_id].matric_number for credential_id in inserted}
+            if registered_students:
+                # an ORM bulk update by primary key, sent as a single executemany
+                await session.exec(update(Student), params=[{"matric_number": matric_number, "device_registered": True, "user_id": user_ids[matric_number]}
+                                                            for matric_number in registered_students])
+            await session.commit()
+        for matric_number in registered_students:
+            student_cache.invalidate(matric_number)
+            credential_cache.invalidate(matric_number)
+        for index, registration in enumerate(registrations):
+            # ON CONFLICT DO NOTHING skipped it, the device was registered before this batch
+            if outcomes[index] == REGISTERED and registration.credential_id not in inserted:
+                outcomes[index] = CREDENTIAL_ALREADY_REGISTERED
+        for outcome in outcomes:
+            self.progress.record(outcome)
+        return outcomes
+
+    async def register(self, registration: VerifiedRegistration) -> str:
+        return await self.submit(registration)
+
+
+async def get_enrolment_counts(session: AsyncSession) -> dict:
+    # from the database rather than the counters, so they cover every worker and everything registered before this process started
+    students = (await session.exec(select(func.count()).select_from(Student))).one()
+    registered = (await session.exec(select(func.count()).select_from(Student).where(Student.device_registered == True))).one()  # noqa: E712
+    credentials = (await session.exec(select(func.count()).select_from(Credential))).one()
+    return {"students": students, "students_with_a_device": registered, "credentials": credentials,
+            "percent_enrolled": round(100 * registered / students, 1) if students else 0.0}
+
+
+registration_writer = RegistrationWriter()
+enrolment_progress = registration_writer.progress
@@ -0,0 +1,129 @@
+from fastapi import HTTPException, status
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Annotated, Callable
+from .metrics import password_hash_seconds
+import asyncio
+import os
+import time
+
+# "thread" works fine for bcrypt and argon2 because both libraries release the GIL while hashing. "process" is there in case we move to a scheme that doesn't
+HASH_POOL_KIND = os.getenv("HASH_POOL_KIND", "thread")
+HASH_POOL_WORKERS: Annotated[int, "Number of hashing workers. Defaults to the number of cores"] = int(
+    os.getenv("HASH_POOL_WORKERS", os.cpu_count() or 1))
+HASH_QUEUE_LIMIT: Annotated[int, "Maximum number of hashes running or waiting for a worker before we start rejecting with 503"] = int(
+    os.getenv("HASH_QUEUE_LIMIT", HASH_POOL_WORKERS * 8))
+HASH_RETRY_AFTER_SECONDS = int(os.getenv("HASH_RETRY_AFTER_SECONDS", 1))
+
+hashing_pool_saturated_exception = HTTPException(
+    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+    detail="The server is busy. Try again shortly.",
+    headers={"Retry-After": str(HASH_RETRY_AFTER_SECONDS)},
+)
+
+
+class PasswordHasher:
+    def __init__(self, kind: str = HASH_POOL_KIND, workers: int = HASH_POOL_WORKERS, queue_limit: int = HASH_QUEUE_LIMIT):
+        self.kind = kind
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self._executor: Executor | None = None
+        self.in_flight = 0
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    @property
+    def executor(self) -> Executor:
+        # created on first use so importing this module doesn't spawn processes
+        if self._executor is None:
+            if self.kind == "process":
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix="password-hasher")
+        return self._executor
+
+    async def _run(self, operation: str, func: Callable, *args):
+        if self.in_flight >= self.queue_limit:
+            self.rejected += 1
+            raise hashing_pool_saturated_exception
+        self.in_flight += 1
+        self.submitted += 1
+        started = time.perf_counter()
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            self.in_flight -= 1
+        elapsed = time.perf_counter() - started
+        password_hash_seconds.observe(elapsed, operation)
+        self.completed += 1
+        self.total_seconds += elapsed
+        self.max_seconds = max(self.max_seconds, elapsed)
+        return result
+
+    async def hash(self, password: str) -> str:
+        from .utils import get_password_hash
+        return await self._run("hash", get_password_hash, password)
+
+    async def verify(self, plain_password: str, hashed_password: str) -> bool:
+        from .utils import verify_password
+        return await self._run("verify", verify_password, plain_password, hashed_password)
+
+    async def verify_and_update(self, plain_password: str, hashed_password: str) -> tuple[bool, str | None]:
+        # The rehash (when there is one) happens inside the same job, so an upgrade costs that one login a second hash and nothing else
+        from .utils import verify_and_update_password
+        return await self._run("verify", verify_and_update_password, plain_password, hashed_password)
+
+    async def hash_many(self, passwords: list[str]) -> list[str]:
+        # For bulk imports. These wait for a slot instead of being rejected, and only `workers` of them are queued at a time so logins can still get a worker in between
+        from .utils import get_password_hash
+        loop = asyncio.get_running_loop()
+        hashes: list[str] = []
+        for start in range(0, len(passwords), self.workers):
+            chunk = passwords[start:start + self.workers]
+            self.in_flight += len(chunk)
+            self.submitted += len(chunk)
+            started = time.perf_counter()
+            try:
+                hashes.extend(await asyncio.gather(*(loop.run_in_executor(self.executor, get_password_hash, password) for password in chunk)))
+            except Exception:
+                self.failed += len(chunk)
+                raise
+            finally:
+                self.in_flight -= len(chunk)
+            elapsed = time.perf_counter() - started
+            for _ in chunk:
+                password_hash_seconds.observe(elapsed, "bulk_hash")
+            self.completed += len(chunk)
+            self.total_seconds += elapsed * len(chunk)
+            self.max_seconds = max(self.max_seconds, elapsed)
+        return hashes
+
+    def stats(self) -> dict:
+        # the seconds include the time spent waiting for a free worker, which is what a client actually experiences
+        return {
+            "kind": self.kind,
+            "workers": self.workers,
+            "queue_limit": self.queue_limit,
+            "in_flight": self.in_flight,
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "average_seconds": self.total_seconds / self.completed if self.completed else 0.0,
+            "max_seconds": self.max_seconds,
+        }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+password_hasher = PasswordHasher()
@@ -0,0 +1,223 @@
+from contextlib import contextmanager
+from typing import Callable, Iterable
+import bisect
+import functools
+import time
+
+# Minimal Prometheus text-format metrics. Everything is recorded from the event loop thread so there is no locking.
+# Metrics recorded inside a process pool worker would be lost, which is why the hashing and webauthn timers sit at the call sites
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_labels(labelnames: tuple[str, ...], labelvalues: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{escape_label_value(str(value))}"' for name,
+             value in zip(labelnames, labelvalues)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+
+    def header(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+    def render(self) -> list[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = ()):
+        super().__init__(name, help, labelnames)
+        self.values: dict[tuple, float] = {}
+
+    def inc(self, *labelvalues, amount: float = 1):
+        self.values[labelvalues] = self.values.get(labelvalues, 0) + amount
+
+    def render(self) -> list[str]:
+        return self.header() + [f"{self.name}{format_labels(self.labelnames, labels)} {format_value(value)}" for labels, value in self.values.items()]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, *labelvalues, amount: float = 1):
+        self.inc(*labelvalues, amount=-amount)
+
+    def set(self, *labelvalues, value: float):
+        self.values[labelvalues] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # labelvalues -> [per bucket counts (not cumulative, the last slot is +Inf), sum, count]
+        self.values: dict[tuple, list] = {}
+
+    def observe(self, value: float, *labelvalues):
+        entry = self.values.get(labelvalues)
+        if entry is None:
+            entry = self.values[labelvalues] = [
+                [0] * (len(self.buckets) + 1), 0.0, 0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    @contextmanager
+    def time(self, *labelvalues):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labelvalues)
+
+    def timed(self, *labelvalues):
+        # decorator version of time() for async functions
+        def decorator(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                with self.time(*labelvalues):
+                    return await func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def render(self) -> list[str]:
+        lines = self.header()
+        for labels, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = f'le="{format_value(bound)}"'
+                lines.append(
+                    f"{self.name}_bucket{format_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(
+                f"{self.name}_sum{format_labels(self.labelnames, labels)} {format_value(total)}")
+            lines.append(
+                f"{self.name}_count{format_labels(self.labelnames, labels)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: list[Metric] = []
+        # collectors are called on every scrape and return metrics built from state that lives elsewhere (pools, caches, ...)
+        self.collectors: list[Callable[[], Iterable[Metric]]] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help: str, labelnames: tuple[str, ...] = ()) -> Counter:
+        return self.register(Counter(name, help, labelnames))
+
+    def gauge(self, name: str, help: str, labelnames: tuple[str, ...] = ()) -> Gauge:
+        return self.register(Gauge(name, help, labelnames))
+
+    def histogram(self, name: str, help: str, labelnames: tuple[str, ...] = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def add_collector(self, collector: Callable[[], Iterable[Metric]]):
+        self.collectors.append(collector)
+
+    def render(self) -> str:
+        lines: list[str] = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        for collector in self.collectors:
+            for metric in collector():
+                lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+http_requests = registry.counter(
+    "http_requests_total", "HTTP requests by route and status code", ("method", "route", "status"))
+http_request_seconds = registry.histogram(
+    "http_request_duration_seconds", "HTTP request latency by route", ("method", "route"))
+http_requests_in_flight = registry.gauge(
+    "http_requests_in_flight", "HTTP requests currently being handled", ("method",))
+password_hash_seconds = registry.histogram(
+    "password_hash_duration_seconds", "Time for a password hash or verify, including the wait for a hashing worker", ("operation",))
+jwt_decode_seconds = registry.histogram(
+    "jwt_decode_duration_seconds", "Time spent in jwt.decode")
+webauthn_verify_seconds = registry.histogram(
+    "webauthn_verify_duration_seconds", "Time spent verifying webauthn responses", ("ceremony",))
+crud_seconds = registry.histogram(
+    "crud_duration_seconds", "Time spent in each crud call", ("operation",))
+
+
+class MetricsMiddleware:
+    # Plain ASGI middleware rather than @app.middleware("http") so that it doesn't get in the way of streamed request and response bodies.
+    # startup_report is main's app.startup.StartupReport, passed in so that this module (which the pool workers import) doesn't import app.startup
+    def __init__(self, app, startup_report=None):
+        self.app = app
+        self.startup_report = startup_report
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        method = scope["method"]
+        status_code = 500
+        started = time.perf_counter()
+        if self.startup_report is not None:
+            self.startup_report.request_started()
+        # the route template is only known once the router has run, so in-flight can only be tracked per method
+        http_requests_in_flight.inc(method)
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            if self.startup_report is not None:
+                self.startup_report.request_finished()
+            http_requests_in_flight.dec(method)
+            route = scope.get("route")
+            # using the template (/lecture-sessions/{lecture_session_id}) keeps the number of label values bounded
+            route_path = getattr(route, "path", "unmatched")
+            http_request_seconds.observe(
+                time.perf_counter() - started, method, route_path)
+            http_requests.inc(method, route_path, str(status_code))
+
+
+def gauges_from_stats(prefix: str, help: str, labelled_stats: list[tuple[tuple, dict]], labelnames: tuple[str, ...] = ()) -> list[Gauge]:
+    # Turns the numeric values of the existing stats() dicts into gauges named <prefix>_<key>, one sample per (labelvalues, stats) pair
+    gauges: dict[str, Gauge] = {}
+    for labelvalues, stats in labelled_stats:
+        for key, value in stats.items():
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            if key not in gauges:
+                gauges[key] = Gauge(
+                    f"{prefix}_{key}", f"{help} ({key})", labelnames)
+            gauges[key].set(*labelvalues, value=value)
+    return list(gauges.values())
@@ -1,11 +1,16 @@
 from sqlmodel import SQLModel, Field
+from sqlalchemy import UniqueConstraint, Index
 from pydantic import BaseModel
 from uuid import UUID
+from dataclasses import dataclass
+from datetime import datetime
 
 
 class BaseStudent(SQLModel):
     matric_number: str = Field(primary_key=True, max_length=15, min_length=5)
     password: str
+    # credential_id, public_key, sign_count and transports are from when a student could only have one device. Devices live in Credential now,
+    # these columns are only read by script/migrate_credentials.py
     credential_id: bytes | None = None
     public_key: bytes | None = None
     sign_count: int | None = None
@@ -28,6 +33,97 @@ class StudentUpdateModel(BaseStudent):
     password: str | None = None
 
 
+@dataclass(frozen=True)
+class StudentSnapshot:
+    # Read-only copy of the parts of a student the webauthn flow needs. This is what crud caches, so it deliberately leaves the password hash out
+    matric_number: str
+    credential_id: bytes | None
+    public_key: bytes | None
+    transports: str | None
+    sign_count: int | None
+    device_registered: bool
+    user_id: UUID | None = None
+
+    @classmethod
+    def from_student(cls, student: "Student") -> "StudentSnapshot":
+        return cls(matric_number=student.matric_number, credential_id=student.credential_id, public_key=student.public_key,
+                   transports=student.transports, sign_count=student.sign_count, device_registered=student.device_registered, user_id=student.user_id)
+
+
+class Credential(SQLModel, table=True):
+    # One row per registered device, so a student who replaces their phone keeps the old one until it is removed.
+    # The unique index on credential_id resolves the rawId of an assertion to its owner in one lookup, which is what usernameless login relies on
+    id: int | None = Field(default=None, primary_key=True)
+    credential_id: bytes = Field(unique=True, index=True)
+    matric_number: str = Field(
+        foreign_key="student.matric_number", max_length=15, index=True)
+    public_key: bytes
+    sign_count: int = 0
+    transports: str | None = None
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    last_used_at: datetime | None = None
+
+
+@dataclass(frozen=True)
+class CredentialSnapshot:
+    id: int
+    credential_id: bytes
+    matric_number: str
+    public_key: bytes
+    sign_count: int
+    transports: str | None
+
+    @classmethod
+    def from_credential(cls, credential: "Credential") -> "CredentialSnapshot":
+        return cls(id=credential.id, credential_id=credential.credential_id, matric_number=credential.matric_number,
+                   public_key=credential.public_key, sign_count=credential.sign_count, transports=credential.transports)
+
+
+class BaseLectureSession(SQLModel):
+    course_code: str = Field(index=True, max_length=15)
+    title: str | None = None
+
+
+class LectureSession(BaseLectureSession, table=True):
+    id: int | None = Field(default=None, primary_key=True)
+    opened_at: datetime = Field(default_factory=datetime.utcnow)
+    closes_at: datetime
+    # kept up to date by AttendanceWriter in the same transaction as the check-ins themselves
+    attendance_count: int = 0
+
+
+class LectureSessionCreateModel(BaseLectureSession):
+    duration_minutes: int = Field(default=120, gt=0, le=24 * 60)
+    # matric numbers whose check-ins are prepared when the lecture opens. Without it the students who attended this course before are used
+    roster: list[str] | None = Field(default=None, max_length=5000)
+
+
+class AttendanceRecord(SQLModel, table=True):
+    # the unique constraint is what makes a repeated check-in for the same lecture a no-op, and it doubles as the (session, student) index.
+    # (student, time) is for pulling up one student's check-ins across the semester
+    __table_args__ = (UniqueConstraint("lecture_session_id", "matric_number"),
+                      Index("ix_attendancerecord_matric_number_checked_in_at", "matric_number", "checked_in_at"))
+    id: int | None = Field(default=None, primary_key=True)
+    lecture_session_id: int = Field(foreign_key="lecturesession.id")
+    matric_number: str = Field(
+        foreign_key="student.matric_number", max_length=15)
+    checked_in_at: datetime = Field(default_factory=datetime.utcnow)
+
+
+class CourseAttendanceSummary(SQLModel, table=True):
+    # Precomputed per-course totals so that reports never have to scan the raw check-ins
+    course_code: str = Field(primary_key=True, max_length=15)
+    sessions_held: int = 0
+    check_ins: int = 0
+
+
+class StudentCourseAttendance(SQLModel, table=True):
+    course_code: str = Field(primary_key=True, max_length=15)
+    matric_number: str = Field(primary_key=True, max_length=15, index=True)
+    sessions_attended: int = 0
+    last_checked_in_at: datetime | None = None
+
+
 class RefreshToken(BaseModel):
     refresh_token: str
 
@@ -37,3 +133,33 @@ class TokenResponse(BaseModel):
     token_type: str
     refresh_token: str | None = None
     new_access_token: str | None = None
+
+
+class Challenge(SQLModel, table=True):
+    # Only used by DatabaseChallengeStore so that pending webauthn ceremonies are visible to every worker
+    key: str = Field(primary_key=True, max_length=64)
+    challenge: bytes
+    expires_at: float = Field(index=True)
+
+
+class RefreshTokenFamily(SQLModel, table=True):
+    # One row per login, see app.refresh_tokens. generation is how many times its refresh token has been rotated
+    family_id: UUID = Field(primary_key=True)
+    matric_number: str = Field(max_length=15, index=True)
+    generation: int = 0
+    expires_at: datetime = Field(index=True)
+    revoked_at: datetime | None = None
+
+
+class TokenRevocation(SQLModel, table=True):
+    # One row per student whose tokens were revoked, see app.utils.invalidate_student_tokens. In the database so that every worker stops accepting them
+    matric_number: str = Field(primary_key=True, max_length=15)
+    # unix time, every token issued to the student up to then is rejected
+    revoked_at: float
+
+
+class RateLimitBucket(SQLModel, table=True):
+    # Only used by DatabaseRateLimitStore so that every worker draws from the same token buckets
+    key: str = Field(primary_key=True, max_length=80)
+    tokens: float
+    updated_at: float = Field(index=True)
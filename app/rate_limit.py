@@ -0,0 +1,158 @@
+from fastapi import HTTPException, status
+from sqlalchemy import case, delete
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlmodel.ext.asyncio.session import AsyncSession
+from typing import Annotated
+from .cache import TTLCache
+from .models import RateLimitBucket
+import math
+import os
+import time
+
+# Same trade-off as CHALLENGE_STORE: memory is only correct for a single uvicorn worker, with more workers each one would hand out its own full set of tokens
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true").lower() == "true"
+RATE_LIMIT_STORE = os.getenv("RATE_LIMIT_STORE", "memory")
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", 100_000))
+# A token bucket holds up to BURST requests and gets PER_MINUTE of them back every minute.
+# Password guesses against one matric number are limited hard. The webauthn ceremony is two requests and can be retried a few times
+LOGIN_RATE_LIMIT_BURST = int(os.getenv("LOGIN_RATE_LIMIT_BURST", 5))
+LOGIN_RATE_LIMIT_PER_MINUTE = float(os.getenv("LOGIN_RATE_LIMIT_PER_MINUTE", 10))
+WEBAUTHN_RATE_LIMIT_BURST = int(os.getenv("WEBAUTHN_RATE_LIMIT_BURST", 20))
+WEBAUTHN_RATE_LIMIT_PER_MINUTE = float(
+    os.getenv("WEBAUTHN_RATE_LIMIT_PER_MINUTE", 60))
+# a whole lecture hall can sit behind the campus NAT, so the per IP bucket has to fit everyone logging in at the start of a lecture
+IP_RATE_LIMIT_BURST = int(os.getenv("IP_RATE_LIMIT_BURST", 600))
+IP_RATE_LIMIT_PER_MINUTE = float(os.getenv("IP_RATE_LIMIT_PER_MINUTE", 1200))
+EXPENSIVE_REQUEST_CONCURRENCY: Annotated[int, "Requests allowed inside the hashing/webauthn endpoints of one worker at once. The rest get a 429 straight away"] = int(
+    os.getenv("EXPENSIVE_REQUEST_CONCURRENCY", 64))
+
+
+def too_many_requests_exception(retry_after: float) -> HTTPException:
+    return HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail="Too many requests. Slow down and try again shortly.",
+                         headers={"Retry-After": str(max(1, math.ceil(retry_after)))})
+
+
+class RateLimitStore:
+    # take has to refill and spend in one atomic step, otherwise two requests racing each other could both spend the last token
+    async def take(self, key: str, capacity: int, refill_per_second: float) -> float:
+        # 0 when the request can go ahead, otherwise roughly how many seconds until it could
+        raise NotImplementedError
+
+    def reset(self):
+        pass
+
+
+class InMemoryRateLimitStore(RateLimitStore):
+    def __init__(self, max_keys: int = RATE_LIMIT_MAX_KEYS, clock=time.monotonic):
+        # key -> (tokens, updated_at). The ttl per key is the time the bucket takes to fill back up, after that forgetting it is the same as a full bucket
+        self.buckets = TTLCache(maxsize=max_keys, ttl=60, clock=clock)
+        self.clock = clock
+
+    async def take(self, key: str, capacity: int, refill_per_second: float) -> float:
+        # there is no await in here so nothing else can run between the read and the write
+        now = self.clock()
+        tokens, updated_at = self.buckets.get(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - updated_at) * refill_per_second)
+        if tokens < 1:
+            self.buckets.set(key, (tokens, now), capacity / refill_per_second)
+            return (1 - tokens) / refill_per_second
+        self.buckets.set(key, (tokens - 1, now), capacity / refill_per_second)
+        return 0.0
+
+    def reset(self):
+        self.buckets.clear()
+
+
+class DatabaseRateLimitStore(RateLimitStore):
+    def __init__(self, engine: AsyncEngine, purge_every: int = 1000, max_refill_seconds: float = 3600):
+        self.engine = engine
+        self.purge_every = purge_every
+        self.max_refill_seconds = max_refill_seconds
+        self._takes = 0
+
+    async def take(self, key: str, capacity: int, refill_per_second: float) -> float:
+        from .database import get_dialect_insert
+        now = time.time()
+        async with AsyncSession(self.engine) as session:
+            insert = get_dialect_insert(session)
+            refilled = RateLimitBucket.tokens + \
+                (now - RateLimitBucket.updated_at) * refill_per_second
+            refilled = case((refilled > capacity, capacity), else_=refilled)
+            # The refill and the spend are a single upsert, and the WHERE makes it update nothing when the bucket is empty.
+            # So a row coming back from RETURNING means the request got a token
+            statement = insert(RateLimitBucket).values(key=key, tokens=capacity - 1, updated_at=now)
+            statement = statement.on_conflict_do_update(index_elements=[RateLimitBucket.key], set_={
+                "tokens": refilled - 1, "updated_at": now}, where=refilled >= 1).returning(RateLimitBucket.tokens)
+            allowed = (await session.exec(statement)).scalar_one_or_none() is not None
+            self._takes += 1
+            # a bucket that hasn't been touched for max_refill_seconds is full again, so its row can go
+            if self._takes % self.purge_every == 0:
+                await session.exec(delete(RateLimitBucket).where(RateLimitBucket.updated_at <= now - self.max_refill_seconds))
+            await session.commit()
+        # a rejected upsert doesn't return the bucket, and one token's worth of refill is the longest it can take
+        return 0.0 if allowed else 1 / refill_per_second
+
+
+class RateLimit:
+    def __init__(self, name: str, burst: int, per_minute: float, store: RateLimitStore):
+        self.name = name
+        self.burst = burst
+        self.refill_per_second = per_minute / 60
+        self.store = store
+        self.allowed = 0
+        self.rejected = 0
+
+    async def check(self, key: str):
+        if not RATE_LIMIT_ENABLED:
+            return
+        retry_after = await self.store.take(f"{self.name}:{key}", self.burst, self.refill_per_second)
+        if retry_after:
+            self.rejected += 1
+            raise too_many_requests_exception(retry_after)
+        self.allowed += 1
+
+    def stats(self) -> dict:
+        return {"burst": self.burst, "per_minute": self.refill_per_second * 60, "allowed": self.allowed, "rejected": self.rejected}
+
+
+class ConcurrencyLimit:
+    # Caps how many requests are inside the expensive endpoints of this worker. It is per process on purpose: what it protects is this process's CPU and hashing pool.
+    # Unlike the hashing pool's queue limit this is checked before the request touches the database at all
+    def __init__(self, limit: int = EXPENSIVE_REQUEST_CONCURRENCY, retry_after: float = 1):
+        self.limit = limit
+        self.retry_after = retry_after
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.rejected = 0
+
+    def acquire(self):
+        if self.in_flight >= self.limit:
+            self.rejected += 1
+            raise too_many_requests_exception(self.retry_after)
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    def release(self):
+        self.in_flight -= 1
+
+    def stats(self) -> dict:
+        return {"limit": self.limit, "in_flight": self.in_flight, "max_in_flight": self.max_in_flight, "rejected": self.rejected}
+
+
+def create_rate_limit_store(kind: str = RATE_LIMIT_STORE) -> RateLimitStore:
+    if kind == "database":
+        from .database import async_engine
+        return DatabaseRateLimitStore(async_engine)
+    if kind == "memory":
+        return InMemoryRateLimitStore()
+    raise ValueError(f"Unknown RATE_LIMIT_STORE {kind!r}")
+
+
+rate_limit_store = create_rate_limit_store()
+login_rate_limit = RateLimit("login", LOGIN_RATE_LIMIT_BURST,
+                             LOGIN_RATE_LIMIT_PER_MINUTE, rate_limit_store)
+webauthn_rate_limit = RateLimit(
+    "webauthn", WEBAUTHN_RATE_LIMIT_BURST, WEBAUTHN_RATE_LIMIT_PER_MINUTE, rate_limit_store)
+ip_rate_limit = RateLimit("ip", IP_RATE_LIMIT_BURST,
+                          IP_RATE_LIMIT_PER_MINUTE, rate_limit_store)
+expensive_requests = ConcurrencyLimit()
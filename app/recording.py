@@ -0,0 +1,189 @@
+from fastapi import HTTPException, status
+from fastapi.responses import Response
+from typing import Annotated, BinaryIO
+from .cache import TTLCache
+import mmap
+import os
+import pathlib
+import re
+import struct
+import time
+
+# Everything the lecturer streams is also written to disk so students who missed something can replay it.
+# A recording is a directory per lecture session: numbered segment files, each a run of chunks as <4 byte big endian length><message as it was streamed>,
+# and an index with one fixed size record per chunk. Players read the manifest (built from the index), then fetch the segments they need with Range requests
+RECORDINGS_DIR: Annotated[str, "Recordings go in <RECORDINGS_DIR>/<lecture_session_id>/"] = os.getenv(
+    "RECORDINGS_DIR", "recordings")
+RECORDING_ENABLED = os.getenv("RECORDING_ENABLED", "true").lower() == "true"
+RECORDING_SEGMENT_BYTES: Annotated[int, "A new segment is started once the current one would grow past this"] = int(
+    os.getenv("RECORDING_SEGMENT_BYTES", 8 * 1024 * 1024))
+RECORDING_FLUSH_SECONDS: Annotated[float, "How far behind the live stream the replay of a lecture that is still going can be"] = float(
+    os.getenv("RECORDING_FLUSH_SECONDS", 1))
+# unix time in milliseconds, segment number, offset of the length prefix in the segment, message length, flags byte
+INDEX_RECORD = struct.Struct(">QIIIB")
+CHUNK_LENGTH = struct.Struct(">I")
+KEYFRAME_FLAG = 0x01
+
+recording_not_found_exception = HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                                              detail="This lecture has not been recorded.")
+
+
+def recording_directory(lecture_session_id: int) -> pathlib.Path:
+    return pathlib.Path(RECORDINGS_DIR) / str(lecture_session_id)
+
+
+def segment_path(directory: pathlib.Path, segment: int) -> pathlib.Path:
+    return directory / f"{segment:06d}.seg"
+
+
+class LectureRecorder:
+    # Appends the published chunks to the current segment and the index. Both are buffered and flushed every RECORDING_FLUSH_SECONDS,
+    # segment first, so an index record never points at bytes that aren't on disk yet. These are writes to the page cache, quick enough for the event loop
+    def __init__(self, directory: pathlib.Path, segment_bytes: int = RECORDING_SEGMENT_BYTES, flush_seconds: float = RECORDING_FLUSH_SECONDS,
+                 clock=time.time):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.flush_seconds = flush_seconds
+        self.clock = clock
+        directory.mkdir(parents=True, exist_ok=True)
+        index_path = directory / "index"
+        # a lecturer who reconnects carries on with the same recording. A record cut short by a crash is dropped
+        self.segment = 0
+        if index_path.exists():
+            size = index_path.stat().st_size
+            with open(index_path, "r+b") as index_file:
+                index_file.truncate(size - size % INDEX_RECORD.size)
+                if size >= INDEX_RECORD.size:
+                    index_file.seek(-INDEX_RECORD.size, os.SEEK_END)
+                    self.segment = INDEX_RECORD.unpack(index_file.read(INDEX_RECORD.size))[1]
+        self.index_file: BinaryIO = open(index_path, "ab")
+        self.segment_file: BinaryIO = open(segment_path(directory, self.segment), "ab", buffering=1024 * 1024)
+        self.last_flush = clock()
+
+    def append(self, message: bytes):
+        offset = self.segment_file.tell()
+        if offset and offset + CHUNK_LENGTH.size + len(message) > self.segment_bytes:
+            self.segment_file.close()
+            self.segment += 1
+            # "wb": the segment is flushed before the index, so after a crash the next segment can already hold bytes the index never got to
+            self.segment_file = open(segment_path(self.directory, self.segment), "wb", buffering=1024 * 1024)
+            offset = 0
+        self.segment_file.write(CHUNK_LENGTH.pack(len(message)))
+        self.segment_file.write(message)
+        now = self.clock()
+        self.index_file.write(INDEX_RECORD.pack(round(now * 1000), self.segment, offset, len(message), message[0] if message else 0))
+        if now - self.last_flush >= self.flush_seconds:
+            self.flush()
+
+    def flush(self):
+        self.segment_file.flush()
+        self.index_file.flush()
+        self.last_flush = self.clock()
+
+    def close(self):
+        self.flush()
+        self.segment_file.close()
+        self.index_file.close()
+
+
+def open_recorder(lecture_session_id: int) -> LectureRecorder | None:
+    return LectureRecorder(recording_directory(lecture_session_id)) if RECORDING_ENABLED else None
+
+
+# The manifest of a lecture that is still being recorded changes every second, so it is cached by the size of its index rather than for a fixed time
+manifest_cache: Annotated[TTLCache, "(lecture session id, index size) -> manifest"] = TTLCache(
+    maxsize=256, ttl=60 * 60)
+
+
+def read_manifest(lecture_session_id: int) -> dict:
+    index_path = recording_directory(lecture_session_id) / "index"
+    try:
+        size = index_path.stat().st_size
+    except FileNotFoundError:
+        raise recording_not_found_exception
+    size -= size % INDEX_RECORD.size
+    if not size:
+        raise recording_not_found_exception
+    manifest = manifest_cache.get((lecture_session_id, size))
+    if manifest is not None:
+        return manifest
+    with open(index_path, "rb") as index_file:
+        index = index_file.read(size)
+    started_at = INDEX_RECORD.unpack_from(index)[0]
+    segment_sizes: dict[int, int] = {}
+    keyframes = []
+    chunks = 0
+    for milliseconds, segment, offset, length, flags in INDEX_RECORD.iter_unpack(index):
+        chunks += 1
+        segment_sizes[segment] = offset + CHUNK_LENGTH.size + length
+        # only the keyframes, they are the only places a player can seek to
+        if flags & KEYFRAME_FLAG:
+            keyframes.append([milliseconds - started_at, segment, offset])
+    manifest = {
+        "lecture_session_id": lecture_session_id,
+        "started_at_ms": started_at,
+        "duration_ms": milliseconds - started_at,
+        "chunks": chunks,
+        # the bytes of each segment that the index covers, a segment that is still being written can be longer than this
+        "segments": [{"segment": segment, "bytes": size} for segment, size in sorted(segment_sizes.items())],
+        "keyframes": keyframes,
+    }
+    manifest_cache.set((lecture_session_id, size), manifest)
+    return manifest
+
+
+def parse_range(range_header: str | None, size: int) -> tuple[int, int] | None:
+    # A single "bytes=start-end", "bytes=start-" or "bytes=-suffix" range as (start, end inclusive). None means send the whole file,
+    # which is also the answer to several ranges at once since players only ever ask for one. ValueError means it can't be satisfied
+    match = re.fullmatch(r"\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)\s*", range_header or "")
+    if match is None or not any(match.groups()):
+        return None
+    first, last = match.groups()
+    if not first:
+        length = int(last)
+        if not length or not size:
+            raise ValueError
+        return max(0, size - length), size - 1
+    start, end = int(first), int(last) if last else size - 1
+    if start >= size or end < start:
+        raise ValueError
+    return start, min(end, size - 1)
+
+
+class MappedFileResponse(Response):
+    # Starlette's FileResponse doesn't do ranges, and reading the whole segment into a bytes object for each request is what we want to avoid.
+    # The file is memory mapped and sent chunk_size bytes at a time, so a request never holds more than one chunk of its own
+    chunk_size = 256 * 1024
+
+    def __init__(self, path: pathlib.Path, range_header: str | None = None, media_type: str = "application/octet-stream", headers: dict | None = None):
+        self.path = path
+        self.media_type = media_type
+        self.background = None
+        size = path.stat().st_size
+        headers = {"accept-ranges": "bytes", **(headers or {})}
+        try:
+            byte_range = parse_range(range_header, size)
+        except ValueError:
+            self.status_code, self.start, self.end = status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE, 0, -1
+            headers["content-range"] = f"bytes */{size}"
+        else:
+            if byte_range is None:
+                self.status_code, (self.start, self.end) = status.HTTP_200_OK, (0, size - 1)
+            else:
+                self.status_code, (self.start, self.end) = status.HTTP_206_PARTIAL_CONTENT, byte_range
+                headers["content-range"] = f"bytes {self.start}-{self.end}/{size}"
+        headers["content-length"] = str(self.end - self.start + 1)
+        self.init_headers(headers)
+
+    async def __call__(self, scope, receive, send):
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        if scope["method"] == "HEAD" or self.end < self.start:
+            await send({"type": "http.response.body", "body": b""})
+            return
+        with open(self.path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if hasattr(mmap, "MADV_SEQUENTIAL"):
+                mapped.madvise(mmap.MADV_SEQUENTIAL)
+            for start in range(self.start, self.end + 1, self.chunk_size):
+                end = min(start + self.chunk_size, self.end + 1)
+                # bytes, not a view of the mapping. The transport can keep what it hasn't sent yet, and the mapping couldn't be closed under it
+                await send({"type": "http.response.body", "body": mapped[start:end], "more_body": end <= self.end})
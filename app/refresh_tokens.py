@@ -0,0 +1,137 @@
+from sqlmodel import update, delete
+from sqlmodel.ext.asyncio.session import AsyncSession
+from typing import Annotated, Callable
+from .models import RefreshTokenFamily
+from datetime import datetime, timedelta
+import asyncio
+import os
+import uuid
+
+# Every login starts a token family, a row holding which generation of refresh token is the current one. /refresh only accepts the current
+# generation and hands back the next one, so each refresh token works once. If an older one turns up again, somebody kept a copy of it:
+# the whole family is revoked and the student has to log in again, whoever they were. Revoking a student revokes all their families
+REFRESH_TOKEN_EXPIRE_MINUTES: Annotated[int,
+                                        "I am setting the refresh token time to 4hrs. It starts again with every refresh, so an active student stays logged in"] = 240
+REFRESH_TOKEN_PURGE_INTERVAL_SECONDS: Annotated[float, "How often the expired and revoked families are deleted"] = float(
+    os.getenv("REFRESH_TOKEN_PURGE_INTERVAL_SECONDS", 15 * 60))
+REFRESH_TOKEN_PURGE_AFTER_HOURS: Annotated[float, "Families are kept this long after they expire or are revoked so a late reuse is still reported"] = float(
+    os.getenv("REFRESH_TOKEN_PURGE_AFTER_HOURS", 24))
+
+
+def default_session_factory() -> AsyncSession:
+    from .database import async_engine
+    return AsyncSession(async_engine, expire_on_commit=False)
+
+
+class RefreshTokenFamilies:
+    def __init__(self, lifetime: timedelta = timedelta(minutes=REFRESH_TOKEN_EXPIRE_MINUTES), purge_after: timedelta = timedelta(hours=REFRESH_TOKEN_PURGE_AFTER_HOURS),
+                 session_factory: Callable[[], AsyncSession] = default_session_factory):
+        self.lifetime = lifetime
+        self.purge_after = purge_after
+        self.session_factory = session_factory
+        self.started = 0
+        self.rotated = 0
+        self.rejected = 0
+        self.reuse_detected = 0
+        self.revoked = 0
+        self.purged = 0
+
+    def encode(self, matric_number: str, family_id: uuid.UUID, generation: int) -> str:
+        from .utils import create_access_refresh_token
+        return create_access_refresh_token(data={"sub": "refresh|" + matric_number, "fam": family_id.hex, "gen": generation},
+                                           expires_delta=self.lifetime)
+
+    def decode(self, refresh_token: str) -> tuple[str, uuid.UUID, int]:
+        # Only the signature and the claims, no database. Refresh tokens from before the families existed have no fam claim and aren't accepted any more
+        from jose import JWTError
+        from .utils import credentials_exception, revoked_students
+        from .token_keys import get_token_keys
+        try:
+            payload = get_token_keys().decode(refresh_token)
+            token_type, _, matric_number = payload["sub"].partition("|")
+            family_id, generation = uuid.UUID(hex=payload["fam"]), int(payload["gen"])
+        except (JWTError, KeyError, TypeError, ValueError, AttributeError):
+            raise credentials_exception
+        if token_type != "refresh" or not matric_number:
+            raise credentials_exception
+        matric_number = matric_number.upper()
+        # revocations this worker already knows about. The ones it doesn't were made with revoke_student too, and rotate finds those families revoked
+        revoked_at = revoked_students.get(matric_number)
+        if revoked_at and payload.get("iat", 0) <= revoked_at:
+            raise credentials_exception
+        return matric_number, family_id, generation
+
+    async def start(self, session: AsyncSession, matric_number: str) -> str:
+        family = RefreshTokenFamily(family_id=uuid.uuid4(), matric_number=matric_number.upper(), generation=0,
+                                    expires_at=datetime.utcnow() + self.lifetime)
+        session.add(family)
+        await session.commit()
+        self.started += 1
+        return self.encode(family.matric_number, family.family_id, 0)
+
+    async def rotate(self, session: AsyncSession, refresh_token: str) -> tuple[str, str]:
+        # Returns the matric number and the next refresh token. The happy path is a single compare-and-set update by primary key:
+        # it only matches while this token's generation is the current one, so two requests racing with the same token can't both get through
+        from .utils import credentials_exception
+        matric_number, family_id, generation = self.decode(refresh_token)
+        now = datetime.utcnow()
+        result = await session.exec(update(RefreshTokenFamily).where(
+            RefreshTokenFamily.family_id == family_id, RefreshTokenFamily.matric_number == matric_number, RefreshTokenFamily.generation == generation,
+            RefreshTokenFamily.revoked_at.is_(None), RefreshTokenFamily.expires_at > now,
+        ).values(generation=generation + 1, expires_at=now + self.lifetime).returning(RefreshTokenFamily.family_id))
+        if result.first() is not None:
+            await session.commit()
+            self.rotated += 1
+            return matric_number, self.encode(matric_number, family_id, generation + 1)
+        # Didn't match, so a second read to find out why. A family that has moved past this generation means the token was used before
+        family = await session.get(RefreshTokenFamily, family_id)
+        if family is not None and family.revoked_at is None and family.generation > generation:
+            family.revoked_at = now
+            await session.commit()
+            self.reuse_detected += 1
+            print(f"Refresh token reused for {family.matric_number}, revoked family {family_id}")
+        else:
+            await session.rollback()
+        self.rejected += 1
+        raise credentials_exception
+
+    async def revoke(self, session: AsyncSession, refresh_token: str) -> bool:
+        # logging out of one device: only that login's family goes
+        _, family_id, _ = self.decode(refresh_token)
+        return await self._revoke(session, RefreshTokenFamily.family_id == family_id) > 0
+
+    async def revoke_student(self, session: AsyncSession, matric_number: str) -> int:
+        return await self._revoke(session, RefreshTokenFamily.matric_number == matric_number.upper())
+
+    async def _revoke(self, session: AsyncSession, condition) -> int:
+        result = await session.exec(update(RefreshTokenFamily).where(condition, RefreshTokenFamily.revoked_at.is_(None)).values(
+            revoked_at=datetime.utcnow()).returning(RefreshTokenFamily.family_id))
+        revoked = len(result.all())
+        await session.commit()
+        self.revoked += revoked
+        return revoked
+
+    async def purge_expired(self, session: AsyncSession) -> int:
+        # A range scan of the expires_at index. Revoking a family doesn't move its expires_at, so revoked families are caught by this too
+        result = await session.exec(delete(RefreshTokenFamily).where(
+            RefreshTokenFamily.expires_at < datetime.utcnow() - self.purge_after))
+        await session.commit()
+        self.purged += result.rowcount
+        return result.rowcount
+
+    async def purge_periodically(self, interval_seconds: float = REFRESH_TOKEN_PURGE_INTERVAL_SECONDS):
+        # started by the lifespan. Every worker runs it, the deletes just overlap and the later ones find nothing
+        while True:
+            await asyncio.sleep(interval_seconds)
+            try:
+                async with self.session_factory() as session:
+                    await self.purge_expired(session)
+            except Exception as err:
+                print("Purging refresh token families failed:", err)
+
+    def stats(self) -> dict:
+        return {"started": self.started, "rotated": self.rotated, "rejected": self.rejected, "reuse_detected": self.reuse_detected,
+                "revoked": self.revoked, "purged": self.purged}
+
+
+refresh_token_families = RefreshTokenFamilies()
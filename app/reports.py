@@ -0,0 +1,82 @@
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from typing import AsyncIterator, Optional
+from .models import CourseAttendanceSummary, StudentCourseAttendance
+import csv
+import io
+
+# All of these read the precomputed counters that AttendanceWriter maintains, so their cost doesn't grow with the number of lectures in the semester
+
+
+def attendance_percentage(sessions_attended: int, sessions_held: int) -> float:
+    if not sessions_held:
+        return 0.0
+    return round(100 * sessions_attended / sessions_held, 2)
+
+
+async def get_course_report(session: AsyncSession, course_code: str) -> Optional[dict]:
+    summary = await session.get(CourseAttendanceSummary, course_code.upper())
+    if summary is None:
+        return None
+    return {
+        "course_code": summary.course_code,
+        "sessions_held": summary.sessions_held,
+        "check_ins": summary.check_ins,
+        "average_check_ins_per_session": round(summary.check_ins / summary.sessions_held, 2) if summary.sessions_held else 0.0,
+    }
+
+
+async def get_student_course_report(session: AsyncSession, course_code: str, matric_number: str) -> Optional[dict]:
+    course_code, matric_number = course_code.upper(), matric_number.upper()
+    summary = await session.get(CourseAttendanceSummary, course_code)
+    if summary is None:
+        return None
+    attendance = await session.get(StudentCourseAttendance, (course_code, matric_number))
+    sessions_attended = attendance.sessions_attended if attendance else 0
+    return {
+        "course_code": course_code,
+        "matric_number": matric_number,
+        "sessions_held": summary.sessions_held,
+        "sessions_attended": sessions_attended,
+        "attendance_percentage": attendance_percentage(sessions_attended, summary.sessions_held),
+        "last_checked_in_at": attendance.last_checked_in_at if attendance else None,
+    }
+
+
+async def get_student_report(session: AsyncSession, matric_number: str) -> list[dict]:
+    # one row per course the student has ever checked in to
+    matric_number = matric_number.upper()
+    result = await session.exec(select(StudentCourseAttendance, CourseAttendanceSummary).join(
+        CourseAttendanceSummary, CourseAttendanceSummary.course_code == StudentCourseAttendance.course_code).where(
+        StudentCourseAttendance.matric_number == matric_number).order_by(StudentCourseAttendance.course_code))
+    return [{
+        "course_code": attendance.course_code,
+        "sessions_held": summary.sessions_held,
+        "sessions_attended": attendance.sessions_attended,
+        "attendance_percentage": attendance_percentage(attendance.sessions_attended, summary.sessions_held),
+        "last_checked_in_at": attendance.last_checked_in_at,
+    } for attendance, summary in result.all()]
+
+
+async def stream_course_report_csv(session: AsyncSession, course_code: str) -> AsyncIterator[str]:
+    # Streams the rows from the database straight into the response instead of building the whole report first
+    course_code = course_code.upper()
+    summary = await session.get(CourseAttendanceSummary, course_code)
+    sessions_held = summary.sessions_held if summary else 0
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(["matric_number", "sessions_attended",
+                    "sessions_held", "attendance_percentage", "last_checked_in_at"])
+    result = await session.stream(select(StudentCourseAttendance).where(
+        StudentCourseAttendance.course_code == course_code).order_by(StudentCourseAttendance.matric_number))
+    async for partition in result.scalars().partitions(500):
+        for attendance in partition:
+            writer.writerow([attendance.matric_number, attendance.sessions_attended, sessions_held,
+                             attendance_percentage(attendance.sessions_attended, sessions_held),
+                             attendance.last_checked_in_at.isoformat() if attendance.last_checked_in_at else ""])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    # the header on its own still has to go out when nobody attended
+    if buffer.getvalue():
+        yield buffer.getvalue()
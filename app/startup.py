@@ -0,0 +1,146 @@
+from contextlib import contextmanager
+from typing import Annotated
+import builtins
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+STARTUP_PROFILE_IMPORTS = os.getenv(
+    "STARTUP_PROFILE_IMPORTS", "true").lower() == "true"
+STARTUP_REPORT_SLOWEST_IMPORTS: Annotated[int, "How many packages the import breakdown lists"] = int(
+    os.getenv("STARTUP_REPORT_SLOWEST_IMPORTS", 10))
+
+
+def get_process_started_at() -> float | None:
+    # Unix time the process was started at, so the report includes the interpreter starting up and uvicorn importing itself.
+    # Only linux exposes it cheaply, everywhere else the report starts counting when app.startup is imported
+    try:
+        with open("/proc/self/stat") as stat_file:
+            # the command name in brackets can contain spaces, the fields after it can't. starttime is field 22, in clock ticks since boot
+            fields = stat_file.read().rpartition(")")[2].split()
+        started_after_boot = int(fields[19]) / os.sysconf("SC_CLK_TCK")
+        return time.time() - (time.clock_gettime(time.CLOCK_BOOTTIME) - started_after_boot)
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+class ImportProfiler:
+    # Wraps __import__ while the app is starting and adds up the time spent importing each top level package, not counting the packages it imports in turn.
+    # Same idea as python -X importtime but it can be read from the running app. importlib.import_module doesn't go through __import__, so a few modules are
+    # counted in whichever package imported them
+    def __init__(self):
+        self.seconds_by_package: dict[str, float] = {}
+        self._children_seconds: list[float] = []
+        self._original_import = None
+        self._thread_id: int | None = None
+
+    def install(self):
+        if self._original_import is None:
+            self._original_import = builtins.__import__
+            self._thread_id = threading.get_ident()
+            builtins.__import__ = self._import
+
+    def uninstall(self):
+        # after startup every import statement in a function body would go through here as well, so it is only there until the app is ready
+        if self._original_import is not None:
+            builtins.__import__ = self._original_import
+            self._original_import = None
+
+    def _import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        # relative imports and modules that are already loaded cost next to nothing, so they aren't timed.
+        # Neither are other threads' imports, they would interleave with the main thread's on the same stack
+        if level or name in sys.modules or threading.get_ident() != self._thread_id:
+            return self._original_import(name, globals, locals, fromlist, level)
+        started = time.perf_counter()
+        self._children_seconds.append(0.0)
+        try:
+            return self._original_import(name, globals, locals, fromlist, level)
+        finally:
+            children_seconds = self._children_seconds.pop()
+            seconds = time.perf_counter() - started
+            package = name.partition(".")[0]
+            self.seconds_by_package[package] = self.seconds_by_package.get(
+                package, 0.0) + seconds - children_seconds
+            if self._children_seconds:
+                self._children_seconds[-1] += seconds
+
+    def slowest(self, count: int = STARTUP_REPORT_SLOWEST_IMPORTS) -> dict[str, float]:
+        return dict(sorted(self.seconds_by_package.items(), key=lambda item: item[1], reverse=True)[:count])
+
+
+class StartupReport:
+    # Where a worker's cold start goes: from the process starting to main being imported, the imports, the lifespan startup, and the first request.
+    # Every timestamp is unix time so they line up with the process start time from /proc
+    def __init__(self):
+        self.process_started_at = get_process_started_at()
+        self.imports_started_at = time.time()
+        self.imports_finished_at: float | None = None
+        self.ready_at: float | None = None
+        self.first_request_at: float | None = None
+        self.first_response_at: float | None = None
+        self.phase_seconds: dict[str, float] = {}
+        self.import_profiler = ImportProfiler()
+
+    def start(self, profile_imports: bool = STARTUP_PROFILE_IMPORTS):
+        # Called by main before anything else is imported. Not on import of this module: the hashing and webauthn pool workers never get to ready(),
+        # so a profiler they installed would wrap every import for as long as they live
+        self.imports_started_at = time.time()
+        if profile_imports and multiprocessing.parent_process() is None:
+            self.import_profiler.install()
+
+    @contextmanager
+    def phase(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phase_seconds[name] = time.perf_counter() - started
+
+    def imports_finished(self):
+        self.imports_finished_at = time.time()
+
+    def ready(self):
+        # the lifespan startup is done and uvicorn starts accepting connections right after this
+        self.ready_at = time.time()
+        self.import_profiler.uninstall()
+
+    def request_started(self):
+        if self.first_request_at is None:
+            self.first_request_at = time.time()
+            # when the app is served without running the lifespan (the tests, the in-process benchmark) this is the next best point to stop profiling
+            self.import_profiler.uninstall()
+
+    def request_finished(self):
+        if self.first_response_at is None:
+            self.first_response_at = time.time()
+
+    def _since_start(self, timestamp: float | None) -> float | None:
+        if timestamp is None:
+            return None
+        return timestamp - (self.process_started_at or self.imports_started_at)
+
+    def stats(self) -> dict:
+        return {
+            "process_start_known": self.process_started_at is not None,
+            "seconds_before_imports": self._since_start(self.imports_started_at),
+            "import_seconds": self.imports_finished_at - self.imports_started_at if self.imports_finished_at else None,
+            **{f"{name}_seconds": seconds for name, seconds in self.phase_seconds.items()},
+            "seconds_to_ready": self._since_start(self.ready_at),
+            # the first request can sit in the kernel's accept queue while the worker is still starting, so this is what that student actually waited for
+            "seconds_to_first_request": self._since_start(self.first_request_at),
+            "seconds_to_first_response": self._since_start(self.first_response_at),
+            "first_response_seconds": self.first_response_at - self.first_request_at if self.first_response_at else None,
+        }
+
+    def summary(self) -> str:
+        lines = [f"{name}: {value:.3f}" if isinstance(value, float) else f"{name}: {value}" for name, value in self.stats().items()]
+        slowest = self.import_profiler.slowest()
+        if slowest:
+            lines.append("slowest imports: " + ", ".join(f"{package} {1000 * seconds:.0f}ms" for package, seconds in slowest.items()))
+        return "Startup report\n  " + "\n  ".join(lines)
+
+
+# only main imports this, and it starts the report before anything else so the profiler sees every other import
+startup_report = StartupReport()
@@ -0,0 +1,225 @@
+from fastapi import WebSocket, WebSocketDisconnect, status
+from collections import deque
+from dataclasses import dataclass
+from typing import Annotated
+import asyncio
+import os
+
+# The lecturer's app sends the lecture as binary websocket messages: one flags byte (bit 0 set on a keyframe, a chunk a decoder can start from) and then
+# the encoded audio or screen share. Listeners get exactly those messages back. Audio codecs can mark every chunk as a keyframe
+STREAM_RING_CHUNKS: Annotated[int, "Chunks of each lecture kept for listeners who join late or fall behind"] = int(
+    os.getenv("STREAM_RING_CHUNKS", 256))
+STREAM_SUBSCRIBER_QUEUE_CHUNKS: Annotated[int, "Chunks a listener can be behind before they skip ahead to the next keyframe"] = int(
+    os.getenv("STREAM_SUBSCRIBER_QUEUE_CHUNKS", 64))
+STREAM_MAX_CHUNK_BYTES = int(os.getenv("STREAM_MAX_CHUNK_BYTES", 256 * 1024))
+KEYFRAME_FLAG = 0x01
+
+
+@dataclass(frozen=True)
+class StreamChunk:
+    sequence: int
+    keyframe: bool
+    # a view of the message as the publisher sent it. Every listener's queue holds the same view, so fanning a chunk out to the whole hall copies nothing
+    data: memoryview
+
+
+class ChunkRing:
+    # The last `capacity` chunks in fixed slots. The chunks are bytes, which can't change under a view, so a chunk that is overwritten here
+    # while it still sits in a slow listener's queue is simply sent from the old bytes and freed once they are done with it
+    def __init__(self, capacity: int = STREAM_RING_CHUNKS):
+        self.capacity = capacity
+        self.slots: list[StreamChunk | None] = [None] * capacity
+        self.next_sequence = 0
+        self.last_keyframe: int | None = None
+
+    def append(self, message: bytes) -> StreamChunk:
+        chunk = StreamChunk(sequence=self.next_sequence, keyframe=bool(
+            message[0] & KEYFRAME_FLAG), data=memoryview(message))
+        self.slots[chunk.sequence % self.capacity] = chunk
+        self.next_sequence += 1
+        if chunk.keyframe:
+            self.last_keyframe = chunk.sequence
+        return chunk
+
+    def since_last_keyframe(self) -> list[StreamChunk]:
+        # where a new listener starts, so the first thing their decoder sees is something it can decode
+        if self.last_keyframe is None or self.last_keyframe < self.next_sequence - self.capacity:
+            return []
+        return [self.slots[sequence % self.capacity] for sequence in range(self.last_keyframe, self.next_sequence)]
+
+
+class StreamSubscriber:
+    def __init__(self, max_queued_chunks: int = STREAM_SUBSCRIBER_QUEUE_CHUNKS):
+        self.max_queued_chunks = max_queued_chunks
+        self.queue: deque[StreamChunk] = deque()
+        self.ready = asyncio.Event()
+        self.waiting_for_keyframe = False
+        self.closed = False
+        self.sent = 0
+        self.dropped = 0
+        self.skips = 0
+
+    def offer(self, chunk: StreamChunk):
+        # Never waits. A listener on a bad connection would otherwise hold up the publisher, and with it everyone else in the hall
+        if self.waiting_for_keyframe and not chunk.keyframe:
+            self.dropped += 1
+            return
+        if len(self.queue) >= self.max_queued_chunks:
+            # Too far behind. What is queued is thrown away and the listener picks up again at the next keyframe,
+            # so they lose a moment of the lecture instead of hearing it later and later
+            self.dropped += len(self.queue)
+            self.queue.clear()
+            self.skips += 1
+            if not chunk.keyframe:
+                self.waiting_for_keyframe = True
+                self.dropped += 1
+                return
+        self.waiting_for_keyframe = False
+        self.queue.append(chunk)
+        self.ready.set()
+
+    async def next_chunk(self) -> StreamChunk | None:
+        while not self.queue:
+            if self.closed:
+                return None
+            self.ready.clear()
+            await self.ready.wait()
+        return self.queue.popleft()
+
+    def close(self):
+        self.closed = True
+        self.ready.set()
+
+
+class LectureStream:
+    def __init__(self, lecture_session_id: int, ring_chunks: int = STREAM_RING_CHUNKS, subscriber_queue_chunks: int = STREAM_SUBSCRIBER_QUEUE_CHUNKS):
+        self.lecture_session_id = lecture_session_id
+        self.ring = ChunkRing(ring_chunks)
+        self.subscriber_queue_chunks = subscriber_queue_chunks
+        self.subscribers: set[StreamSubscriber] = set()
+        self.publisher_connected = False
+        # set while the publisher is connected, see app.recording
+        self.recorder = None
+        self.recording_failed = False
+        self.chunks_published = 0
+        self.bytes_published = 0
+
+    def publish(self, message: bytes):
+        chunk = self.ring.append(message)
+        self.chunks_published += 1
+        self.bytes_published += len(message)
+        if self.recorder is not None:
+            try:
+                self.recorder.append(message)
+            except OSError as err:
+                # a full disk ends the recording, not the lecture
+                print("Recording stopped:", err)
+                self.stop_recording()
+                self.recording_failed = True
+        for subscriber in self.subscribers:
+            subscriber.offer(chunk)
+
+    def stop_recording(self):
+        recorder, self.recorder = self.recorder, None
+        if recorder is not None:
+            try:
+                recorder.close()
+            except OSError as err:
+                print("Recording stopped:", err)
+
+    def subscribe(self) -> StreamSubscriber:
+        subscriber = StreamSubscriber(self.subscriber_queue_chunks)
+        for chunk in self.ring.since_last_keyframe():
+            subscriber.offer(chunk)
+        self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: StreamSubscriber):
+        subscriber.close()
+        self.subscribers.discard(subscriber)
+
+
+class StreamHub:
+    # The lectures being streamed through this worker. A lecture's publisher and listeners have to reach the same worker, so streaming needs a single
+    # worker or a proxy that routes /lecture-sessions/{id}/stream* by lecture
+    def __init__(self, ring_chunks: int = STREAM_RING_CHUNKS, subscriber_queue_chunks: int = STREAM_SUBSCRIBER_QUEUE_CHUNKS):
+        self.ring_chunks = ring_chunks
+        self.subscriber_queue_chunks = subscriber_queue_chunks
+        self.streams: dict[int, LectureStream] = {}
+        # what streams that have ended sent, so the totals don't go down when a lecture finishes
+        self.finished = {"chunks_published": 0, "bytes_published": 0,
+                         "chunks_sent": 0, "chunks_dropped": 0, "skips": 0}
+
+    def stream(self, lecture_session_id: int) -> LectureStream:
+        stream = self.streams.get(lecture_session_id)
+        if stream is None:
+            stream = self.streams[lecture_session_id] = LectureStream(
+                lecture_session_id, self.ring_chunks, self.subscriber_queue_chunks)
+        return stream
+
+    def leave(self, stream: LectureStream, subscriber: StreamSubscriber | None = None):
+        if subscriber is not None:
+            stream.unsubscribe(subscriber)
+            self.finished["chunks_sent"] += subscriber.sent
+            self.finished["chunks_dropped"] += subscriber.dropped
+            self.finished["skips"] += subscriber.skips
+        # the buffered chunks go once nobody is publishing or listening
+        if not stream.publisher_connected and not stream.subscribers and self.streams.get(stream.lecture_session_id) is stream:
+            del self.streams[stream.lecture_session_id]
+            self.finished["chunks_published"] += stream.chunks_published
+            self.finished["bytes_published"] += stream.bytes_published
+
+    def stats(self) -> dict:
+        subscribers = [subscriber for stream in self.streams.values()
+                       for subscriber in stream.subscribers]
+        return {
+            "streams": len(self.streams),
+            "publishers": sum(stream.publisher_connected for stream in self.streams.values()),
+            "recording": sum(stream.recorder is not None for stream in self.streams.values()),
+            "subscribers": len(subscribers),
+            "queued_chunks": sum(len(subscriber.queue) for subscriber in subscribers),
+            "chunks_published": self.finished["chunks_published"] + sum(stream.chunks_published for stream in self.streams.values()),
+            "bytes_published": self.finished["bytes_published"] + sum(stream.bytes_published for stream in self.streams.values()),
+            "chunks_sent": self.finished["chunks_sent"] + sum(subscriber.sent for subscriber in subscribers),
+            "chunks_dropped": self.finished["chunks_dropped"] + sum(subscriber.dropped for subscriber in subscribers),
+            "skips": self.finished["skips"] + sum(subscriber.skips for subscriber in subscribers),
+        }
+
+
+async def receive_chunks(websocket: WebSocket, stream: LectureStream):
+    # the publisher's side. Text messages are ignored, they are left for whatever control messages the lecturer's app needs later
+    while True:
+        message = await websocket.receive()
+        if message["type"] == "websocket.disconnect":
+            return
+        data = message.get("bytes")
+        if not data:
+            continue
+        if len(data) > STREAM_MAX_CHUNK_BYTES:
+            await websocket.close(code=status.WS_1009_MESSAGE_TOO_BIG)
+            return
+        stream.publish(data)
+
+
+async def send_chunks(websocket: WebSocket, subscriber: StreamSubscriber):
+    # a listener's side. Listeners don't send anything, but reading is the only way to find out they left while nothing is being published
+    async def watch_for_disconnect():
+        try:
+            while (await websocket.receive())["type"] != "websocket.disconnect":
+                pass
+        finally:
+            subscriber.close()
+
+    watcher = asyncio.create_task(watch_for_disconnect())
+    try:
+        while (chunk := await subscriber.next_chunk()) is not None:
+            await websocket.send_bytes(chunk.data)
+            subscriber.sent += 1
+    except (WebSocketDisconnect, RuntimeError, OSError):
+        # the listener went away in the middle of a send
+        pass
+    finally:
+        watcher.cancel()
+
+
+stream_hub = StreamHub()
@@ -0,0 +1,97 @@
+from dataclasses import dataclass
+from typing import Annotated, Any
+import os
+import pathlib
+
+# HS256 signs with SECRET_KEY, the same as always. ES256 signs with a private key so that other services can check access tokens against
+# /.well-known/jwks.json without calling us or knowing any secret. python-jose has no EdDSA, so ES256 is the asymmetric option.
+# For ES256, JWT_KEYS_DIR holds one PEM file per key, named <kid>.pem, and JWT_SIGNING_KEY_ID says which one signs. To rotate, add the new key,
+# point JWT_SIGNING_KEY_ID at it and delete the old file once the longest lived token it signed (the 4hr refresh token) has expired.
+# script/generate_token_key.py writes a new key
+JWT_ALGORITHM = os.getenv("JWT_ALGORITHM", "HS256")
+JWT_KEYS_DIR: Annotated[str | None, "Directory of <kid>.pem files, private keys or public keys only kept to verify"] = os.getenv(
+    "JWT_KEYS_DIR")
+JWT_SIGNING_KEY_ID = os.getenv("JWT_SIGNING_KEY_ID")
+SECRET_KEY = os.getenv("SECRET_KEY")
+
+
+@dataclass(frozen=True)
+class TokenKey:
+    kid: str | None
+    algorithm: str
+    # jose Key objects, parsed once instead of on every encode and decode. An EC private key can only sign, so verifying goes through its public half
+    signing_key: Any | None
+    verification_key: Any
+
+
+class TokenKeyRing:
+    def __init__(self, signing_key: TokenKey, keys: list[TokenKey]):
+        self.signing_key = signing_key
+        self.keys: dict[str | None, TokenKey] = {key.kid: key for key in keys}
+
+    def encode(self, claims: dict) -> str:
+        from jose import jwt
+        headers = {"kid": self.signing_key.kid} if self.signing_key.kid else None
+        return jwt.encode(claims, self.signing_key.signing_key, algorithm=self.signing_key.algorithm, headers=headers)
+
+    def decode(self, token: str) -> dict:
+        # The kid picks the key, and the token has to use that key's algorithm. Tokens without a kid are the HS256 ones signed with SECRET_KEY,
+        # which covers the admin tokens and whatever was issued before switching to ES256
+        from jose import jwt, JWTError
+        header = jwt.get_unverified_header(token)
+        kid = header.get("kid")
+        # the header isn't signed yet at this point, so a kid that is a list or an object has to fail like any other bad token
+        if kid is not None and not isinstance(kid, str):
+            raise JWTError("Unknown signing key")
+        key = self.keys.get(kid)
+        if key is None or header.get("alg") != key.algorithm:
+            raise JWTError("Unknown signing key")
+        return jwt.decode(token, key.verification_key, algorithms=[key.algorithm])
+
+    def jwks(self) -> dict:
+        # only the asymmetric keys. An HMAC secret can't be published, so with HS256 the set is empty
+        keys = []
+        for token_key in self.keys.values():
+            if token_key.kid is None or token_key.algorithm == "HS256":
+                continue
+            keys.append({**token_key.verification_key.to_dict(), "kid": token_key.kid, "use": "sig"})
+        return {"keys": keys}
+
+
+def load_token_keys(algorithm: str = JWT_ALGORITHM, keys_dir: str | None = JWT_KEYS_DIR, signing_key_id: str | None = JWT_SIGNING_KEY_ID,
+                    secret_key: str | None = SECRET_KEY) -> TokenKeyRing:
+    from jose import jwk
+    keys = []
+    if secret_key:
+        hmac_key = jwk.construct(secret_key, "HS256")
+        keys.append(TokenKey(kid=None, algorithm="HS256", signing_key=hmac_key, verification_key=hmac_key))
+    if algorithm == "HS256":
+        if not keys:
+            raise ValueError("SECRET_KEY has to be set to sign tokens with HS256")
+        return TokenKeyRing(keys[0], keys)
+    if algorithm != "ES256":
+        raise ValueError(f"JWT_ALGORITHM must be HS256 or ES256, not {algorithm}")
+    if not keys_dir or not signing_key_id:
+        raise ValueError("JWT_KEYS_DIR and JWT_SIGNING_KEY_ID have to be set to sign tokens with ES256")
+    signing_key = None
+    for path in sorted(pathlib.Path(keys_dir).glob("*.pem")):
+        key = jwk.construct(path.read_text(), "ES256")
+        # public_key() of a public key is the key itself
+        token_key = TokenKey(kid=path.stem, algorithm="ES256", signing_key=None if key.is_public() else key, verification_key=key.public_key())
+        keys.append(token_key)
+        if token_key.kid == signing_key_id:
+            signing_key = token_key
+    if signing_key is None or signing_key.signing_key is None:
+        raise ValueError(f"{keys_dir} has no private key named {signing_key_id}.pem")
+    return TokenKeyRing(signing_key, keys)
+
+
+token_keys: TokenKeyRing | None = None
+
+
+def get_token_keys() -> TokenKeyRing:
+    # loaded by the lifespan when the app starts, so a missing or broken key stops the worker there instead of failing the first login
+    global token_keys
+    if token_keys is None:
+        token_keys = load_token_keys()
+    return token_keys
@@ -1,22 +1,70 @@
 from fastapi import HTTPException, status
 from fastapi.security import OAuth2PasswordBearer, HTTPBearer
 from typing import Annotated
-from jose import JWTError, jwt
-from passlib.context import CryptContext
-from dotenv import load_dotenv
 from datetime import datetime, timedelta
 import os
-from sqlmodel import Session
+import time
+from sqlmodel.ext.asyncio.session import AsyncSession
+from .cache import TTLCache
+from .metrics import jwt_decode_seconds
+from .token_keys import get_token_keys
 
-load_dotenv(".env")
-
-SECRET_KEY = os.getenv("SECRET_KEY")
-ALGORITHM = "HS256"
+# the signing keys and algorithm are set up in token_keys
 SECRET_MESSAGE = os.getenv("SECRET_MESSAGE")
-SECRET_KEY = os.getenv("SECRET_KEY")
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Password hashing policy. The scheme listed first hashes new passwords, the others are only kept around so existing hashes still verify.
+# Changing any of these doesn't invalidate stored hashes: they get rehashed under the new policy the next time the student logs in.
+# script/calibrate_password_hashing.py measures what these should be set to on a given machine
+PASSWORD_HASH_SCHEME = os.getenv("PASSWORD_HASH_SCHEME", "bcrypt")
+BCRYPT_ROUNDS: Annotated[int, "log2 of the bcrypt work factor"] = int(
+    os.getenv("BCRYPT_ROUNDS", 12))
+ARGON2_TIME_COST: Annotated[int, "Number of argon2id passes over the memory"] = int(
+    os.getenv("ARGON2_TIME_COST", 2))
+ARGON2_MEMORY_COST: Annotated[int, "KiB of memory per argon2id hash"] = int(
+    os.getenv("ARGON2_MEMORY_COST", 19456))
+ARGON2_PARALLELISM: Annotated[int, "argon2id lanes. More than 1 only helps when the hashing pool has fewer workers than cores"] = int(
+    os.getenv("ARGON2_PARALLELISM", 1))
+
+
+def build_password_context(scheme: str = PASSWORD_HASH_SCHEME, bcrypt_rounds: int = BCRYPT_ROUNDS, argon2_time_cost: int = ARGON2_TIME_COST,
+                           argon2_memory_cost: int = ARGON2_MEMORY_COST, argon2_parallelism: int = ARGON2_PARALLELISM):
+    from passlib.context import CryptContext
+    if scheme not in ("bcrypt", "argon2"):
+        raise ValueError(
+            f"PASSWORD_HASH_SCHEME must be bcrypt or argon2, not {scheme}")
+    schemes = [scheme] + [other for other in ("bcrypt", "argon2") if other != scheme]
+    # deprecated="auto" marks every scheme but the first as needing an upgrade, and passlib also flags hashes whose cost differs from the settings below
+    return CryptContext(schemes=schemes, deprecated="auto", bcrypt__rounds=bcrypt_rounds, argon2__type="ID", argon2__time_cost=argon2_time_cost,
+                        argon2__memory_cost=argon2_memory_cost, argon2__parallelism=argon2_parallelism)
+
+
+# Built on the first hash rather than on import, it is only needed by the login and student endpoints. Tests can still swap it out with monkeypatch
+pwd_context = None
+
+
+def get_password_context():
+    global pwd_context
+    if pwd_context is None:
+        pwd_context = build_password_context()
+    return pwd_context
+
+
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="verify-student")
 token_auth_scheme = HTTPBearer()
+# When this is true, a token whose signature and expiry check out is trusted as is and we don't go to the database to confirm the student still exists.
+# Set it to false to fall back to the existence check (which is then cached for STUDENT_EXISTENCE_TTL_SECONDS)
+TRUST_TOKEN_CLAIMS = os.getenv("TRUST_TOKEN_CLAIMS", "true").lower() == "true"
+STUDENT_EXISTENCE_TTL_SECONDS = float(
+    os.getenv("STUDENT_EXISTENCE_TTL_SECONDS", 300))
+# Revocations are stored in the database and every worker reads a student's from there, then keeps it this long.
+# A revocation made on another worker reaches this one at most this many seconds later, the worker that made it knows straight away
+TOKEN_REVOCATION_CACHE_SECONDS = float(
+    os.getenv("TOKEN_REVOCATION_CACHE_SECONDS", 30))
+TOKEN_CACHE_MAX_ENTRIES = int(os.getenv("TOKEN_CACHE_MAX_ENTRIES", 50_000))
+
+known_students: Annotated[TTLCache, "matric numbers we have recently confirmed exist in the database"] = TTLCache(
+    maxsize=TOKEN_CACHE_MAX_ENTRIES, ttl=STUDENT_EXISTENCE_TTL_SECONDS)
+revoked_students: Annotated[TTLCache, "matric number -> unix time at which every token issued to that student stopped being valid, 0 if they never were"] = TTLCache(
+    maxsize=TOKEN_CACHE_MAX_ENTRIES, ttl=TOKEN_REVOCATION_CACHE_SECONDS)
 
 incorrect_matric_number_or_password_exception = HTTPException(
     status_code=status.HTTP_401_UNAUTHORIZED,
@@ -30,11 +78,16 @@ credentials_exception = HTTPException(
 
 
 def get_password_hash(password: str) -> str:
-    return pwd_context.hash(password)
+    return get_password_context().hash(password)
 
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+    return get_password_context().verify(plain_password, hashed_password)
+
+
+def verify_and_update_password(plain_password: str, hashed_password: str) -> tuple[bool, str | None]:
+    # the second value is a new hash to store when the password is right but was hashed under an older policy
+    return get_password_context().verify_and_update(plain_password, hashed_password)
 
 
 def create_access_refresh_token(data: dict, expires_delta: timedelta | None = None):
@@ -43,23 +96,27 @@ def create_access_refresh_token(data: dict, expires_delta: timedelta | None = No
         expire = datetime.utcnow() + expires_delta
     else:
         expire = datetime.utcnow() + timedelta(minutes=15)
-    to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    # iat keeps the sub-second part (jose would round a datetime down to the second) so that a token issued right after a revocation isn't caught by it
+    to_encode.update({"exp": expire, "iat": time.time()})
+    encoded_jwt = get_token_keys().encode(to_encode)
     return encoded_jwt
 
 
-async def decode_and_validate_token(token: str, session: Session | None = None, token_expected: str = "access") -> Annotated[str | bool, "The matric number of the user or True"]:
+async def decode_and_validate_token(token: str, session: AsyncSession | None = None, token_expected: str = "access") -> Annotated[str | bool, "The matric number of the user or True"]:
     from . import crud
+    # jose is imported here instead of at the top so that it isn't loaded while the worker is starting up
+    from jose import JWTError
     try:
         if not session:
             assert token_expected == "create_student_token"
-            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+            with jwt_decode_seconds.time():
+                payload = get_token_keys().decode(token)
             message: str = payload.get("sub")
             if message is None or message != SECRET_MESSAGE:
                 raise credentials_exception
             return True
-        payload: dict[str, str] = jwt.decode(
-            token, SECRET_KEY, algorithms=[ALGORITHM])
+        with jwt_decode_seconds.time():
+            payload: dict[str, str] = get_token_keys().decode(token)
         access_or_refresh_token: Annotated[str, "access if it is an access token else refresh"] = payload.get(
             "sub").split("|")[0]
         matric_number: str = payload.get("sub").split("|")[1]
@@ -67,7 +124,35 @@ async def decode_and_validate_token(token: str, session: Session | None = None,
             raise credentials_exception
     except (JWTError, IndexError):
         raise credentials_exception
-    db_student = crud.get_student(session, matric_number)
+    matric_number = matric_number.upper()
+    revoked_at = await get_tokens_revoked_at(session, matric_number)
+    # tokens issued before we had iat in them count as issued at 0, so a revocation catches them too
+    if revoked_at and payload.get("iat", 0) <= revoked_at:
+        raise credentials_exception
+    if TRUST_TOKEN_CLAIMS or matric_number in known_students:
+        return matric_number
+    db_student = await crud.async_get_student_snapshot(session, matric_number)
     if not db_student:
         raise incorrect_matric_number_or_password_exception
+    known_students.set(db_student.matric_number, True)
     return db_student.matric_number
+
+
+async def get_tokens_revoked_at(session: AsyncSession, matric_number: str) -> float:
+    revoked_at = revoked_students.get(matric_number)
+    if revoked_at is None:
+        from . import crud
+        revoked_at = await crud.async_get_token_revocation(session, matric_number) or 0.0
+        revoked_students.set(matric_number, revoked_at)
+    return revoked_at
+
+
+async def invalidate_student_tokens(session: AsyncSession, matric_number: str):
+    # Every token issued to this student up to now stops being accepted, by this worker at once and by the others within TOKEN_REVOCATION_CACHE_SECONDS.
+    # Call it when a student is deleted or their device changes
+    from . import crud
+    matric_number = matric_number.upper()
+    revoked_at = time.time()
+    await crud.async_revoke_student_tokens(session, matric_number, revoked_at)
+    known_students.invalidate(matric_number)
+    revoked_students.set(matric_number, revoked_at)
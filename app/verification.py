@@ -0,0 +1,174 @@
+from fastapi import HTTPException, status
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Annotated, Any
+from .batching import MicroBatcher
+from .metrics import webauthn_verify_seconds
+import asyncio
+import multiprocessing
+import os
+import time
+
+# Checking a WebAuthn response means parsing CBOR and verifying an ECDSA or RSA signature, and py_webauthn does it all in python while holding the GIL.
+# Done in the handler it blocks the event loop, so at the start of a lecture the whole hall's check-ins queue up behind each other on one core.
+# The verifications go to a process pool instead, a few milliseconds' worth at a time so a burst costs one round trip to a worker per batch and not per check-in
+WEBAUTHN_POOL_KIND = os.getenv("WEBAUTHN_POOL_KIND", "process")
+WEBAUTHN_POOL_WORKERS: Annotated[int, "Number of verification workers. Defaults to the number of cores"] = int(
+    os.getenv("WEBAUTHN_POOL_WORKERS", os.cpu_count() or 1))
+WEBAUTHN_BATCH_SIZE: Annotated[int, "Send a batch to the pool once this many verifications are waiting"] = int(
+    os.getenv("WEBAUTHN_BATCH_SIZE", 32))
+WEBAUTHN_BATCH_DELAY_MS: Annotated[float, "Send a batch at most this long after the first verification in it arrived"] = float(
+    os.getenv("WEBAUTHN_BATCH_DELAY_MS", 2))
+
+webauthn_verification_failed_exception = HTTPException(
+    status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+# The jobs and their results cross a process boundary, so they are plain dataclasses of bytes and strings. The credential is the JSON the browser sent
+@dataclass(frozen=True)
+class AuthenticationJob:
+    credential: dict
+    challenge: bytes
+    public_key: bytes
+    sign_count: int
+    rp_id: str
+    origin: str
+    ceremony = "authentication"
+
+    def verify(self) -> int:
+        from webauthn import verify_authentication_response
+        verification = verify_authentication_response(
+            credential=self.credential,
+            expected_challenge=self.challenge,
+            expected_rp_id=self.rp_id,
+            expected_origin=self.origin,
+            credential_public_key=self.public_key,
+            credential_current_sign_count=self.sign_count,
+            require_user_verification=True,
+        )
+        return verification.new_sign_count
+
+
+@dataclass(frozen=True)
+class VerifiedAttestation:
+    credential_id: bytes
+    credential_public_key: bytes
+    sign_count: int
+    transports: str
+
+
+@dataclass(frozen=True)
+class RegistrationJob:
+    credential: dict
+    challenge: bytes
+    rp_id: str
+    origin: str
+    ceremony = "registration"
+
+    def verify(self) -> VerifiedAttestation:
+        from webauthn import verify_registration_response
+        verification = verify_registration_response(
+            credential=self.credential,
+            expected_challenge=self.challenge,
+            expected_rp_id=self.rp_id,
+            expected_origin=self.origin,
+        )
+        # I am meant to store the credential and the user attached to this credential
+        transports: list = self.credential["response"]["transports"]
+        return VerifiedAttestation(credential_id=verification.credential_id, credential_public_key=verification.credential_public_key,
+                                   sign_count=verification.sign_count, transports=",".join(transports))
+
+
+def load_webauthn():
+    # run once in every worker as it starts, so the first batch a worker gets doesn't pay for importing webauthn
+    import webauthn  # noqa: F401
+
+
+def run_verifications(jobs: list) -> list[tuple[Any, str | None, float]]:
+    # Runs in a worker. A response that fails to verify only fails its own check-in, so errors come back as strings next to the results
+    # instead of being raised for the whole batch. The seconds are measured here because the histogram lives in the parent
+    results = []
+    for job in jobs:
+        started = time.perf_counter()
+        try:
+            results.append((job.verify(), None, time.perf_counter() - started))
+        except Exception as err:
+            results.append((None, f"{type(err).__name__}: {err}", time.perf_counter() - started))
+    return results
+
+
+class WebAuthnVerifier(MicroBatcher):
+    def __init__(self, kind: str = WEBAUTHN_POOL_KIND, workers: int = WEBAUTHN_POOL_WORKERS, max_batch_size: int = WEBAUTHN_BATCH_SIZE,
+                 max_delay_ms: float = WEBAUTHN_BATCH_DELAY_MS):
+        super().__init__(max_batch_size=max_batch_size,
+                         max_delay_seconds=max_delay_ms / 1000)
+        self.kind = kind
+        self.workers = workers
+        self._executor: Executor | None = None
+        self.verified = 0
+        self.failed = 0
+        self.total_seconds = 0.0
+
+    @property
+    def executor(self) -> Executor:
+        # created on first use so importing this module doesn't spawn processes. forkserver because forking the app itself would copy
+        # the hashing pool's and aiosqlite's threads into the child in whatever state they were in
+        if self._executor is None:
+            if self.kind == "process":
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("forkserver"),
+                                                     initializer=load_webauthn)
+            else:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix="webauthn-verifier", initializer=load_webauthn)
+        return self._executor
+
+    async def process_batch(self, jobs: list) -> list[tuple[Any, str | None, float]]:
+        # split across the workers so a batch that arrived together is verified on every core at once
+        loop = asyncio.get_running_loop()
+        chunk_size = -(-len(jobs) // min(self.workers, len(jobs)))
+        chunks = await asyncio.gather(*(loop.run_in_executor(self.executor, run_verifications, jobs[start:start + chunk_size])
+                                        for start in range(0, len(jobs), chunk_size)))
+        results = [result for chunk in chunks for result in chunk]
+        for job, (_, error, seconds) in zip(jobs, results):
+            webauthn_verify_seconds.observe(seconds, job.ceremony)
+            self.total_seconds += seconds
+            if error is None:
+                self.verified += 1
+            else:
+                self.failed += 1
+        return results
+
+    async def _verify(self, job):
+        result, error, _ = await self.submit(job)
+        if error is not None:
+            print("Error:", error)
+            raise webauthn_verification_failed_exception
+        return result
+
+    async def verify_authentication(self, credential: dict, authentication_challenge: bytes, public_key: bytes, sign_count: int, RP_ID: str,
+                                    WEBAUTHN_ORIGIN: str) -> int:
+        # returns the authenticator's new sign count
+        return await self._verify(AuthenticationJob(credential=credential, challenge=authentication_challenge, public_key=public_key,
+                                                    sign_count=sign_count, rp_id=RP_ID, origin=WEBAUTHN_ORIGIN))
+
+    async def verify_registration(self, credential: dict, registration_challenge: bytes, RP_ID: str, WEBAUTHN_ORIGIN: str) -> VerifiedAttestation:
+        return await self._verify(RegistrationJob(credential=credential, challenge=registration_challenge, rp_id=RP_ID, origin=WEBAUTHN_ORIGIN))
+
+    async def start(self):
+        # starts every worker now rather than on the first check-in. The pool only starts another process when no worker is idle, so they are asked all at once
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(loop.run_in_executor(self.executor, time.sleep, 0.05) for _ in range(self.workers)))
+
+    def stats(self) -> dict:
+        # the seconds are the verification itself, without the wait for a batch or a free worker
+        verifications = self.verified + self.failed
+        return {"kind": self.kind, "workers": self.workers, **super().stats(), "verified": self.verified, "failed": self.failed,
+                "average_seconds": self.total_seconds / verifications if verifications else 0.0}
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+webauthn_verifier = WebAuthnVerifier()
@@ -1,23 +1,43 @@
-from webauthn.helpers.cose import COSEAlgorithmIdentifier
-from webauthn.helpers.structs import (
-    AuthenticatorSelectionCriteria,
-    UserVerificationRequirement,
-    AttestationConveyancePreference,
-    AuthenticatorAttachment,
-    AuthenticatorSelectionCriteria,
-    ResidentKeyRequirement
-)
-from webauthn import (
-    generate_registration_options,
-    verify_registration_response,
-    generate_authentication_options,
-    verify_authentication_response
-)
 from fastapi import HTTPException, status
+from .cache import TTLCache
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from dataclasses import dataclass
+from typing import Annotated
 from uuid import UUID
+import os
 
+# Built once per registered device. They only change when the student registers again, the TTL just stops a template for a device registered through another worker living forever
+AUTHENTICATION_OPTIONS_CACHE_TTL_SECONDS = float(
+    os.getenv("AUTHENTICATION_OPTIONS_CACHE_TTL_SECONDS", 6 * 60 * 60))
+AUTHENTICATION_OPTIONS_CACHE_MAX_ENTRIES = int(
+    os.getenv("AUTHENTICATION_OPTIONS_CACHE_MAX_ENTRIES", 50_000))
+# 32 bytes that can't show up anywhere else in the options, base64url encoded to the same length as a real challenge
+CHALLENGE_PLACEHOLDER = b"\xff" * 32
 
-def generate_registration_options_function(RP_ID: str, user_id: UUID, matric_number: str, registration_challenge: bytes):
+
+# (credential_id, comma separated transports) for each of a student's devices
+CredentialDescriptors = tuple[tuple[bytes, str | None], ...]
+
+
+# The webauthn package takes a while to import (pydantic models, cbor2, cryptography and every attestation format), so it is imported inside the
+# functions that verify or build options and isn't loaded until the first ceremony. These two are the same as the ones in webauthn.helpers
+def bytes_to_base64url(value: bytes) -> str:
+    return urlsafe_b64encode(value).decode("utf-8").replace("=", "")
+
+
+def base64url_to_bytes(value: str) -> bytes:
+    return urlsafe_b64decode(f"{value}===")
+
+
+def credential_descriptor_dicts(credentials: CredentialDescriptors) -> list[dict]:
+    return [{"type": "public-key", "id": credential_id, "transports": transports.split(",") if transports else None}
+            for credential_id, transports in credentials]
+
+
+def generate_registration_options_function(RP_ID: str, user_id: UUID, matric_number: str, registration_challenge: bytes, existing_credentials: CredentialDescriptors = ()):
+    from webauthn import generate_registration_options
+    from webauthn.helpers.cose import COSEAlgorithmIdentifier
+    from webauthn.helpers.structs import AttestationConveyancePreference, AuthenticatorAttachment, AuthenticatorSelectionCriteria, ResidentKeyRequirement
     try:
         options = generate_registration_options(
             rp_id=RP_ID,
@@ -31,7 +51,8 @@ def generate_registration_options_function(RP_ID: str, user_id: UUID, matric_num
                 resident_key=ResidentKeyRequirement.REQUIRED,
             ),
             challenge=registration_challenge,
-            exclude_credentials=[],
+            # stops the browser from registering a device the student has already registered
+            exclude_credentials=credential_descriptor_dicts(existing_credentials),
             supported_pub_key_algs=[
                 COSEAlgorithmIdentifier.ECDSA_SHA_256,
                 COSEAlgorithmIdentifier.RSASSA_PKCS1_v1_5_SHA_256,
@@ -44,34 +65,14 @@ def generate_registration_options_function(RP_ID: str, user_id: UUID, matric_num
     return options
 
 
-def verify_registration_options_function(credential: dict, registration_challenge: bytes, RP_ID: str, WEBAUTHN_ORIGIN: str):
+def generate_authentication_options_functions(RP_ID: str, credentials: CredentialDescriptors, authentication_challenge: bytes):
+    # no credentials means a discoverable credential login, where the authenticator offers whichever of its passkeys belong to this RP
+    from webauthn import generate_authentication_options
+    from webauthn.helpers.structs import UserVerificationRequirement
     try:
-        verification = verify_registration_response(
-            credential=credential,
-            expected_challenge=registration_challenge,
-            expected_rp_id=RP_ID,
-            expected_origin=WEBAUTHN_ORIGIN,
-        )
-        # I am meant to store the credential and the user attached to this credential
-        transports: list = credential["response"]["transports"]
-        transports_string: str = ""
-        transports_string = ",".join(transports)
-    except Exception as err:
-        print(err)
-        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
-    return verification, transports_string
-
-
-def generate_authentication_options_functions(RP_ID: str, credential_id: bytes, transports: str, authentication_challenge: bytes):
-    try:
-        if transports:
-            transports = transports.split(",")
-
         options = generate_authentication_options(
             rp_id=RP_ID,
-            allow_credentials=[
-                {"type": "public-key", "id": credential_id, "transports": transports}
-            ],
+            allow_credentials=credential_descriptor_dicts(credentials),
             user_verification=UserVerificationRequirement.REQUIRED,
             challenge=authentication_challenge
         )
@@ -81,27 +82,58 @@ def generate_authentication_options_functions(RP_ID: str, credential_id: bytes,
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
-def verify_authentication_options_function(credential_id: bytes, raw_id_bytes: bytes, credential, authentication_challenge: bytes, public_key: bytes, sign_count, RP_ID: str, WEBAUTHN_ORIGIN: str):
-    try:
-        user_credential = None
-        if credential_id == raw_id_bytes:
-            user_credential = True  # we could set it to anything as long as it is not None
-
-        if user_credential is None:
-            raise Exception(
-                "Could not find corresponding public key in DB")
-
-        # Verify the assertion
-        verification = verify_authentication_response(
-            credential=credential,
-            expected_challenge=authentication_challenge,
-            expected_rp_id=RP_ID,
-            expected_origin=WEBAUTHN_ORIGIN,
-            credential_public_key=public_key,
-            credential_current_sign_count=sign_count,
-            require_user_verification=True,
-        )
-    except Exception as err:
-        print("Error:", err)
-        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
-    return verification
+@dataclass(frozen=True)
+class AuthenticationOptionsTemplate:
+    # The serialized options split around the challenge. credentials is what it was built from, so a stale template can be spotted
+    credentials: CredentialDescriptors
+    before_challenge: bytes
+    after_challenge: bytes
+
+    def render(self, authentication_challenge: bytes) -> bytes:
+        # bytes, because the endpoints send this as the response body as is
+        return self.before_challenge + urlsafe_b64encode(authentication_challenge).rstrip(b"=") + self.after_challenge
+
+
+authentication_options_cache: Annotated[TTLCache, "upper cased matric number -> AuthenticationOptionsTemplate"] = TTLCache(
+    maxsize=AUTHENTICATION_OPTIONS_CACHE_MAX_ENTRIES, ttl=AUTHENTICATION_OPTIONS_CACHE_TTL_SECONDS)
+
+
+def build_authentication_options_template(RP_ID: str, credentials: CredentialDescriptors) -> AuthenticationOptionsTemplate:
+    from webauthn import options_to_json
+    options_json = options_to_json(generate_authentication_options_functions(
+        RP_ID=RP_ID, credentials=credentials, authentication_challenge=CHALLENGE_PLACEHOLDER)).encode()
+    before_challenge, placeholder, after_challenge = options_json.partition(
+        bytes_to_base64url(CHALLENGE_PLACEHOLDER).encode())
+    assert placeholder, "the challenge placeholder is missing from the serialized options"
+    return AuthenticationOptionsTemplate(credentials=credentials, before_challenge=before_challenge, after_challenge=after_challenge)
+
+
+def get_authentication_options_template(RP_ID: str, matric_number: str, credentials: CredentialDescriptors) -> AuthenticationOptionsTemplate:
+    # The template is rebuilt if the devices it was made for aren't the ones the student has now, so a missed invalidation can't hand out an old credential
+    matric_number = matric_number.upper()
+    template: AuthenticationOptionsTemplate | None = authentication_options_cache.get(matric_number)
+    if template is None or template.credentials != credentials:
+        template = build_authentication_options_template(RP_ID, credentials)
+        authentication_options_cache.set(matric_number, template)
+    return template
+
+
+def generate_authentication_options_json(RP_ID: str, matric_number: str, credentials: CredentialDescriptors, authentication_challenge: bytes) -> bytes:
+    # Same JSON as options_to_json(generate_authentication_options_functions(...)) but only the challenge is encoded per request
+    return get_authentication_options_template(RP_ID, matric_number, credentials).render(authentication_challenge)
+
+
+# the discoverable options are the same for everyone, so there is one template per RP_ID
+discoverable_options_templates: dict[str, AuthenticationOptionsTemplate] = {}
+
+
+def generate_discoverable_authentication_options_json(RP_ID: str, authentication_challenge: bytes) -> bytes:
+    template = discoverable_options_templates.get(RP_ID)
+    if template is None:
+        template = discoverable_options_templates[RP_ID] = build_authentication_options_template(
+            RP_ID, ())
+    return template.render(authentication_challenge)
+
+
+def invalidate_authentication_options(matric_number: str):
+    authentication_options_cache.invalidate(matric_number.upper())
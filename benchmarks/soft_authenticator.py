@@ -0,0 +1,94 @@
+# A software platform authenticator. It produces real WebAuthn registration and assertion responses (ES256, "none" attestation)
+# that pass py_webauthn's verification, so the ceremonies can be driven without a browser or a phone
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec
+from webauthn.helpers import bytes_to_base64url, base64url_to_bytes
+import cbor2
+import hashlib
+import json
+import os
+import struct
+
+FLAG_USER_PRESENT = 0x01
+FLAG_USER_VERIFIED = 0x04
+FLAG_ATTESTED_CREDENTIAL_DATA = 0x40
+
+
+def parse_options(options) -> dict:
+    # the options endpoints have returned both a JSON string and a JSON object at different times, this takes either
+    if isinstance(options, (bytes, str)):
+        options = json.loads(options)
+    return options
+
+
+class SoftAuthenticator:
+    def __init__(self, rp_id: str, origin: str, credential_id: bytes | None = None, private_key: ec.EllipticCurvePrivateKey | None = None, sign_count: int = 0):
+        self.rp_id = rp_id
+        self.origin = origin
+        self.credential_id = credential_id or os.urandom(32)
+        self.private_key = private_key or ec.generate_private_key(
+            ec.SECP256R1())
+        self.sign_count = sign_count
+        self.rp_id_hash = hashlib.sha256(rp_id.encode()).digest()
+
+    def cose_public_key(self) -> bytes:
+        numbers = self.private_key.public_key().public_numbers()
+        return cbor2.dumps({1: 2, 3: -7, -1: 1, -2: numbers.x.to_bytes(32, "big"), -3: numbers.y.to_bytes(32, "big")})
+
+    def client_data(self, ceremony: str, challenge: str) -> bytes:
+        return json.dumps({"type": ceremony, "challenge": challenge, "origin": self.origin, "crossOrigin": False}).encode()
+
+    def register(self, options) -> dict:
+        options = parse_options(options)
+        client_data_json = self.client_data(
+            "webauthn.create", options["challenge"])
+        attested_credential_data = bytes(16) + struct.pack(">H", len(
+            self.credential_id)) + self.credential_id + self.cose_public_key()
+        auth_data = self.rp_id_hash + bytes([FLAG_USER_PRESENT | FLAG_USER_VERIFIED | FLAG_ATTESTED_CREDENTIAL_DATA]) + struct.pack(
+            ">I", self.sign_count) + attested_credential_data
+        attestation_object = cbor2.dumps(
+            {"fmt": "none", "attStmt": {}, "authData": auth_data})
+        credential_id = bytes_to_base64url(self.credential_id)
+        return {
+            "id": credential_id,
+            "rawId": credential_id,
+            "response": {
+                "attestationObject": bytes_to_base64url(attestation_object),
+                "clientDataJSON": bytes_to_base64url(client_data_json),
+                "transports": ["internal"],
+            },
+            "type": "public-key",
+            "clientExtensionResults": {},
+            "authenticatorAttachment": "platform",
+        }
+
+    def authenticate(self, options, user_handle: bytes | None = None) -> dict:
+        options = parse_options(options)
+        self.sign_count += 1
+        client_data_json = self.client_data("webauthn.get", options["challenge"])
+        auth_data = self.rp_id_hash + \
+            bytes([FLAG_USER_PRESENT | FLAG_USER_VERIFIED]) + \
+            struct.pack(">I", self.sign_count)
+        signature = self.private_key.sign(
+            auth_data + hashlib.sha256(client_data_json).digest(), ec.ECDSA(hashes.SHA256()))
+        credential_id = bytes_to_base64url(self.credential_id)
+        response = {
+            "authenticatorData": bytes_to_base64url(auth_data),
+            "clientDataJSON": bytes_to_base64url(client_data_json),
+            "signature": bytes_to_base64url(signature),
+        }
+        if user_handle is not None:
+            response["userHandle"] = bytes_to_base64url(user_handle)
+        return {
+            "id": credential_id,
+            "rawId": credential_id,
+            "response": response,
+            "type": "public-key",
+            "clientExtensionResults": {},
+            "authenticatorAttachment": "platform",
+        }
+
+    def allowed_by(self, options) -> bool:
+        # whether the options list this authenticator's credential (or allow any discoverable credential)
+        allow_credentials = parse_options(options).get("allowCredentials") or []
+        return not allow_credentials or any(base64url_to_bytes(credential["id"]) == self.credential_id for credential in allow_credentials)
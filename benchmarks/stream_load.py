@@ -0,0 +1,175 @@
+# Load generator for the lecture stream fan-out, e.g.
+#   python benchmarks/stream_load.py --listeners 500 --seconds 20
+#   python benchmarks/stream_load.py --listeners 500 --slow-listeners 25 --base-url http://localhost:8000
+# One publisher streams fake media chunks (a keyframe every --keyframe-interval chunks) into a new lecture and every listener records how long each chunk took
+# to reach it. The slow listeners stop reading for a while after every chunk, like a phone on a bad connection, so the run shows what backpressure costs them
+# and that it costs everyone else nothing.
+# Without --base-url the app is served by uvicorn inside this process, on the same event loop as the listeners, which understates what a dedicated worker can do.
+# With --base-url the server has to use the same database as --db-url and the same SECRET_KEY, because the listeners are seeded and their tokens minted here
+import sys
+import pathlib
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent))
+from benchmarks.load_test import DEFAULT_DB_URLS, percentile, seed_students, remove_students
+from datetime import timedelta
+import argparse
+import asyncio
+import os
+import struct
+import time
+import httpx
+
+# flags byte, then the chunk's sequence number and the time it was sent, then padding up to --chunk-bytes
+CHUNK_HEADER = struct.Struct(">BQd")
+
+
+class Listener:
+    def __init__(self, slow_seconds: float = 0.0):
+        self.slow_seconds = slow_seconds
+        self.connect_seconds: float | None = None
+        self.latencies: list[float] = []
+        self.sequences: list[int] = []
+        self.error: str | None = None
+
+    async def listen(self, url: str, done: asyncio.Event):
+        from websockets.asyncio.client import connect
+        started = time.perf_counter()
+        try:
+            async with connect(url, max_size=None, compression=None) as websocket:
+                self.connect_seconds = time.perf_counter() - started
+                while not done.is_set():
+                    try:
+                        message = await asyncio.wait_for(websocket.recv(), timeout=0.5)
+                    except asyncio.TimeoutError:
+                        continue
+                    _, sequence, sent_at = CHUNK_HEADER.unpack_from(message)
+                    self.latencies.append(time.time() - sent_at)
+                    self.sequences.append(sequence)
+                    if self.slow_seconds:
+                        await asyncio.sleep(self.slow_seconds)
+        except Exception as err:
+            self.error = f"{type(err).__name__}: {err}"
+
+
+async def publish(url: str, chunks: int, chunks_per_second: float, chunk_bytes: int, keyframe_interval: int):
+    from websockets.asyncio.client import connect
+    padding = bytes(max(0, chunk_bytes - CHUNK_HEADER.size))
+    async with connect(url, compression=None) as websocket:
+        started = time.perf_counter()
+        for sequence in range(chunks):
+            # sent on a fixed schedule, so a stall anywhere shows up as latency rather than as a slower stream
+            await asyncio.sleep(max(0.0, started + sequence / chunks_per_second - time.perf_counter()))
+            flags = 1 if sequence % keyframe_interval == 0 else 0
+            await websocket.send(CHUNK_HEADER.pack(flags, sequence, time.time()) + padding)
+
+
+def summarise(listeners: list[Listener], chunks: int) -> dict:
+    latencies = sorted(latency for listener in listeners for latency in listener.latencies)
+    connect_seconds = sorted(listener.connect_seconds for listener in listeners if listener.connect_seconds is not None)
+    received = sum(len(listener.sequences) for listener in listeners)
+    return {
+        "listeners": len(listeners),
+        "connected": len(connect_seconds),
+        "errors": sum(listener.error is not None for listener in listeners),
+        "connect_p95_ms": round(1000 * percentile(connect_seconds, 0.95), 2),
+        "delivered_percent": round(100 * received / (chunks * len(listeners)), 2) if listeners and chunks else 0.0,
+        "p50_ms": round(1000 * percentile(latencies, 0.50), 2),
+        "p95_ms": round(1000 * percentile(latencies, 0.95), 2),
+        "p99_ms": round(1000 * percentile(latencies, 0.99), 2),
+        "max_ms": round(1000 * latencies[-1], 2) if latencies else 0.0,
+    }
+
+
+async def start_server(port: int):
+    import uvicorn
+    from main import app
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning", ws="websockets"))
+    task = asyncio.create_task(server.serve())
+    while not server.started:
+        if task.done():
+            task.result()
+        await asyncio.sleep(0.05)
+    port = server.servers[0].sockets[0].getsockname()[1]
+    return server, task, f"http://127.0.0.1:{port}"
+
+
+async def main(args: argparse.Namespace) -> int:
+    # app.database reads DB_URL when it is imported, so this has to happen before anything from app is imported
+    os.environ["DB_URL"] = args.db_url
+    os.environ["RATE_LIMIT_ENABLED"] = "false"
+    from app.database import create_db_and_tables
+    from app.utils import create_access_refresh_token, SECRET_MESSAGE
+    create_db_and_tables()
+    server = server_task = None
+    if args.base_url:
+        base_url = args.base_url.rstrip("/")
+    else:
+        server, server_task, base_url = await start_server(args.port)
+    ws_url = "ws" + base_url.removeprefix("http")
+
+    seeded = await seed_students(args.listeners, os.getenv("RP_ID", "localhost"), os.getenv("WEBAUTHN_ORIGIN", "http://localhost:3000"))
+    admin_token = create_access_refresh_token(data={"sub": SECRET_MESSAGE}, expires_delta=timedelta(hours=1))
+    chunks = int(args.seconds * args.chunks_per_second)
+    try:
+        async with httpx.AsyncClient(base_url=base_url, timeout=30) as http:
+            response = await http.post("/lecture-sessions", headers={"Authorization": f"Bearer {admin_token}"},
+                                       json={"course_code": "BENCH101", "title": "Stream load test", "roster": []})
+            response.raise_for_status()
+            lecture_session_id = response.json()["id"]
+            stream_url = f"{ws_url}/lecture-sessions/{lecture_session_id}/stream"
+
+            listeners = [Listener(args.slow_listener_seconds if index < args.slow_listeners else 0.0) for index in range(args.listeners)]
+            done = asyncio.Event()
+            listening = [asyncio.create_task(listener.listen(
+                f"{stream_url}?token={create_access_refresh_token(data={'sub': 'access|' + matric_number}, expires_delta=timedelta(hours=1))}", done))
+                for listener, (matric_number, _) in zip(listeners, seeded)]
+            # everyone is connected before the first chunk, so every listener should see all of them
+            while sum(listener.connect_seconds is not None or listener.error is not None for listener in listeners) < len(listeners):
+                await asyncio.sleep(0.05)
+            await publish(f"{stream_url}/publish?token={admin_token}", chunks, args.chunks_per_second, args.chunk_bytes, args.keyframe_interval)
+            # a moment for the last chunks to arrive
+            await asyncio.sleep(args.drain_seconds)
+            done.set()
+            await asyncio.gather(*listening)
+            server_stats = (await http.get("/metrics/streaming")).json()
+    finally:
+        await remove_students([matric_number for matric_number, _ in seeded])
+        if server is not None:
+            server.should_exit = True
+            await server_task
+
+    print(f"listeners={args.listeners} slow={args.slow_listeners} chunks={chunks} at {args.chunks_per_second}/s of {args.chunk_bytes} bytes "
+          f"target={args.base_url or 'in-process'}")
+    groups = {"listeners": listeners[args.slow_listeners:], "slow listeners": listeners[:args.slow_listeners]}
+    print(f"{'group':16} {'connected':>9} {'errors':>6} {'connect p95':>11} {'delivered %':>11} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for name, group in groups.items():
+        if not group:
+            continue
+        result = summarise(group, chunks)
+        print(f"{name:16} {result['connected']:>9} {result['errors']:>6} {result['connect_p95_ms']:>11.2f} {result['delivered_percent']:>11.2f} "
+              f"{result['p50_ms']:>9.2f} {result['p95_ms']:>9.2f} {result['p99_ms']:>9.2f} {result['max_ms']:>9.2f}")
+    errors = [listener.error for listener in listeners if listener.error]
+    if errors:
+        print(f"first error: {errors[0]}")
+    print(f"server: {server_stats}")
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stream a fake lecture to hundreds of websocket listeners")
+    parser.add_argument("--listeners", type=int, default=500)
+    parser.add_argument("--slow-listeners", type=int, default=0,
+                        help="How many of the listeners read slowly")
+    parser.add_argument("--slow-listener-seconds", type=float, default=0.25,
+                        help="How long a slow listener stops reading after every chunk")
+    parser.add_argument("--seconds", type=float, default=10.0, help="How long the lecture is streamed for")
+    parser.add_argument("--chunks-per-second", type=float, default=25.0)
+    parser.add_argument("--chunk-bytes", type=int, default=4096)
+    parser.add_argument("--keyframe-interval", type=int, default=50, help="Every this many chunks is a keyframe")
+    parser.add_argument("--drain-seconds", type=float, default=2.0)
+    parser.add_argument("--backend", choices=DEFAULT_DB_URLS, default="sqlite")
+    parser.add_argument("--db-url", help="Defaults to a throwaway database for the chosen backend")
+    parser.add_argument("--base-url", help="Load a running server instead of serving the app in this process")
+    parser.add_argument("--port", type=int, default=0, help="Port for the in-process server, any free one by default")
+    args = parser.parse_args()
+    args.db_url = args.db_url or DEFAULT_DB_URLS[args.backend]
+    sys.exit(asyncio.run(main(args)))
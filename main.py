@@ -1,34 +1,83 @@
-from fastapi import FastAPI, HTTPException, Request, status, Depends
+# imported and started first so that the startup report's import timings include everything below
+from app.startup import startup_report
+startup_report.start()
+from fastapi import FastAPI, HTTPException, Request, status, Depends, WebSocket, WebSocketException
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
 # The name of the module crud is app.crud. So, when we do fron .utils import models, we are telling it to go up one directory from app.crud to app and then access the module models there
 import app.crud as crud
-from app.database import engine
-from app.models import StudentPydanticModel, RefreshToken, TokenResponse, StudentUpdateModel
-from app.utils import create_access_refresh_token, decode_and_validate_token, verify_password, oauth2_scheme, credentials_exception, incorrect_matric_number_or_password_exception
-from app.webauthn_functions import generate_registration_options_function, verify_registration_options_function, generate_authentication_options_functions, verify_authentication_options_function
+from app.database import get_engine, get_async_engine, dispose_engines, get_async_session, get_pool_stats
+from app.models import StudentPydanticModel, RefreshToken, TokenResponse, StudentUpdateModel, LectureSessionCreateModel, CredentialSnapshot
+from app.hashing import password_hasher
+from app.verification import webauthn_verifier
+from app.challenge_store import challenge_store
+from app.attendance import attendance_writer
+from app.streaming import stream_hub, receive_chunks, send_chunks
+from app.recording import open_recorder, read_manifest, recording_directory, segment_path, recording_not_found_exception, MappedFileResponse
+from app.enrolment import registration_writer, enrolment_progress, get_enrolment_counts, pack_pending_registration, unpack_pending_registration, VerifiedRegistration, REGISTERED, STUDENT_NOT_FOUND, USER_HANDLE_CONFLICT
+from app.rate_limit import login_rate_limit, webauthn_rate_limit, ip_rate_limit, expensive_requests
+from app.metrics import registry, MetricsMiddleware, gauges_from_stats
+import app.utils as utils
+from app.reports import get_course_report, get_student_course_report, get_student_report, stream_course_report_csv
+from app.bulk_import import aiter_lines, parse_csv, parse_ndjson, import_students
+from app.token_keys import get_token_keys
+from app.refresh_tokens import refresh_token_families
+from app.utils import create_access_refresh_token, decode_and_validate_token, invalidate_student_tokens, oauth2_scheme, incorrect_matric_number_or_password_exception
+from app.webauthn_functions import bytes_to_base64url, base64url_to_bytes, generate_registration_options_function, generate_authentication_options_json, get_authentication_options_template, generate_discoverable_authentication_options_json, invalidate_authentication_options, authentication_options_cache
 from sqlmodel import Session
-from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+from sqlmodel.ext.asyncio.session import AsyncSession
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 import os
-import uvicorn
-from dotenv import load_dotenv
 from typing import Annotated
-from datetime import timedelta
+from datetime import datetime, timedelta
 import uuid
-from webauthn import options_to_json, base64url_to_bytes
-load_dotenv(".env")
+from contextlib import asynccontextmanager
+import asyncio
+import json
 
 WEBAUTHN_ORIGIN = os.getenv("WEBAUTHN_ORIGIN")
 CORS_ORIGIN = os.getenv("CORS_ORIGIN")
 RP_ID = os.getenv("RP_ID")
-SECRET_KEY = os.getenv("SECRET_KEY")
-ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES: Annotated[int,
                                        "Number of minutes the access token is valid for. I am setting it to 15 minutes"] = float(os.getenv("ACCESS_TOKEN_DURATION"))
-REFRESH_TOKEN_EXPIRE_MINUTES: Annotated[int,
-                                        "I am setting the refresh token time to 4hrs"] = 240
-
-app = FastAPI()
+PRELOAD_DEFERRED_IMPORTS = os.getenv(
+    "PRELOAD_DEFERRED_IMPORTS", "true").lower() == "true"
+
+
+def import_deferred_modules():
+    # webauthn and passlib aren't imported at startup. This loads them once the worker is accepting requests, so that the first student to log in doesn't wait for them
+    import webauthn  # noqa: F401
+    utils.get_password_context()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    with startup_report.phase("lifespan_startup"):
+        # creating the engine loads the database driver, better here than on the first request
+        get_async_engine()
+        # parses the signing keys once (and imports jose), a bad key fails the startup rather than every login
+        get_token_keys()
+    startup_report.ready()
+    print(startup_report.summary())
+    preload = asyncio.gather(asyncio.to_thread(import_deferred_modules),
+                             webauthn_verifier.start()) if PRELOAD_DEFERRED_IMPORTS else None
+    purge_refresh_tokens = asyncio.create_task(refresh_token_families.purge_periodically())
+    yield
+    purge_refresh_tokens.cancel()
+    if preload is not None:
+        await preload
+    # whatever check-ins are still waiting for their batch get verified and written before we go away
+    await webauthn_verifier.flush()
+    await attendance_writer.flush()
+    await registration_writer.flush()
+    password_hasher.shutdown()
+    webauthn_verifier.shutdown()
+    await dispose_engines()
+
+
+# orjson is several times faster than the json module, and every token and options response goes through it
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -37,6 +86,29 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# added last so it is the outermost middleware and its timings include everything else
+app.add_middleware(MetricsMiddleware, startup_report=startup_report)
+
+
+def collect_component_metrics():
+    # the components keep their own counters, these just get turned into gauges on every scrape
+    yield from gauges_from_stats("password_hasher", "Password hashing pool", [((), password_hasher.stats())])
+    yield from gauges_from_stats("webauthn_verifier", "WebAuthn verification pool", [((), webauthn_verifier.stats())])
+    yield from gauges_from_stats("db_pool", "Database connection pool", [((name, ), stats) for name, stats in get_pool_stats().items()], ("engine",))
+    yield from gauges_from_stats("cache", "In-process caches", [(("student",), crud.student_cache.stats()), (("lecture_session",), crud.lecture_session_cache.stats()),
+                                                             (("known_students",), utils.known_students.stats()), (("revoked_students",), utils.revoked_students.stats()),
+                                                             (("authentication_options",), authentication_options_cache.stats()), (("credentials",), crud.credential_cache.stats())], ("cache",))
+    yield from gauges_from_stats("attendance_writer", "Batched attendance writer", [((), attendance_writer.stats())])
+    yield from gauges_from_stats("registration_writer", "Batched device registration writer", [((), registration_writer.stats())])
+    yield from gauges_from_stats("enrolment", "Device registration ceremonies", [((), enrolment_progress.stats())])
+    yield from gauges_from_stats("refresh_tokens", "Refresh token families", [((), refresh_token_families.stats())])
+    yield from gauges_from_stats("rate_limit", "Token bucket rate limits", [((limit.name,), limit.stats()) for limit in (login_rate_limit, webauthn_rate_limit, ip_rate_limit)], ("limit",))
+    yield from gauges_from_stats("expensive_requests", "Concurrency cap on the hashing and webauthn endpoints", [((), expensive_requests.stats())])
+    yield from gauges_from_stats("startup", "Worker cold start", [((), startup_report.stats())])
+    yield from gauges_from_stats("streaming", "Lecture stream fan-out", [((), stream_hub.stats())])
+
+
+registry.add_collector(collect_component_metrics)
 
 
 @app.get(path="/")
@@ -44,34 +116,153 @@ def home():
     return True
 
 
+@app.get(path="/metrics", response_class=PlainTextResponse)
+def metrics():
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get(path="/metrics/hashing")
+def hashing_metrics():
+    return password_hasher.stats()
+
+
+@app.get(path="/metrics/webauthn")
+def webauthn_metrics():
+    return webauthn_verifier.stats()
+
+
+@app.get(path="/metrics/db-pool")
+def db_pool_metrics():
+    return get_pool_stats()
+
+
+@app.get(path="/metrics/student-cache")
+def student_cache_metrics():
+    return crud.student_cache.stats()
+
+
+# Blocking session kept only as a compatibility fallback. None of the endpoints use it anymore because every query on it stalls the event loop
 def get_session():
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         yield session
 
 
 GetSessionDep = Annotated[Session, Depends(get_session)]
+GetAsyncSessionDep = Annotated[AsyncSession, Depends(get_async_session)]
 ExtractTokenDep = Annotated[str, Depends(oauth2_scheme)]
 token_auth_scheme = HTTPBearer()
 HTTPExtractTokenDep = Annotated[HTTPAuthorizationCredentials, Depends(
     token_auth_scheme)]
 
 
+# These two run before the endpoint body, so a rejected request never reaches the database or the hashing pool.
+# Behind a reverse proxy run uvicorn with --proxy-headers so request.client is the student and not the proxy
+async def limit_by_client_ip(request: Request):
+    await ip_rate_limit.check(request.client.host if request.client else "unknown")
+
+
+async def expensive_request_slot():
+    expensive_requests.acquire()
+    try:
+        yield
+    finally:
+        expensive_requests.release()
+
+
+expensive_endpoint_dependencies = [
+    Depends(limit_by_client_ip), Depends(expensive_request_slot)]
+
+
+no_pending_challenge_exception = HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                                               detail="No pending challenge for this student or it has expired. Request new options and try again.")
+
+
+student_not_found_exception = HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                                            detail="Student does not exist.")
+
+
+course_not_found_exception = HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                                           detail="No lecture has been held for this course.")
+
+
+credential_not_found_exception = HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                                               detail="This student has no such device.")
+
+
+unknown_credential_exception = HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
+                                             detail="This device is not registered.")
+
+
+no_registered_device_exception = HTTPException(status_code=status.HTTP_403_FORBIDDEN,
+                                               detail="Your have not registered your device. Register your device before attempting to log in.")
+
+
+class PreEncodedJSONResponse(Response):
+    # For bodies that are JSON already: the cached options templates and models serialized by pydantic. Returning them as a str would get them encoded a second time as a JSON string
+    media_type = "application/json"
+
+
+def model_response(model: BaseModel, **dump_options) -> PreEncodedJSONResponse:
+    # pydantic-core writes the JSON straight from the model. Otherwise FastAPI validates the model against response_model again, dumps it to a dict and encodes that
+    return PreEncodedJSONResponse(model.model_dump_json(**dump_options))
+
+
+def registration_challenge_key(matric_number: str) -> str:
+    return "registration:" + matric_number.upper()
+
+
+def authentication_challenge_key(matric_number: str) -> str:
+    return "authentication:" + matric_number.upper()
+
+
+def lecture_challenge_key(lecture_session_id: int, matric_number: str) -> str:
+    # A check-in challenge is only good for one lecture. It is handed out with the lecture session and stays put until the student verifies with it
+    return f"lecture:{lecture_session_id}:{matric_number.upper()}"
+
+
+def credential_descriptors(credentials: tuple[CredentialSnapshot, ...]) -> tuple[tuple[bytes, str | None], ...]:
+    return tuple((credential.credential_id, credential.transports) for credential in credentials)
+
+
 # @app.post(path="/create-student", dependencies=[Depends(verify_token_for_create_student_endpoint)])
 @app.post(path="/create-student")
-async def create_student(*, session: GetSessionDep, student: StudentPydanticModel, authorization: HTTPExtractTokenDep):
+async def create_student(*, session: GetAsyncSessionDep, student: StudentPydanticModel, authorization: HTTPExtractTokenDep):
     token = authorization.credentials
     if await decode_and_validate_token(token=token, token_expected="create_student_token"):
-        db_student = crud.create_student(session, student)
+        db_student = await crud.async_create_student(session, student)
         if db_student:
             student.password = "sike, you thought you were getting the original thing"
-            return student.model_dump(exclude_unset=True)
+            return model_response(student, exclude_unset=True)
         raise HTTPException(status_code=status.HTTP_409_CONFLICT,
                             detail="Student already exists.")
 
 
-@app.post(path="/verify-student", response_model=TokenResponse)
-def verify_student(student: StudentPydanticModel, session: GetSessionDep):
-    db_student = crud.get_student(session, student.matric_number)
+@app.post(path="/create-students")
+async def create_students(*, request: Request, session: GetAsyncSessionDep, authorization: HTTPExtractTokenDep):
+    # Bulk enrolment. The body is either NDJSON (one {"matric_number": ..., "password": ...} per line) or a CSV with a header line.
+    # The body is read and committed batch by batch as it streams in. Only the per-row report is kept, it is small even for a whole faculty
+    token = authorization.credentials
+    await decode_and_validate_token(token=token, token_expected="create_student_token")
+    content_type = request.headers.get("content-type", "")
+    if content_type.startswith("text/csv"):
+        parse = parse_csv
+    elif content_type.startswith(("application/x-ndjson", "application/jsonl")):
+        parse = parse_ndjson
+    else:
+        raise HTTPException(status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+                            detail="Send the students as text/csv or application/x-ndjson.")
+    results = [result async for result in import_students(session, parse(aiter_lines(request.stream())))]
+    summary: dict[str, int] = {}
+    for result in results:
+        summary[result["status"]] = summary.get(result["status"], 0) + 1
+    return {"summary": summary, "results": results}
+
+
+@app.post(path="/verify-student", response_model=TokenResponse, dependencies=expensive_endpoint_dependencies)
+async def verify_student(student: StudentPydanticModel, session: GetAsyncSessionDep):
+    # per matric number so that guessing one student's password is slow no matter how many addresses it comes from
+    await login_rate_limit.check(student.matric_number.upper())
+    db_student = await crud.async_get_student(session, student.matric_number)
     if not db_student:
         raise incorrect_matric_number_or_password_exception
     if not db_student.device_registered:
@@ -79,114 +270,450 @@ def verify_student(student: StudentPydanticModel, session: GetSessionDep):
                             detail="Your have not registered your device. Register your device before attempting to log in.")
     retrieved_password: Annotated[str,
                                   "The hashed password"] = db_student.password
-    if not verify_password(student.password, retrieved_password):
+    verified, upgraded_password = await password_hasher.verify_and_update(student.password, retrieved_password)
+    if not verified:
         # Wrong password
         raise incorrect_matric_number_or_password_exception
+    if upgraded_password:
+        # the stored hash was made under an older hashing policy, this is the only time we have the plain password to rehash it
+        await crud.async_update_student(session, db_student.matric_number, StudentUpdateModel(password=upgraded_password))
+    return model_response(await issue_tokens(session, db_student.matric_number))
+
+
+def issue_access_token(matric_number: str) -> str:
     access_token_expires = timedelta(
         minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    access_token = create_access_refresh_token(
-        data={"sub": "access|" + db_student.matric_number}, expires_delta=access_token_expires)
+    return create_access_refresh_token(
+        data={"sub": "access|" + matric_number}, expires_delta=access_token_expires)
 
-    refresh_token_expires = timedelta(minutes=REFRESH_TOKEN_EXPIRE_MINUTES)
-    refresh_token = create_access_refresh_token(
-        data={"sub": "refresh|" + db_student.matric_number}, expires_delta=refresh_token_expires)
 
-    return TokenResponse(access_token=access_token, token_type="bearer", refresh_token=refresh_token)
+async def issue_tokens(session: AsyncSession, matric_number: str) -> TokenResponse:
+    # every login is a new refresh token family, so logging out on one device leaves the others logged in
+    refresh_token = await refresh_token_families.start(session, matric_number)
+    return TokenResponse(access_token=issue_access_token(matric_number), token_type="bearer", refresh_token=refresh_token)
 
 
-registration_challenges: dict[Annotated[str, "The matric number of a student"],
-                              Annotated[bytes, "The registration challenge associated with that user"]] = {}
+async def revoke_all_student_tokens(session: AsyncSession, matric_number: str):
+    # both in the database, so every worker sees them
+    await invalidate_student_tokens(session, matric_number)
+    await refresh_token_families.revoke_student(session, matric_number)
 
 
-@app.get(path="/generate-registration-options")
-async def handler_generate_registration_options(*, matric_number: str, session: GetSessionDep, authorization: HTTPExtractTokenDep):
+@app.get(path="/generate-registration-options", dependencies=[Depends(limit_by_client_ip)])
+async def handler_generate_registration_options(*, matric_number: str, session: GetAsyncSessionDep, authorization: HTTPExtractTokenDep):
     token = authorization.credentials
     # decode_and_validate_token here can only return True if anything wrong happens it raises a credential error
     validated = await decode_and_validate_token(token=token, token_expected="create_student_token")
-    user_id: uuid.UUID = uuid.uuid4()
+    db_student = await crud.async_get_student_snapshot(session, matric_number)
+    if not db_student:
+        raise student_not_found_exception
+    # Every device a student registers has to carry the same user handle, otherwise usernameless login can't tell they belong to the same person.
+    # A student registering their first device gets a new one, which is kept with the challenge and only written to the student once the ceremony is verified
+    user_id: uuid.UUID = db_student.user_id or uuid.uuid4()
     registration_challenge: bytes = os.urandom(32)
-    update_data = StudentUpdateModel(
-        user_id=user_id)
-    registration_challenges[matric_number] = registration_challenge
-    crud.update_student(session, matric_number, update_data)
+    existing_credentials = await crud.async_get_student_credentials(session, matric_number)
+    await challenge_store.put(registration_challenge_key(matric_number), pack_pending_registration(registration_challenge, user_id))
+    enrolment_progress.ceremony_started()
     options = generate_registration_options_function(
-        RP_ID=RP_ID, user_id=user_id, matric_number=matric_number, registration_challenge=registration_challenge)
+        RP_ID=RP_ID, user_id=user_id, matric_number=matric_number, registration_challenge=registration_challenge,
+        existing_credentials=tuple((credential.credential_id, credential.transports) for credential in existing_credentials))
 
-    return options_to_json(options)
+    from webauthn import options_to_json
+    return PreEncodedJSONResponse(options_to_json(options))
 
 
-@app.post(path="/verify-registration-response")
-async def handler_verify_registration_response(*, matric_number: str, request: Request, session: GetSessionDep, authorization: HTTPExtractTokenDep):
+@app.post(path="/verify-registration-response", dependencies=expensive_endpoint_dependencies)
+async def handler_verify_registration_response(*, matric_number: str, request: Request, session: GetAsyncSessionDep, authorization: HTTPExtractTokenDep):
     token = authorization.credentials
     validated = await decode_and_validate_token(token=token, token_expected="create_student_token")
 
     credential: dict = await request.json()  # returns a json object
-    registration_challenge = registration_challenges[matric_number]
-
-    verification, transports_string = verify_registration_options_function(
+    # popping here means a challenge can only be used once even if the verification below fails
+    pending_registration = await challenge_store.pop(registration_challenge_key(matric_number))
+    if pending_registration is None:
+        raise no_pending_challenge_exception
+    registration_challenge, user_id = unpack_pending_registration(pending_registration)
+
+    # verified in the webauthn pool, together with whatever other registrations arrived in the same few milliseconds
+    verification = await webauthn_verifier.verify_registration(
         credential=credential, registration_challenge=registration_challenge, RP_ID=RP_ID, WEBAUTHN_ORIGIN=WEBAUTHN_ORIGIN)
-    update_data = StudentUpdateModel(credential_id=verification.credential_id, public_key=verification.credential_public_key,
-                                     sign_count=verification.sign_count, transports=transports_string, device_registered=True)
-    crud.update_student(session, matric_number, update_data)
-    del registration_challenges[matric_number]
-    return JSONResponse(status_code=status.HTTP_200_OK, content={"verified": True})
+    # The new device is added next to whatever the student already had instead of replacing it.
+    # The write is batched with the other registrations being verified right now, this waits for the batch it went out in
+    outcome = await registration_writer.register(VerifiedRegistration(matric_number=matric_number.upper(), user_id=user_id, credential_id=verification.credential_id,
+                                                                      public_key=verification.credential_public_key, sign_count=verification.sign_count, transports=verification.transports))
+    if outcome == STUDENT_NOT_FOUND:
+        raise student_not_found_exception
+    if outcome == USER_HANDLE_CONFLICT:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT,
+                            detail="Another device was registered for this student while this one was being set up. Request new options and try again.")
+    if outcome != REGISTERED:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT,
+                            detail="This device is already registered.")
+    # a new device means whatever tokens were issued before it should stop working
+    await revoke_all_student_tokens(session, matric_number)
+    invalidate_authentication_options(matric_number)
+    return ORJSONResponse(status_code=status.HTTP_200_OK, content={"verified": True})
 
 
-authentication_challenges: dict[Annotated[str, "The matric number of a student"],
-                                Annotated[bytes, "The authentication challenge associated with that user"]] = {}
+@app.delete(path="/students/{matric_number}/credentials/{credential_id}")
+async def delete_student_credential(*, matric_number: str, credential_id: str, session: GetAsyncSessionDep, authorization: HTTPExtractTokenDep):
+    # for a lost or stolen phone. credential_id is base64url, the same as the id in the options
+    token = authorization.credentials
+    await decode_and_validate_token(token=token, token_expected="create_student_token")
+    try:
+        credential_id_bytes = base64url_to_bytes(credential_id)
+    except ValueError:
+        raise credential_not_found_exception
+    if not await crud.async_delete_credential(session, matric_number, credential_id_bytes):
+        raise credential_not_found_exception
+    await revoke_all_student_tokens(session, matric_number)
+    invalidate_authentication_options(matric_number)
+    return ORJSONResponse(status_code=status.HTTP_200_OK, content={"deleted": True})
+
+
+@app.get(path="/generate-authentication-options", dependencies=[Depends(limit_by_client_ip)])
+async def handler_generate_authentication_options(session: GetAsyncSessionDep, token: ExtractTokenDep):
+    matric_number = await decode_and_validate_token(token=token, session=session)
+    await webauthn_rate_limit.check(matric_number)
+    authentication_challenge: bytes = os.urandom(32)
+
+    credentials = await crud.async_get_student_credentials(session, matric_number)
+    if not credentials:
+        raise no_registered_device_exception
+
+    await challenge_store.put(authentication_challenge_key(matric_number), authentication_challenge)
+    # only the challenge gets serialized here, the rest of the options comes from a template cached per student
+    return PreEncodedJSONResponse(generate_authentication_options_json(
+        RP_ID=RP_ID, matric_number=matric_number, credentials=credential_descriptors(credentials), authentication_challenge=authentication_challenge))
+
 
+@app.post("/verify-authentication-response", response_class=ORJSONResponse, dependencies=expensive_endpoint_dependencies)
+async def hander_verify_authentication_response(*, request: Request, session: GetAsyncSessionDep, token: ExtractTokenDep, lecture_session_id: int | None = None):
 
-@app.get(path="/generate-authentication-options")
-async def handler_generate_authentication_options(session: GetSessionDep, token: ExtractTokenDep):
     matric_number = await decode_and_validate_token(token=token, session=session)
+    await webauthn_rate_limit.check(matric_number)
+    if lecture_session_id is not None:
+        # checking this before the expensive verification so a check-in to a closed lecture fails fast
+        await get_open_lecture_session(session, lecture_session_id)
+    credential: dict = await request.json()  # returns a json object
+    # A student checking in may have signed the challenge that came with the lecture session or one from /generate-authentication-options,
+    # so the one to use up is whichever of them the device actually signed
+    signed_challenge = client_data_challenge(credential)
+    authentication_challenge = None
+    lecture_key = lecture_challenge_key(lecture_session_id, matric_number) if lecture_session_id is not None else None
+    if lecture_key is not None and await challenge_store.get(lecture_key) == signed_challenge:
+        authentication_challenge = await challenge_store.pop(lecture_key)
+    else:
+        # single use either way, so it goes even when it isn't the one that was signed
+        authentication_challenge = await challenge_store.pop(authentication_challenge_key(matric_number))
+    if authentication_challenge is None or authentication_challenge != signed_challenge:
+        raise no_pending_challenge_exception
+
+    # Find the user's corresponding public key. It has to be one of this student's devices, not just any registered one
+    db_credential = await get_asserted_credential(session, credential, matric_number)
+    if db_credential.matric_number != matric_number:
+        raise unknown_credential_exception
+    await verify_assertion(session, credential, db_credential, authentication_challenge)
+    if lecture_session_id is None:
+        return ORJSONResponse(content={"verified": True}, status_code=status.HTTP_200_OK)
+    # this waits for the batch the check-in lands in, which is at most ATTENDANCE_BATCH_DELAY_MS plus one shared commit
+    newly_checked_in = await attendance_writer.record(lecture_session_id, matric_number)
+    return ORJSONResponse(content={"verified": True, "checked_in": True, "already_checked_in": not newly_checked_in}, status_code=status.HTTP_200_OK)
+
+
+@app.get(path="/generate-discoverable-authentication-options", dependencies=[Depends(limit_by_client_ip)])
+async def handler_generate_discoverable_authentication_options():
+    # Usernameless login: no matric number and no allow list, the authenticator offers whichever passkey it has for us.
+    # The pending challenge is keyed by itself because there is nobody to key it by yet, and it comes back inside clientDataJSON
     authentication_challenge: bytes = os.urandom(32)
+    await challenge_store.put(discoverable_challenge_key(authentication_challenge), authentication_challenge)
+    return PreEncodedJSONResponse(generate_discoverable_authentication_options_json(RP_ID=RP_ID, authentication_challenge=authentication_challenge))
+
+
+@app.post(path="/verify-discoverable-authentication-response", response_model=TokenResponse, dependencies=expensive_endpoint_dependencies)
+async def handler_verify_discoverable_authentication_response(*, request: Request, session: GetAsyncSessionDep):
+    credential: dict = await request.json()
+    authentication_challenge = await challenge_store.pop(discoverable_challenge_key(client_data_challenge(credential)))
+    if authentication_challenge is None:
+        raise no_pending_challenge_exception
+    # the rawId is the only thing that says who this is, and it resolves through the unique index on credential_id
+    db_credential = await get_asserted_credential(session, credential)
+    await webauthn_rate_limit.check(db_credential.matric_number)
+    user_handle = credential["response"].get("userHandle")
+    if user_handle:
+        db_student = await crud.async_get_student_snapshot(session, db_credential.matric_number)
+        if db_student.user_id is None or base64url_to_bytes(user_handle) != str(db_student.user_id).encode():
+            raise unknown_credential_exception
+    await verify_assertion(session, credential, db_credential, authentication_challenge)
+    return model_response(await issue_tokens(session, db_credential.matric_number))
+
+
+def discoverable_challenge_key(authentication_challenge: bytes) -> str:
+    return "discoverable:" + bytes_to_base64url(authentication_challenge)
+
+
+def client_data_challenge(credential: dict) -> bytes:
+    # the challenge the authenticator signed, as the browser put it in clientDataJSON. Only used to find the pending challenge, the signature check is what trusts it
+    try:
+        client_data = json.loads(base64url_to_bytes(
+            credential["response"]["clientDataJSON"]))
+        return base64url_to_bytes(client_data["challenge"])
+    except (KeyError, TypeError, ValueError, AttributeError):
+        raise no_pending_challenge_exception
+
+
+async def get_asserted_credential(session: AsyncSession, credential: dict, matric_number: str | None = None) -> CredentialSnapshot:
+    try:
+        raw_id_bytes: bytes = base64url_to_bytes(credential["rawId"])
+    except (KeyError, TypeError, ValueError):
+        raise unknown_credential_exception
+    db_credential = await crud.async_get_credential(session, raw_id_bytes, matric_number)
+    if db_credential is None:
+        raise unknown_credential_exception
+    return db_credential
+
+
+async def verify_assertion(session: AsyncSession, credential: dict, db_credential: CredentialSnapshot, authentication_challenge: bytes):
+    # the signature check runs in the webauthn pool, so the event loop keeps serving the rest of the hall while it happens
+    new_sign_count = await webauthn_verifier.verify_authentication(credential=credential, authentication_challenge=authentication_challenge, public_key=db_credential.public_key,
+                                                                   sign_count=db_credential.sign_count, RP_ID=RP_ID, WEBAUTHN_ORIGIN=WEBAUTHN_ORIGIN)
+    # Update this credential's sign count to what the authenticator says it is now, as long as that is still ahead of what the database has
+    if not await crud.async_update_credential_sign_count(session, db_credential, new_sign_count):
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT,
+                            detail="Another sign in for this device happened at the same time. Try again.")
+
 
-    db_student = crud.get_student(session, matric_number)
-    # we are pretty much assuming that all these thigns have a non null value in the database
-    credential_id, transports = db_student.credential_id, db_student.transports
+async def get_open_lecture_session(session: AsyncSession, lecture_session_id: int):
+    db_lecture_session = await crud.async_get_lecture_session(session, lecture_session_id)
+    if db_lecture_session is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail="Lecture session does not exist.")
+    if db_lecture_session.closes_at <= datetime.utcnow():
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail="Attendance for this lecture session is closed.")
+    return db_lecture_session
 
-    authentication_challenges[matric_number] = authentication_challenge
-    options = generate_authentication_options_functions(
-        RP_ID=RP_ID, credential_id=credential_id, transports=transports, authentication_challenge=authentication_challenge)
 
-    return options_to_json(options)
+def seconds_until_closed(db_lecture_session) -> float:
+    return (db_lecture_session.closes_at - datetime.utcnow()).total_seconds()
 
 
-@app.post("/verify-authentication-response", response_class=JSONResponse)
-async def hander_verify_authentication_response(*, request: Request, session: GetSessionDep, token: ExtractTokenDep):
+async def prepare_check_ins(session: AsyncSession, db_lecture_session, roster: list[str]) -> int:
+    # Everything a check-in needs is made while the lecturer is opening the lecture, instead of in a rush of generate-authentication-options
+    # requests at the start of class: the devices of the whole roster in a few queries, their options templates, and a challenge each written in one go.
+    # Students without a device are skipped, they can't check in with one anyway
+    credentials = await crud.async_get_students_credentials(session, roster)
+    for matric_number, student_credentials in credentials.items():
+        get_authentication_options_template(RP_ID, matric_number, credential_descriptors(student_credentials))
+    await challenge_store.put_many({lecture_challenge_key(db_lecture_session.id, matric_number): os.urandom(32) for matric_number in credentials},
+                                   ttl=seconds_until_closed(db_lecture_session))
+    return len(credentials)
 
+
+@app.post(path="/lecture-sessions")
+async def create_lecture_session(*, lecture_session: LectureSessionCreateModel, session: GetAsyncSessionDep, authorization: HTTPExtractTokenDep):
+    # lecturers use the same admin token as create-student for now
+    token = authorization.credentials
+    await decode_and_validate_token(token=token, token_expected="create_student_token")
+    db_lecture_session = await crud.async_create_lecture_session(session, lecture_session)
+    roster = lecture_session.roster
+    if roster is None:
+        roster = await crud.async_get_course_roster(session, db_lecture_session.course_code)
+    prepared_check_ins = await prepare_check_ins(session, db_lecture_session, roster)
+    return ORJSONResponse(content={**db_lecture_session.model_dump(mode="json"), "prepared_check_ins": prepared_check_ins})
+
+
+@app.get(path="/lecture-sessions/{lecture_session_id}")
+async def get_lecture_session(lecture_session_id: int, session: GetAsyncSessionDep, token: ExtractTokenDep):
     matric_number = await decode_and_validate_token(token=token, session=session)
-    credential: dict = await request.json()  # returns a json object
-    # Find the user's corresponding public key
-    raw_id_bytes: bytes = base64url_to_bytes(credential["rawId"])
+    db_lecture_session = await crud.async_get_lecture_session(session, lecture_session_id)
+    if db_lecture_session is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail="Lecture session does not exist.")
+    if seconds_until_closed(db_lecture_session) <= 0:
+        return db_lecture_session
+    credentials = await crud.async_get_student_credentials(session, matric_number)
+    if not credentials:
+        return db_lecture_session
+    # While the lecture is open the student's check-in options come along, so the device can go straight to verify-authentication-response.
+    # The challenge is the one prepared when the lecture was opened. Students who weren't on the roster, or who already used theirs, get a new one
+    key = lecture_challenge_key(lecture_session_id, matric_number)
+    authentication_challenge = await challenge_store.get(key)
+    if authentication_challenge is None:
+        await webauthn_rate_limit.check(matric_number)
+        authentication_challenge = os.urandom(32)
+        await challenge_store.put(key, authentication_challenge, ttl=seconds_until_closed(db_lecture_session))
+    authentication_options = generate_authentication_options_json(
+        RP_ID=RP_ID, matric_number=matric_number, credentials=credential_descriptors(credentials), authentication_challenge=authentication_challenge)
+    # the options are JSON already, so they are spliced in as the last field rather than decoded and encoded again
+    return PreEncodedJSONResponse(db_lecture_session.model_dump_json().encode()[:-1] + b',"authentication_options":' + authentication_options + b"}")
+
+
+def websocket_token(websocket: WebSocket, token: str | None) -> str:
+    # Browsers can't set headers on a websocket, so the token comes in the query string. Other clients can still send the usual Authorization header
+    if token:
+        return token
+    scheme, _, credentials = websocket.headers.get("authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not credentials:
+        raise WebSocketException(code=status.WS_1008_POLICY_VIOLATION, reason="Not authenticated")
+    return credentials
+
+
+async def check_websocket_request(websocket: WebSocket, lecture_session_id: int, token: str | None, session: AsyncSession, token_expected: str):
+    # the same checks as the http endpoints, turned into a refused websocket instead of an error response
+    try:
+        if token_expected == "create_student_token":
+            await decode_and_validate_token(token=websocket_token(websocket, token), token_expected=token_expected)
+        else:
+            await decode_and_validate_token(token=websocket_token(websocket, token), session=session)
+        await get_open_lecture_session(session, lecture_session_id)
+    except HTTPException as err:
+        raise WebSocketException(code=status.WS_1008_POLICY_VIOLATION, reason=str(err.detail))
+    finally:
+        # a stream lasts the whole lecture, it shouldn't keep a pooled connection that long
+        await session.close()
+
+
+@app.websocket("/lecture-sessions/{lecture_session_id}/stream/publish")
+async def publish_lecture_stream(websocket: WebSocket, lecture_session_id: int, session: GetAsyncSessionDep, token: str | None = None):
+    # lecturers use the same admin token as create-student for now
+    await check_websocket_request(websocket, lecture_session_id, token, session, "create_student_token")
+    stream = stream_hub.stream(lecture_session_id)
+    if stream.publisher_connected:
+        raise WebSocketException(code=status.WS_1008_POLICY_VIOLATION,
+                                 reason="This lecture is already being streamed.")
+    stream.publisher_connected = True
+    try:
+        stream.recorder = open_recorder(lecture_session_id)
+        await websocket.accept()
+        await receive_chunks(websocket, stream)
+    finally:
+        stream.stop_recording()
+        stream.publisher_connected = False
+        stream_hub.leave(stream)
+
+
+@app.websocket("/lecture-sessions/{lecture_session_id}/stream")
+async def listen_to_lecture_stream(websocket: WebSocket, lecture_session_id: int, session: GetAsyncSessionDep, token: str | None = None):
+    await check_websocket_request(websocket, lecture_session_id, token, session, "access")
+    stream = stream_hub.stream(lecture_session_id)
+    subscriber = stream.subscribe()
+    try:
+        await websocket.accept()
+        await send_chunks(websocket, subscriber)
+    finally:
+        stream_hub.leave(stream, subscriber)
+
+
+@app.get(path="/lecture-sessions/{lecture_session_id}/recording")
+async def get_lecture_recording(lecture_session_id: int, session: GetAsyncSessionDep, token: ExtractTokenDep):
+    await decode_and_validate_token(token=token, session=session)
+    return read_manifest(lecture_session_id)
+
+
+@app.get(path="/lecture-sessions/{lecture_session_id}/recording/segments/{segment}")
+async def get_lecture_recording_segment(lecture_session_id: int, segment: int, request: Request, session: GetAsyncSessionDep, token: ExtractTokenDep):
+    await decode_and_validate_token(token=token, session=session)
+    path = segment_path(recording_directory(lecture_session_id), segment)
+    if segment < 0 or not path.is_file():
+        raise recording_not_found_exception
+    # a segment never changes once the recording has moved on to the next one, the one still being written only grows
+    return MappedFileResponse(path, request.headers.get("range"), headers={"cache-control": "private, max-age=60"})
+
+
+@app.get(path="/metrics/streaming")
+def streaming_metrics():
+    return stream_hub.stats()
+
+
+@app.get(path="/reports/courses/{course_code}")
+async def course_report(course_code: str, session: GetAsyncSessionDep, authorization: HTTPExtractTokenDep):
+    await decode_and_validate_token(token=authorization.credentials, token_expected="create_student_token")
+    report = await get_course_report(session, course_code)
+    if report is None:
+        raise course_not_found_exception
+    return report
+
+
+@app.get(path="/reports/courses/{course_code}/export.csv")
+async def export_course_report(course_code: str, session: GetAsyncSessionDep, authorization: HTTPExtractTokenDep):
+    await decode_and_validate_token(token=authorization.credentials, token_expected="create_student_token")
+    return StreamingResponse(stream_course_report_csv(session, course_code), media_type="text/csv",
+                             headers={"Content-Disposition": f'attachment; filename="{course_code.upper()}-attendance.csv"'})
+
+
+@app.get(path="/reports/courses/{course_code}/students/{matric_number}")
+async def student_course_report(course_code: str, matric_number: str, session: GetAsyncSessionDep, authorization: HTTPExtractTokenDep):
+    await decode_and_validate_token(token=authorization.credentials, token_expected="create_student_token")
+    report = await get_student_course_report(session, course_code, matric_number)
+    if report is None:
+        raise course_not_found_exception
+    return report
+
+
+@app.get(path="/reports/me")
+async def my_attendance_report(session: GetAsyncSessionDep, token: ExtractTokenDep):
+    # students can only see their own attendance
+    matric_number = await decode_and_validate_token(token=token, session=session)
+    return await get_student_report(session, matric_number)
+
+
+@app.get(path="/metrics/attendance-writer")
+def attendance_writer_metrics():
+    return attendance_writer.stats()
+
+
+@app.get(path="/enrolment/progress")
+async def enrolment_progress_report(*, session: GetAsyncSessionDep, authorization: HTTPExtractTokenDep):
+    # For the admins watching an enrolment drive. The counts come from the database, the started/registered counters and rates are this worker's
+    token = authorization.credentials
+    await decode_and_validate_token(token=token, token_expected="create_student_token")
+    return {**await get_enrolment_counts(session), **enrolment_progress.stats(), "registration_writer": registration_writer.stats()}
+
 
-    db_student = crud.get_student(session, matric_number)
-    # We are assuming that when we are calling this endpoint all this info would be available in the datbase. like the stuent would have already registered
-    credential_id, public_key, sign_count = db_student.credential_id, db_student.public_key, db_student.sign_count
-    authentication_challenge = authentication_challenges[matric_number]
+@app.get(path="/metrics/rate-limits")
+def rate_limit_metrics():
+    return {"login": login_rate_limit.stats(), "webauthn": webauthn_rate_limit.stats(), "ip": ip_rate_limit.stats(),
+            "expensive_requests": expensive_requests.stats()}
 
-    verification = verify_authentication_options_function(credential_id=credential_id, raw_id_bytes=raw_id_bytes, credential=credential,
-                                                          authentication_challenge=authentication_challenge, public_key=public_key, sign_count=sign_count, RP_ID=RP_ID, WEBAUTHN_ORIGIN=WEBAUTHN_ORIGIN)
-    # Update our credential's sign count to what the authenticator says it is now
-    crud.update_student(session, matric_number, StudentUpdateModel(
-        sign_count=verification.new_sign_count))
-    del authentication_challenges[matric_number]
-    return JSONResponse(content={"verified": True}, status_code=status.HTTP_200_OK)
+
+@app.get(path="/metrics/startup")
+def startup_metrics():
+    return {**startup_report.stats(), "slowest_imports": startup_report.import_profiler.slowest()}
+
+
+@app.get(path="/.well-known/jwks.json")
+def jwks():
+    # the public keys access tokens are signed with, for other services to validate them without calling us. Empty with HS256
+    return ORJSONResponse(content=get_token_keys().jwks(), headers={"Cache-Control": "public, max-age=300"})
+
+
+@app.post(path="/revoke-student-tokens")
+async def revoke_student_tokens(*, matric_number: str, session: GetAsyncSessionDep, authorization: HTTPExtractTokenDep):
+    token = authorization.credentials
+    await decode_and_validate_token(token=token, token_expected="create_student_token")
+    await revoke_all_student_tokens(session, matric_number)
+    return ORJSONResponse(status_code=status.HTTP_200_OK, content={"revoked": True})
 
 
 @app.post(path="/refresh")
-async def refresh(refresh_token: RefreshToken, access_token: ExtractTokenDep, session: GetSessionDep):
-    refresh_token_str = refresh_token.refresh_token
-    # we are passing the session argument as well as the token explicitly because unlike those endpoint or path operations head, this is a regular calling of a function and FastAPi isn't helping us with any dependency injection
-    access_matric_number = await decode_and_validate_token(access_token, session)
-    refresh_matric_number = await decode_and_validate_token(refresh_token_str, session, token_expected="refresh")
-    if not refresh_matric_number or not access_matric_number or refresh_matric_number != access_matric_number:
-        raise credentials_exception
-    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    new_access_token = create_access_refresh_token(
-        data={"sub": "access|" + access_matric_number}, expires_delta=access_token_expires
-    )
-    return TokenResponse(new_access_token=new_access_token, token_type="bearer").model_dump(exclude_unset=True)
+async def refresh(refresh_token: RefreshToken, session: GetAsyncSessionDep):
+    # The refresh token is enough on its own, an expired access token no longer means logging in again. It works once: the response carries the
+    # refresh token to use next time, and using an old one again logs that device out (see app.refresh_tokens)
+    matric_number, new_refresh_token = await refresh_token_families.rotate(session, refresh_token.refresh_token)
+    return model_response(TokenResponse(new_access_token=issue_access_token(matric_number), token_type="bearer", refresh_token=new_refresh_token),
+                          exclude_unset=True)
+
+
+@app.post(path="/logout")
+async def logout(refresh_token: RefreshToken, session: GetAsyncSessionDep):
+    # ends this login's refresh token family. The access token runs out by itself within ACCESS_TOKEN_DURATION
+    revoked = await refresh_token_families.revoke(session, refresh_token.refresh_token)
+    return ORJSONResponse(status_code=status.HTTP_200_OK, content={"revoked": revoked})
+
+
+startup_report.imports_finished()
 
 if __name__ == "__main__":
+    import uvicorn
     uvicorn.run(app=app, host="0.0.0.0")
@@ -0,0 +1,79 @@
+# Picks password hashing parameters that take about --target-ms per hash on this machine, e.g.
+#   python script/calibrate_password_hashing.py --scheme argon2 --target-ms 250
+# Run it on the hardware the API runs on. It prints the environment variables to set, and existing hashes get upgraded to the new
+# parameters as students log in. Keep in mind a login costs one hash per request, so the hashing pool can do about HASH_POOL_WORKERS * 1000 / target-ms logins a second
+import sys
+import pathlib
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent))
+from app.utils import build_password_context
+import argparse
+import statistics
+import time
+
+
+def measure(samples: int, **policy) -> float:
+    # median milliseconds for one hash, after a warm up hash so argon2's first allocation isn't counted
+    context = build_password_context(**policy)
+    context.hash("calibration")
+    timings = []
+    for _ in range(samples):
+        started = time.perf_counter()
+        context.hash("calibration")
+        timings.append(1000 * (time.perf_counter() - started))
+    return statistics.median(timings)
+
+
+def calibrate_bcrypt(target_ms: float, samples: int) -> tuple[dict, float]:
+    # every extra round doubles the cost, so this settles on the last one still under the target
+    chosen, chosen_ms = 4, measure(samples, scheme="bcrypt", bcrypt_rounds=4)
+    for rounds in range(5, 20):
+        milliseconds = measure(samples, scheme="bcrypt", bcrypt_rounds=rounds)
+        print(f"bcrypt rounds={rounds}: {milliseconds:.1f} ms")
+        if milliseconds > target_ms:
+            break
+        chosen, chosen_ms = rounds, milliseconds
+    return {"PASSWORD_HASH_SCHEME": "bcrypt", "BCRYPT_ROUNDS": chosen}, chosen_ms
+
+
+def calibrate_argon2(target_ms: float, samples: int, memory_cost: int, parallelism: int) -> tuple[dict, float]:
+    # Memory is what makes argon2 expensive to attack, so it is kept at --memory-kib and the passes go up until the target is reached.
+    # If a single pass at that memory is already too slow the memory is halved instead
+    while True:
+        milliseconds = measure(samples, scheme="argon2", argon2_time_cost=1,
+                               argon2_memory_cost=memory_cost, argon2_parallelism=parallelism)
+        print(f"argon2id m={memory_cost} t=1 p={parallelism}: {milliseconds:.1f} ms")
+        # argon2 needs at least 8 KiB per lane
+        if milliseconds <= target_ms or memory_cost // 2 < 8 * parallelism:
+            break
+        memory_cost //= 2
+    chosen, chosen_ms = 1, milliseconds
+    for time_cost in range(2, 33):
+        milliseconds = measure(samples, scheme="argon2", argon2_time_cost=time_cost,
+                               argon2_memory_cost=memory_cost, argon2_parallelism=parallelism)
+        print(f"argon2id m={memory_cost} t={time_cost} p={parallelism}: {milliseconds:.1f} ms")
+        if milliseconds > target_ms:
+            break
+        chosen, chosen_ms = time_cost, milliseconds
+    return {"PASSWORD_HASH_SCHEME": "argon2", "ARGON2_TIME_COST": chosen, "ARGON2_MEMORY_COST": memory_cost,
+            "ARGON2_PARALLELISM": parallelism}, chosen_ms
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Find password hashing parameters that hit a target latency per hash")
+    parser.add_argument("--scheme", choices=("bcrypt", "argon2"), default="argon2")
+    parser.add_argument("--target-ms", type=float, default=250.0)
+    parser.add_argument("--samples", type=int, default=5,
+                        help="Hashes timed per candidate, the median is used")
+    parser.add_argument("--memory-kib", type=int, default=19456,
+                        help="Starting argon2id memory cost")
+    parser.add_argument("--parallelism", type=int, default=1)
+    args = parser.parse_args()
+    if args.scheme == "bcrypt":
+        settings, milliseconds = calibrate_bcrypt(args.target_ms, args.samples)
+    else:
+        settings, milliseconds = calibrate_argon2(
+            args.target_ms, args.samples, args.memory_kib, args.parallelism)
+    print(f"\n# about {milliseconds:.1f} ms per hash (target {args.target_ms:.0f} ms)")
+    for name, value in settings.items():
+        print(f"{name}={value}")
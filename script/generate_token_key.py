@@ -0,0 +1,30 @@
+# Writes a new ES256 signing key into JWT_KEYS_DIR, e.g.
+#   python script/generate_token_key.py --keys-dir /etc/augmented-classroom/jwt-keys
+# The file is named after its kid (today's date unless --kid is given). Once every worker has been restarted with the key in the directory it shows up in
+# /.well-known/jwks.json. Give the other services a few minutes to pick it up, then set JWT_SIGNING_KEY_ID to the new kid
+import argparse
+import datetime
+import os
+import pathlib
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Generate an ES256 key for signing tokens")
+    parser.add_argument("--keys-dir", default=os.getenv("JWT_KEYS_DIR"),
+                        help="Defaults to JWT_KEYS_DIR")
+    parser.add_argument("--kid", default=datetime.date.today().isoformat())
+    args = parser.parse_args()
+    if not args.keys_dir:
+        parser.error("--keys-dir or JWT_KEYS_DIR is required")
+    path = pathlib.Path(args.keys_dir) / f"{args.kid}.pem"
+    if path.exists():
+        parser.error(f"{path} already exists")
+    path.parent.mkdir(parents=True, exist_ok=True)
+    private_key = ec.generate_private_key(ec.SECP256R1())
+    # only the owner can read it
+    with open(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), "wb") as key_file:
+        key_file.write(private_key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                                 serialization.NoEncryption()))
+    print(f"Wrote {path}. Set JWT_SIGNING_KEY_ID={args.kid} once it is published")
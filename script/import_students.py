@@ -0,0 +1,63 @@
+# Bulk enrol students from a registry export, e.g.
+#   python script/import_students.py students.csv --report report.csv
+# The CSV needs a header line with at least matric_number and password. Files ending in .ndjson/.jsonl are read as NDJSON instead.
+# It talks to DB_URL directly, so it doesn't go through the API or its rate limits
+import sys
+import pathlib
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent))
+from app.bulk_import import decode_line, parse_csv, parse_ndjson, import_students, BULK_IMPORT_BATCH_SIZE
+from app.database import async_engine
+from app.hashing import PasswordHasher
+from sqlmodel.ext.asyncio.session import AsyncSession
+from collections import Counter
+import argparse
+import asyncio
+import csv
+import os
+
+
+async def read_lines(path: pathlib.Path):
+    # read as bytes so a line that isn't UTF-8 is reported like in the API instead of stopping the import halfway
+    with open(path, "rb") as file:
+        for line in file:
+            yield decode_line(line.rstrip(b"\n"))
+
+
+async def main(path: pathlib.Path, report_path: pathlib.Path | None, batch_size: int, workers: int):
+    parse = parse_ndjson if path.suffix in (".ndjson", ".jsonl") else parse_csv
+    # nothing else is competing for the cores here so the hashing pool can use all of them
+    hasher = PasswordHasher(kind="process", workers=workers,
+                            queue_limit=workers)
+    totals = Counter()
+    report_file = open(report_path, "w", newline="") if report_path else None
+    writer = csv.DictWriter(report_file, fieldnames=[
+                            "line", "matric_number", "status", "detail"]) if report_file else None
+    if writer:
+        writer.writeheader()
+    try:
+        async with AsyncSession(async_engine, expire_on_commit=False) as session:
+            async for result in import_students(session, parse(read_lines(path)), batch_size=batch_size, hasher=hasher):
+                totals[result["status"]] += 1
+                if writer:
+                    writer.writerow(result)
+                elif result["status"] != "created":
+                    print(f"line {result['line']}: {result['matric_number']} {result['status']} {result['detail'] or ''}")
+    finally:
+        hasher.shutdown()
+        if report_file:
+            report_file.close()
+        await async_engine.dispose()
+    print(", ".join(f"{status}: {count}" for status, count in sorted(totals.items())))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Bulk enrol students from a CSV or NDJSON file")
+    parser.add_argument("path", type=pathlib.Path)
+    parser.add_argument("--report", type=pathlib.Path,
+                        help="write the per-row results to this CSV file")
+    parser.add_argument("--batch-size", type=int,
+                        default=BULK_IMPORT_BATCH_SIZE)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+    asyncio.run(main(args.path, args.report, args.batch_size, args.workers))
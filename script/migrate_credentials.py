@@ -0,0 +1,25 @@
+# Copies the single device each student could register before the credential table existed into it, e.g.
+#   python script/migrate_credentials.py
+# Run it once after deploying the credential table (python -m app.database creates it). It is safe to run again, credentials already copied are skipped
+import sys
+import pathlib
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent))
+from app.database import engine, create_db_and_tables
+from app.models import Credential, Student
+from sqlalchemy import func, select
+from sqlmodel import Session
+
+if __name__ == "__main__":
+    create_db_and_tables()
+    if engine.dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    legacy_credentials = select(Student.credential_id, Student.matric_number, Student.public_key, func.coalesce(Student.sign_count, 0), Student.transports,
+                                func.current_timestamp()).where(Student.credential_id.is_not(None), Student.public_key.is_not(None))
+    statement = insert(Credential).from_select(["credential_id", "matric_number", "public_key", "sign_count", "transports", "created_at"],
+                                               legacy_credentials).on_conflict_do_nothing(index_elements=[Credential.credential_id])
+    with Session(engine) as session:
+        copied = session.exec(statement).rowcount
+        session.commit()
+    print(f"Copied {copied} credential(s) into the credential table.")
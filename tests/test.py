@@ -3,12 +3,23 @@ import sys
 import pathlib
 sys.path.insert(0, str(pathlib.Path(__file__).parent.parent))
 from main import get_session, app
-from app.utils import get_password_hash
-from app.models import Student
-from sqlmodel import SQLModel, create_engine, Session
-from sqlmodel.pool import StaticPool
+from app.database import get_async_session
+from app import crud
+from app.utils import get_password_hash, known_students, revoked_students
+from app.rate_limit import rate_limit_store
+from app.webauthn_functions import authentication_options_cache
+from app.enrolment import registration_writer, enrolment_progress
+from app.attendance import attendance_writer
+from app.models import Student, StudentPydanticModel, Credential, RefreshTokenFamily
+from benchmarks.soft_authenticator import SoftAuthenticator
+from sqlmodel import SQLModel, create_engine, Session, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import NullPool
 from fastapi.testclient import TestClient
 from dotenv import load_dotenv
+from webauthn import base64url_to_bytes
+from webauthn.helpers import bytes_to_base64url
 import pytest
 
 load_dotenv(".env")
@@ -19,26 +30,51 @@ test_access_token = os.getenv("TEST_ACCESS_TOKEN")
 test_refresh_token = os.getenv("TEST_REFRESH_TOKEN")
 
 
+@pytest.fixture(name="db_path")
+def db_path_fixture(tmp_path: pathlib.Path):
+    # The tests seed data through a blocking session while the app reads through aiosqlite, so both engines have to point at the same file
+    return tmp_path / "test.db"
+
+
 @pytest.fixture(name="session")
-def session_fixture():
-    engine = create_engine(
-        "sqlite://",
-        connect_args={"check_same_thread": False},
-        poolclass=StaticPool
-    )
+def session_fixture(db_path: pathlib.Path):
+    engine = create_engine(f"sqlite:///{db_path}")
     SQLModel.metadata.create_all(engine)
     with Session(engine) as session:
         yield session
 
 
 @pytest.fixture(name="client")
-def client_fixture(session: Session):
+def client_fixture(session: Session, db_path: pathlib.Path):
+    # NullPool because every TestClient request can run on a different event loop and aiosqlite connections can't be shared across loops
+    async_engine = create_async_engine(
+        f"sqlite+aiosqlite:///{db_path}", poolclass=NullPool)
+
     def get_session_override():
         return session
 
+    async def get_async_session_override():
+        async with AsyncSession(async_engine, expire_on_commit=False) as async_session:
+            yield async_session
+
+    # every test gets a fresh database so whatever the in-process caches remember from the previous test is stale
+    crud.student_cache.clear()
+    crud.lecture_session_cache.clear()
+    known_students.clear()
+    revoked_students.clear()
+    rate_limit_store.reset()
+    authentication_options_cache.clear()
+    crud.credential_cache.clear()
+    enrolment_progress.reset()
     app.dependency_overrides[get_session] = get_session_override
+    app.dependency_overrides[get_async_session] = get_async_session_override
+    # the registration writer opens its own sessions, outside of the dependencies
+    default_session_factories = registration_writer.session_factory, attendance_writer.session_factory
+    registration_writer.session_factory = attendance_writer.session_factory = lambda: AsyncSession(
+        async_engine, expire_on_commit=False)
     client = TestClient(app)
     yield client
+    registration_writer.session_factory, attendance_writer.session_factory = default_session_factories
     app.dependency_overrides.clear()
 
 
@@ -55,6 +91,80 @@ def test_create_student(client: TestClient):
         "matric_number": "21CG029882", "password": "sike, you thought you were getting the original thing"}
 
 
+def test_create_student_already_exists(session: Session, client: TestClient):
+    student = Student(
+        matric_number="21CG029882", password=get_password_hash("password"))
+
+    session.add(student)
+    session.commit()
+
+    response = client.post(
+        url="/create-student",
+        headers={"Authorization": f"Bearer {authorization_token_for_create_student}"},
+        json={"matric_number": "21cg029882", "password": "password"}
+    )
+    assert response.status_code == 409
+
+
+def test_create_students_csv(session: Session, client: TestClient):
+    session.add(Student(matric_number="21CG029882", password=get_password_hash("password")))
+    session.commit()
+    body = "matric_number,password\n21cg029882,password\n21cg029890,password\n21CG029890,password\nabc,password\n21cg029891,password\n"
+
+    response = client.post(
+        url="/create-students",
+        headers={"Authorization": f"Bearer {authorization_token_for_create_student}",
+                 "Content-Type": "text/csv"},
+        content=body
+    )
+
+    assert response.status_code == 200
+    statuses = [(row["line"], row["status"]) for row in response.json()["results"]]
+    assert statuses == [(2, "exists"), (3, "created"), (4, "duplicate"), (5, "invalid"), (6, "created")]
+    assert session.get(Student, "21CG029891") is not None
+
+
+def test_create_students_not_utf8(client: TestClient):
+    # a spreadsheet exported as Latin-1, the é is a single 0xe9 byte
+    body = "matric_number,password\n21cg029893,password\n21cg029894,caf\u00e9\n".encode("latin-1")
+
+    response = client.post(
+        url="/create-students",
+        headers={"Authorization": f"Bearer {authorization_token_for_create_student}",
+                 "Content-Type": "text/csv"},
+        content=body
+    )
+
+    assert response.status_code == 200
+    statuses = [(row["line"], row["status"]) for row in response.json()["results"]]
+    assert statuses == [(2, "created"), (3, "invalid")]
+    assert "UTF-8" in response.json()["results"][1]["detail"]
+
+    response = client.post(
+        url="/create-students",
+        headers={"Authorization": f"Bearer {authorization_token_for_create_student}",
+                 "Content-Type": "application/x-ndjson"},
+        content='{"matric_number": "21cg029895", "password": "caf\u00e9"}\n'.encode("latin-1")
+    )
+    assert response.json()["summary"] == {"invalid": 1}
+
+
+def test_create_students_ndjson(client: TestClient):
+    body = '{"matric_number": "21cg029892", "password": "password"}\nnot json\n'
+
+    response = client.post(
+        url="/create-students",
+        headers={"Authorization": f"Bearer {authorization_token_for_create_student}",
+                 "Content-Type": "application/x-ndjson"},
+        content=body
+    )
+
+    assert response.status_code == 200
+    statuses = [row["status"] for row in response.json()["results"]]
+    assert statuses == ["created", "invalid"]
+    assert response.json()["summary"] == {"created": 1, "invalid": 1}
+
+
 def test_verify_student(session: Session, client: TestClient):
     student = Student(
         matric_number="21CG029883", password=get_password_hash("password"), device_registered=True)
@@ -105,6 +215,112 @@ def test_verify_student_unregistered_device(client: TestClient, session: Session
 
     assert response.status_code == 403
 
+def test_verify_student_hashing_pool_saturated(session: Session, client: TestClient, monkeypatch: pytest.MonkeyPatch):
+    from app.hashing import password_hasher
+    student = Student(
+        matric_number="21CG029883", password=get_password_hash("password"), device_registered=True)
+
+    session.add(student)
+    session.commit()
+    # pretend every slot in the hashing queue is already taken
+    monkeypatch.setattr(password_hasher, "queue_limit", 0)
+
+    response = client.post(
+        "/verify-student",
+        json={"matric_number": "21cg029883", "password": "password"}
+    )
+
+    assert response.status_code == 503
+    assert "retry-after" in response.headers
+    assert client.get("/metrics/hashing").json()["rejected"] >= 1
+
+
+def test_verify_student_rate_limited_per_matric_number(session: Session, client: TestClient, monkeypatch: pytest.MonkeyPatch):
+    from app.hashing import password_hasher
+    from app.rate_limit import login_rate_limit
+    monkeypatch.setattr(login_rate_limit, "burst", 2)
+    session.add(Student(matric_number="21CG029883",
+                password=get_password_hash("password"), device_registered=True))
+    session.commit()
+
+    for _ in range(2):
+        response = client.post(
+            "/verify-student", json={"matric_number": "21cg029883", "password": "guess"})
+        assert response.status_code == 401
+    hashes_before = password_hasher.submitted
+    response = client.post(
+        "/verify-student", json={"matric_number": "21cg029883", "password": "password"})
+
+    assert response.status_code == 429
+    assert int(response.headers["retry-after"]) >= 1
+    # the rejection happens before the password is even looked at
+    assert password_hasher.submitted == hashes_before
+    # other students have their own bucket
+    response = client.post(
+        "/verify-student", json={"matric_number": "21cg029882", "password": "password"})
+    assert response.status_code == 401
+
+
+def test_expensive_endpoints_concurrency_cap(client: TestClient, monkeypatch: pytest.MonkeyPatch):
+    from app.rate_limit import expensive_requests
+    monkeypatch.setattr(expensive_requests, "limit", 0)
+
+    response = client.post(
+        "/verify-student", json={"matric_number": "21cg029883", "password": "password"})
+
+    assert response.status_code == 429
+    assert client.get("/metrics/rate-limits").json()["expensive_requests"]["rejected"] >= 1
+
+
+def test_verify_student_upgrades_hash_to_new_policy(session: Session, client: TestClient, monkeypatch: pytest.MonkeyPatch):
+    from app import utils
+    old_policy = utils.build_password_context(scheme="bcrypt", bcrypt_rounds=4)
+    student = Student(
+        matric_number="21CG029883", password=old_policy.hash("password"), device_registered=True)
+
+    session.add(student)
+    session.commit()
+    # cheap argon2 settings, the point is only that they differ from what the stored hash was made with
+    monkeypatch.setattr(utils, "pwd_context", utils.build_password_context(
+        scheme="argon2", argon2_time_cost=1, argon2_memory_cost=1024))
+
+    response = client.post(
+        "/verify-student",
+        json={"matric_number": "21cg029883", "password": "password"}
+    )
+
+    assert response.status_code == 200
+    session.expire_all()
+    upgraded_hash = session.get(Student, "21CG029883").password
+    assert upgraded_hash.startswith("$argon2id$v=19$m=1024,t=1")
+    assert utils.verify_password("password", upgraded_hash)
+    # the next login verifies against the upgraded hash and leaves it alone
+    client.post("/verify-student",
+                json={"matric_number": "21cg029883", "password": "password"})
+    session.expire_all()
+    assert session.get(Student, "21CG029883").password == upgraded_hash
+
+
+def test_verify_student_wrong_password_keeps_old_hash(session: Session, client: TestClient, monkeypatch: pytest.MonkeyPatch):
+    from app import utils
+    old_hash = utils.build_password_context(
+        scheme="bcrypt", bcrypt_rounds=4).hash("password")
+    session.add(Student(matric_number="21CG029883",
+                password=old_hash, device_registered=True))
+    session.commit()
+    monkeypatch.setattr(utils, "pwd_context", utils.build_password_context(
+        scheme="argon2", argon2_time_cost=1, argon2_memory_cost=1024))
+
+    response = client.post(
+        "/verify-student",
+        json={"matric_number": "21cg029883", "password": "wrong"}
+    )
+
+    assert response.status_code == 401
+    session.expire_all()
+    assert session.get(Student, "21CG029883").password == old_hash
+
+
 def test_generate_registration_options(session: Session, client: TestClient):
     student = Student(
         matric_number="21CG029882", password=get_password_hash("password"))
@@ -118,6 +334,102 @@ def test_generate_registration_options(session: Session, client: TestClient):
         headers={"Authorization": f"Bearer {authorization_token_for_create_student}"}
     )
     assert response.status_code == 200
+    # the options are sent as a JSON object, not as a string holding the JSON
+    assert response.headers["content-type"] == "application/json"
+    assert response.json()["user"]["name"] == "21CG029882"
+
+
+def test_verify_registration_response_without_pending_challenge(session: Session, client: TestClient):
+    response = client.post(
+        url="/verify-registration-response?matric_number=21CG029884",
+        headers={"Authorization": f"Bearer {authorization_token_for_create_student}"},
+        json={}
+    )
+    assert response.status_code == 400
+
+
+def test_in_memory_challenge_store_expires_and_pops_once():
+    import asyncio
+    from app.challenge_store import InMemoryChallengeStore
+
+    async def scenario():
+        store = InMemoryChallengeStore(ttl=60, max_entries=2)
+        await store.put("authentication:A", b"a")
+        await store.put("authentication:B", b"b", ttl=-1)
+        assert await store.pop("authentication:A") == b"a"
+        assert await store.pop("authentication:A") is None
+        assert await store.pop("authentication:B") is None
+        for key in ("C", "D", "E"):
+            await store.put(key, key.encode())
+        # the least recently used entry is evicted once the store is full
+        assert await store.pop("C") is None
+        assert await store.pop("E") == b"E"
+
+    asyncio.run(scenario())
+
+
+def test_database_challenge_store_pops_once(db_path: pathlib.Path, session: Session):
+    import asyncio
+    from app.challenge_store import DatabaseChallengeStore
+
+    async def scenario():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{db_path}")
+        store = DatabaseChallengeStore(engine)
+        await store.put("registration:A", b"first")
+        await store.put("registration:A", b"second")
+        await store.put("registration:B", b"b", ttl=-1)
+        assert await store.pop("registration:A") == b"second"
+        assert await store.pop("registration:A") is None
+        assert await store.pop("registration:B") is None
+        await engine.dispose()
+
+    asyncio.run(scenario())
+
+
+def test_challenge_store_get_and_put_many(db_path: pathlib.Path, session: Session):
+    import asyncio
+    from app.challenge_store import InMemoryChallengeStore, DatabaseChallengeStore
+
+    async def scenario():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{db_path}")
+        for store in (InMemoryChallengeStore(ttl=60), DatabaseChallengeStore(engine)):
+            challenges = {f"lecture:1:{index}": os.urandom(32) for index in range(700)}
+            await store.put_many(challenges, ttl=60)
+            await store.put_many({"lecture:2:A": b"closed"}, ttl=-1)
+            # get leaves the challenge there for the verify request
+            assert await store.get("lecture:1:699") == challenges["lecture:1:699"]
+            assert await store.pop("lecture:1:699") == challenges["lecture:1:699"]
+            assert await store.get("lecture:1:699") is None
+            assert await store.get("lecture:1:0") == challenges["lecture:1:0"]
+            assert await store.get("lecture:2:A") is None
+        await engine.dispose()
+
+    asyncio.run(scenario())
+
+
+def test_rate_limit_stores_refill_and_share_buckets(db_path: pathlib.Path, session: Session):
+    import asyncio
+    from app.rate_limit import DatabaseRateLimitStore, InMemoryRateLimitStore
+
+    now = [0.0]
+    memory_store = InMemoryRateLimitStore(clock=lambda: now[0])
+
+    async def scenario():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{db_path}")
+        # two stores on one database stand in for two workers
+        first_worker, second_worker = DatabaseRateLimitStore(engine), DatabaseRateLimitStore(engine)
+        assert await first_worker.take("login:A", 2, 0.001) == 0
+        assert await second_worker.take("login:A", 2, 0.001) == 0
+        assert await first_worker.take("login:A", 2, 0.001) > 0
+        assert await second_worker.take("login:B", 2, 0.001) == 0
+        await engine.dispose()
+
+        assert await memory_store.take("login:A", 1, 0.5) == 0
+        assert await memory_store.take("login:A", 1, 0.5) == pytest.approx(2)
+        now[0] += 2
+        assert await memory_store.take("login:A", 1, 0.5) == 0
+
+    asyncio.run(scenario())
 
 
 # def test_verify_registration_options(session: Session, client: TestClient):
@@ -169,35 +481,304 @@ def test_generate_registration_options(session: Session, client: TestClient):
 #     assert response.json() == {"verified": True}
 
 
+def register_soft_authenticator(client: TestClient, matric_number: str) -> SoftAuthenticator:
+    admin_headers = {
+        "Authorization": f"Bearer {authorization_token_for_create_student}"}
+    authenticator = SoftAuthenticator(rp_id=os.getenv(
+        "RP_ID"), origin=os.getenv("WEBAUTHN_ORIGIN"))
+    options = client.get(
+        url=f"/generate-registration-options?matric_number={matric_number}", headers=admin_headers).json()
+    response = client.post(url=f"/verify-registration-response?matric_number={matric_number}",
+                           headers=admin_headers, json=authenticator.register(options))
+    assert response.status_code == 200
+    assert response.json() == {"verified": True}
+    return authenticator
+
+
+def test_registration_and_authentication_ceremony(session: Session, client: TestClient):
+    session.add(Student(matric_number="21CG029882",
+                password=get_password_hash("password")))
+    session.commit()
+    authenticator = register_soft_authenticator(client, "21CG029882")
+
+    response = client.post(url="/verify-student",
+                           json={"matric_number": "21CG029882", "password": "password"})
+    assert response.status_code == 200
+    headers = {"Authorization": "Bearer " + response.json()["access_token"]}
+    for _ in range(2):
+        options = client.get(
+            url="/generate-authentication-options", headers=headers).json()
+        assert authenticator.allowed_by(options)
+        response = client.post(url="/verify-authentication-response",
+                               headers=headers, json=authenticator.authenticate(options))
+        assert response.status_code == 200
+        assert response.json() == {"verified": True}
+    session.expire_all()
+    db_credential = session.exec(select(Credential).where(
+        Credential.credential_id == authenticator.credential_id)).one()
+    assert db_credential.sign_count == 2 and db_credential.last_used_at is not None
+
+
+def test_authentication_challenge_cannot_be_replayed(session: Session, client: TestClient):
+    session.add(Student(matric_number="21CG029882",
+                password=get_password_hash("password")))
+    session.commit()
+    authenticator = register_soft_authenticator(client, "21CG029882")
+    # registering a device revokes the tokens issued before it, so this needs a fresh login
+    response = client.post(url="/verify-student",
+                           json={"matric_number": "21CG029882", "password": "password"})
+    headers = {"Authorization": "Bearer " + response.json()["access_token"]}
+    options = client.get(
+        url="/generate-authentication-options", headers=headers).json()
+    credential = authenticator.authenticate(options)
+    assert client.post(url="/verify-authentication-response",
+                       headers=headers, json=credential).status_code == 200
+    response = client.post(
+        url="/verify-authentication-response", headers=headers, json=credential)
+    assert response.status_code == 400
+
+
+def test_webauthn_verifier_batches_and_isolates_failures():
+    import asyncio
+    from app.verification import WebAuthnVerifier
+    from fastapi import HTTPException
+    rp_id, origin = os.getenv("RP_ID"), os.getenv("WEBAUTHN_ORIGIN")
+    authenticators = [SoftAuthenticator(rp_id=rp_id, origin=origin) for _ in range(6)]
+    challenges = [os.urandom(32) for _ in authenticators]
+
+    async def scenario():
+        verifier = WebAuthnVerifier(kind="process", workers=2, max_batch_size=100, max_delay_ms=20)
+        try:
+            assertions = [verifier.verify_authentication(credential=authenticator.authenticate({"challenge": bytes_to_base64url(challenge)}),
+                                                         authentication_challenge=challenge if index != 3 else os.urandom(32),
+                                                         public_key=authenticator.cose_public_key(), sign_count=0, RP_ID=rp_id, WEBAUTHN_ORIGIN=origin)
+                          for index, (authenticator, challenge) in enumerate(zip(authenticators, challenges))]
+            results = await asyncio.gather(*assertions, return_exceptions=True)
+        finally:
+            verifier.shutdown()
+        # the one signed over the wrong challenge fails on its own, the rest of its batch is verified
+        assert [result for index, result in enumerate(results) if index != 3] == [1] * 5
+        assert isinstance(results[3], HTTPException) and results[3].status_code == 500
+        assert verifier.batches == 1
+        assert verifier.stats()["verified"] == 5 and verifier.stats()["failed"] == 1
+
+    asyncio.run(scenario())
+
+
+def test_authentication_options_template_matches_options_to_json():
+    from webauthn import options_to_json
+    from app.webauthn_functions import generate_authentication_options_functions, generate_authentication_options_json
+    credentials, challenge = ((os.urandom(32), "internal,hybrid"), (os.urandom(16), None)), os.urandom(32)
+
+    expected = options_to_json(generate_authentication_options_functions(
+        RP_ID="localhost", credentials=credentials, authentication_challenge=challenge)).encode()
+
+    assert generate_authentication_options_json(
+        "localhost", "21cg029882", credentials, challenge) == expected
+    # the second call is served from the template, with only the challenge changed
+    hits = authentication_options_cache.hits
+    other_challenge = os.urandom(32)
+    assert generate_authentication_options_json("localhost", "21CG029882", credentials, other_challenge) == options_to_json(
+        generate_authentication_options_functions(RP_ID="localhost", credentials=credentials, authentication_challenge=other_challenge)).encode()
+    assert authentication_options_cache.hits == hits + 1
+
+
+def login_headers(client: TestClient, matric_number: str) -> dict:
+    response = client.post(url="/verify-student",
+                           json={"matric_number": matric_number, "password": "password"})
+    return {"Authorization": "Bearer " + response.json()["access_token"]}
+
+
+def test_every_registered_device_can_authenticate(session: Session, client: TestClient):
+    session.add(Student(matric_number="21CG029882",
+                password=get_password_hash("password")))
+    session.commit()
+    old_phone = register_soft_authenticator(client, "21CG029882")
+    headers = login_headers(client, "21CG029882")
+    client.get(url="/generate-authentication-options", headers=headers)
+    # the new phone is added next to the old one, and the cached options pick it up
+    new_phone = register_soft_authenticator(client, "21CG029882")
+    headers = login_headers(client, "21CG029882")
+
+    for authenticator in (old_phone, new_phone):
+        options = client.get(
+            url="/generate-authentication-options", headers=headers).json()
+        allowed = [base64url_to_bytes(descriptor["id"])
+                   for descriptor in options["allowCredentials"]]
+        assert allowed == [old_phone.credential_id, new_phone.credential_id]
+        response = client.post(url="/verify-authentication-response",
+                               headers=headers, json=authenticator.authenticate(options))
+        assert response.status_code == 200
+    # the same device can't be registered twice
+    options = client.get(url="/generate-registration-options?matric_number=21CG029882",
+                         headers={"Authorization": f"Bearer {authorization_token_for_create_student}"}).json()
+    assert [base64url_to_bytes(descriptor["id"]) for descriptor in options["excludeCredentials"]] == [
+        old_phone.credential_id, new_phone.credential_id]
+    response = client.post(url="/verify-registration-response?matric_number=21CG029882",
+                           headers={"Authorization": f"Bearer {authorization_token_for_create_student}"}, json=new_phone.register(options))
+    assert response.status_code == 409
+
+
+def test_another_students_device_is_rejected(session: Session, client: TestClient):
+    session.add(Student(matric_number="21CG029882",
+                password=get_password_hash("password")))
+    session.add(Student(matric_number="21CG029883",
+                password=get_password_hash("password")))
+    session.commit()
+    register_soft_authenticator(client, "21CG029882")
+    friends_phone = register_soft_authenticator(client, "21CG029883")
+    headers = login_headers(client, "21CG029882")
+
+    options = client.get(
+        url="/generate-authentication-options", headers=headers).json()
+    response = client.post(url="/verify-authentication-response",
+                           headers=headers, json=friends_phone.authenticate(options))
+
+    assert response.status_code == 401
+
+
+def test_discoverable_login(session: Session, client: TestClient):
+    session.add(Student(matric_number="21CG029882",
+                password=get_password_hash("password")))
+    session.commit()
+    authenticator = register_soft_authenticator(client, "21CG029882")
+    user_id = session.exec(select(Student.user_id).where(
+        Student.matric_number == "21CG029882")).one()
+
+    options = client.get(
+        url="/generate-discoverable-authentication-options").json()
+    assert options["allowCredentials"] == []
+    response = client.post(url="/verify-discoverable-authentication-response",
+                           json=authenticator.authenticate(options, user_handle=str(user_id).encode()))
+
+    assert response.status_code == 200
+    headers = {"Authorization": "Bearer " + response.json()["access_token"]}
+    assert client.get("/reports/me", headers=headers).status_code == 200
+    # the challenge was used up
+    response = client.post(url="/verify-discoverable-authentication-response",
+                           json=authenticator.authenticate(options, user_handle=str(user_id).encode()))
+    assert response.status_code == 400
+
+
+def test_delete_student_credential(session: Session, client: TestClient):
+    from webauthn.helpers import bytes_to_base64url
+    session.add(Student(matric_number="21CG029882",
+                password=get_password_hash("password")))
+    session.commit()
+    lost_phone = register_soft_authenticator(client, "21CG029882")
+    admin_headers = {
+        "Authorization": f"Bearer {authorization_token_for_create_student}"}
+
+    response = client.delete(
+        url=f"/students/21CG029882/credentials/{bytes_to_base64url(lost_phone.credential_id)}", headers=admin_headers)
+
+    assert response.status_code == 200
+    session.expire_all()
+    assert session.get(Student, "21CG029882").device_registered is False
+    assert client.delete(url=f"/students/21CG029882/credentials/{bytes_to_base64url(lost_phone.credential_id)}",
+                         headers=admin_headers).status_code == 404
+
+
+def test_registration_is_only_written_once_verified(session: Session, client: TestClient):
+    session.add(Student(matric_number="21CG029882",
+                password=get_password_hash("password")))
+    session.commit()
+    admin_headers = {"Authorization": f"Bearer {authorization_token_for_create_student}"}
+    authenticator = SoftAuthenticator(rp_id=os.getenv("RP_ID"), origin=os.getenv("WEBAUTHN_ORIGIN"))
+    for _ in range(3):
+        options = client.get(url="/generate-registration-options?matric_number=21CG029882", headers=admin_headers).json()
+    # asking for options again and again doesn't touch the student
+    session.expire_all()
+    assert session.get(Student, "21CG029882").user_id is None
+
+    response = client.post(url="/verify-registration-response?matric_number=21CG029882",
+                           headers=admin_headers, json=authenticator.register(options))
+
+    assert response.status_code == 200
+    session.expire_all()
+    student = session.get(Student, "21CG029882")
+    assert student.device_registered and str(student.user_id).encode() == base64url_to_bytes(options["user"]["id"])
+    progress = client.get("/enrolment/progress", headers=admin_headers).json()
+    assert progress["students"] == 1 and progress["students_with_a_device"] == 1 and progress["percent_enrolled"] == 100.0
+    assert progress["ceremonies_started"] == 3 and progress["registered"] == 1 and progress["registrations_per_minute"] > 0
+
+
+def test_registration_writer_batches_registrations(db_path: pathlib.Path, session: Session):
+    import asyncio
+    import uuid
+    from app.enrolment import RegistrationWriter, VerifiedRegistration
+    session.add(Student(matric_number="21CG000001", password="x"))
+    session.add(Student(matric_number="21CG000002", password="x"))
+    session.commit()
+
+    def registration(matric_number: str, user_id: uuid.UUID, credential_id: bytes) -> VerifiedRegistration:
+        return VerifiedRegistration(matric_number=matric_number, user_id=user_id, credential_id=credential_id, public_key=b"key", sign_count=0, transports="internal")
+
+    first_user_id, second_user_id = uuid.uuid4(), uuid.uuid4()
+
+    async def scenario():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{db_path}")
+        writer = RegistrationWriter(max_batch_size=10, max_delay_ms=10,
+                                    session_factory=lambda: AsyncSession(engine, expire_on_commit=False))
+        outcomes = await asyncio.gather(writer.register(registration("21CG000001", first_user_id, b"phone")),
+                                        writer.register(registration("21CG000001", first_user_id, b"tablet")),
+                                        # a ceremony started alongside the first one got a different user handle
+                                        writer.register(registration("21CG000001", second_user_id, b"laptop")),
+                                        writer.register(registration("21CG000002", second_user_id, b"phone")),
+                                        writer.register(registration("21CG000003", uuid.uuid4(), b"watch")))
+        assert outcomes == ["registered", "registered", "user_handle_conflict", "credential_already_registered", "student_not_found"]
+        assert await writer.register(registration("21CG000001", first_user_id, b"tablet")) == "credential_already_registered"
+        assert writer.stats()["batches"] == 2
+        await engine.dispose()
+
+    asyncio.run(scenario())
+    assert session.get(Student, "21CG000001").user_id == first_user_id
+    assert session.get(Student, "21CG000002").device_registered is False
+    assert len(session.exec(select(Credential)).all()) == 2
+
+
 def test_refresh(session: Session, client: TestClient):
     student = Student(
-        matric_number="21CG029882", password=get_password_hash("password"))
+        matric_number="21CG029882", password=get_password_hash("password"), device_registered=True)
 
     session.add(student)
     session.commit()
-    response = client.post(
-        "/refresh",
-        json={"refresh_token": test_refresh_token},
-        headers={"Authorization": "Bearer " + test_access_token}
-    )
+    refresh_token = client.post(url="/verify-student",
+                                json={"matric_number": "21CG029882", "password": "password"}).json()["refresh_token"]
+    # the access token isn't needed any more, so an expired one doesn't mean logging in again
+    response = client.post("/refresh", json={"refresh_token": refresh_token})
 
     assert response.status_code == 200
     assert "new_access_token" in response.json() and "token_type" in response.json()
+    # every refresh hands out the refresh token to use next time
+    next_refresh_token = response.json()["refresh_token"]
+    assert next_refresh_token != refresh_token
+    assert client.post("/refresh", json={"refresh_token": next_refresh_token}).status_code == 200
 
 
-def test_refresh_incorrect_access_token(session: Session, client: TestClient):
+def test_refresh_token_reuse_revokes_the_family(session: Session, client: TestClient):
     student = Student(
-        matric_number="21CG029882", password=get_password_hash("password"))
+        matric_number="21CG029882", password=get_password_hash("password"), device_registered=True)
 
     session.add(student)
     session.commit()
-    response = client.post(
-        "/refresh",
-        json={"refresh_token": test_refresh_token},
-        headers={"Authorization": "Bearer k" + test_access_token}
-    )
+    stolen_refresh_token = client.post(url="/verify-student",
+                                       json={"matric_number": "21CG029882", "password": "password"}).json()["refresh_token"]
+    other_device_refresh_token = client.post(url="/verify-student",
+                                             json={"matric_number": "21CG029882", "password": "password"}).json()["refresh_token"]
+    next_refresh_token = client.post("/refresh", json={"refresh_token": stolen_refresh_token}).json()["refresh_token"]
 
-    assert response.status_code == 401
+    # the copy is used after the student already refreshed with it, so neither of them can refresh with this login any more
+    assert client.post("/refresh", json={"refresh_token": stolen_refresh_token}).status_code == 401
+    assert client.post("/refresh", json={"refresh_token": next_refresh_token}).status_code == 401
+    # the student's other login is a different family and carries on
+    response = client.post("/refresh", json={"refresh_token": other_device_refresh_token})
+    assert response.status_code == 200
+
+    response = client.post("/logout", json={"refresh_token": response.json()["refresh_token"]})
+    assert response.json() == {"revoked": True}
+    session.expire_all()
+    assert session.exec(select(RefreshTokenFamily.revoked_at).where(RefreshTokenFamily.revoked_at == None)).all() == []  # noqa: E711
 
 
 def test_refresh_incorrect_refresh_token(session: Session, client: TestClient):
@@ -213,5 +794,563 @@ def test_refresh_incorrect_refresh_token(session: Session, client: TestClient):
     )
 
     assert response.status_code == 401
+    # refresh tokens from before the families existed can't be revoked, so they aren't accepted
+    response = client.post("/refresh", json={"refresh_token": test_refresh_token})
+    assert response.status_code == 401
+
+
+def test_refresh_after_tokens_revoked(session: Session, client: TestClient):
+    session.add(Student(matric_number="21CG029882",
+                password=get_password_hash("password"), device_registered=True))
+    session.commit()
+    refresh_token = client.post(url="/verify-student",
+                                json={"matric_number": "21CG029882", "password": "password"}).json()["refresh_token"]
+    response = client.post(
+        url="/revoke-student-tokens?matric_number=21cg029882",
+        headers={"Authorization": f"Bearer {authorization_token_for_create_student}"}
+    )
+    assert response.status_code == 200
+    # revoked in the database as well, so a worker that didn't handle the revocation refuses it too
+    revoked_students.clear()
+
+    response = client.post("/refresh", json={"refresh_token": refresh_token})
+
+    assert response.status_code == 401
+
+
+def test_revoked_access_token_is_rejected_by_every_worker(session: Session, client: TestClient):
+    session.add(Student(matric_number="21CG029882",
+                password=get_password_hash("password"), device_registered=True))
+    session.commit()
+    access_token = client.post(url="/verify-student",
+                               json={"matric_number": "21CG029882", "password": "password"}).json()["access_token"]
+    headers = {"Authorization": f"Bearer {access_token}"}
+    assert client.get("/lecture-sessions/999999/recording", headers=headers).status_code == 404
+    client.post(url="/revoke-student-tokens?matric_number=21cg029882",
+                headers={"Authorization": f"Bearer {authorization_token_for_create_student}"})
+    # what another worker would see: nothing cached, only the database
+    revoked_students.clear()
+
+    assert client.get("/lecture-sessions/999999/recording", headers=headers).status_code == 401
+    # logging in again works
+    access_token = client.post(url="/verify-student",
+                               json={"matric_number": "21CG029882", "password": "password"}).json()["access_token"]
+    assert client.get("/lecture-sessions/999999/recording", headers={"Authorization": f"Bearer {access_token}"}).status_code == 404
+
+
+def test_refresh_token_families_are_purged(db_path: pathlib.Path, session: Session):
+    import asyncio
+    from datetime import timedelta
+    from app.refresh_tokens import RefreshTokenFamilies
+
+    async def scenario():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{db_path}")
+        families = RefreshTokenFamilies(lifetime=timedelta(minutes=-1), purge_after=timedelta(0))
+        async with AsyncSession(engine, expire_on_commit=False) as async_session:
+            await families.start(async_session, "21CG029882")
+            await RefreshTokenFamilies().start(async_session, "21CG029883")
+            assert await families.purge_expired(async_session) == 1
+        await engine.dispose()
+
+    asyncio.run(scenario())
+    assert session.exec(select(RefreshTokenFamily.matric_number)).all() == ["21CG029883"]
+
+
+def test_access_token_needs_no_database_lookup(client: TestClient):
+    # the student in the token doesn't exist in the database but the token's signature and expiry are valid, so it is trusted
+    # and the request gets as far as finding out there is no such recording
+    response = client.get("/lecture-sessions/999999/recording",
+                          headers={"Authorization": "Bearer " + test_access_token})
+
+    assert response.status_code == 404
+
+
+def test_access_token_existence_check(client: TestClient, monkeypatch: pytest.MonkeyPatch):
+    import app.utils
+    monkeypatch.setattr(app.utils, "TRUST_TOKEN_CLAIMS", False)
+    response = client.get("/lecture-sessions/999999/recording",
+                          headers={"Authorization": "Bearer " + test_access_token})
+
+    assert response.status_code == 401
+
+
+def generate_token_key(keys_dir: pathlib.Path, kid: str):
+    import subprocess
+    subprocess.run([sys.executable, "script/generate_token_key.py", "--keys-dir", str(keys_dir), "--kid", kid],
+                   cwd=pathlib.Path(__file__).parent.parent, check=True, capture_output=True)
+
+
+def test_es256_token_key_rotation(tmp_path: pathlib.Path):
+    from app.token_keys import load_token_keys
+    from jose import JWTError, jwt
+    generate_token_key(tmp_path, "2026-01")
+    old_keys = load_token_keys("ES256", str(tmp_path), "2026-01", "testsecret")
+    old_token = old_keys.encode({"sub": "access|21CG029882"})
+    assert jwt.get_unverified_header(old_token) == {"alg": "ES256", "typ": "JWT", "kid": "2026-01"}
+
+    generate_token_key(tmp_path, "2026-02")
+    keys = load_token_keys("ES256", str(tmp_path), "2026-02", "testsecret")
+
+    # tokens signed with the previous key keep working until it is removed, and so do the HS256 ones without a kid
+    assert keys.decode(old_token)["sub"] == "access|21CG029882"
+    assert keys.decode(keys.encode({"sub": "x"}))["sub"] == "x"
+    assert keys.decode(test_access_token)["sub"] == "access|21CG029882"
+    assert [key["kid"] for key in keys.jwks()["keys"]] == ["2026-01", "2026-02"]
+    assert all("d" not in key for key in keys.jwks()["keys"])
+    (tmp_path / "2026-01.pem").unlink()
+    with pytest.raises(JWTError):
+        load_token_keys("ES256", str(tmp_path), "2026-02", "testsecret").decode(old_token)
+
+
+def test_token_with_malformed_kid_is_rejected(client: TestClient):
+    from app.token_keys import get_token_keys
+    from jose import JWTError
+    import base64
+    import json
+    header = base64.urlsafe_b64encode(json.dumps({"alg": "HS256", "typ": "JWT", "kid": ["x"]}).encode()).rstrip(b"=").decode()
+    token = header + test_access_token[test_access_token.index("."):]
+    with pytest.raises(JWTError):
+        get_token_keys().decode(token)
+    # a 401 like any other bad token, not a 500
+    response = client.get("/generate-authentication-options", headers={"Authorization": "Bearer " + token})
+    assert response.status_code == 401
+
+
+def test_jwks_lets_other_services_validate_access_tokens(session: Session, client: TestClient, tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch):
+    import app.token_keys
+    from jose import jwt
+    assert client.get("/.well-known/jwks.json").json() == {"keys": []}
+    generate_token_key(tmp_path, "2026-01")
+    monkeypatch.setattr(app.token_keys, "token_keys", app.token_keys.load_token_keys(
+        "ES256", str(tmp_path), "2026-01", os.getenv("SECRET_KEY")))
+    session.add(Student(matric_number="21CG029882", password=get_password_hash("password"), device_registered=True))
+    session.commit()
+
+    tokens = client.post("/verify-student", json={"matric_number": "21CG029882", "password": "password"}).json()
+    jwks = client.get("/.well-known/jwks.json").json()
+
+    # all another service needs is the published key set
+    assert jwt.decode(tokens["access_token"], jwks, algorithms=["ES256"])["sub"] == "access|21CG029882"
+    response = client.post("/refresh", json={"refresh_token": tokens["refresh_token"]},
+                           headers={"Authorization": "Bearer " + tokens["access_token"]})
+    assert response.status_code == 200
+
+
+def test_student_cache_write_through(db_path: pathlib.Path, session: Session):
+    import asyncio
+    from app.models import StudentUpdateModel
+
+    async def scenario():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{db_path}")
+        async with AsyncSession(engine, expire_on_commit=False) as async_session:
+            await crud.async_create_student(async_session, StudentPydanticModel(matric_number="21cg029885", password="password"))
+            hits = crud.student_cache.hits
+            snapshot = await crud.async_get_student_snapshot(async_session, "21cg029885")
+            assert snapshot.sign_count is None
+            assert crud.student_cache.hits == hits + 1
+
+            await crud.async_update_student(async_session, "21cg029885", StudentUpdateModel(sign_count=4))
+            snapshot = await crud.async_get_student_snapshot(async_session, "21CG029885")
+            assert snapshot.sign_count == 4
+            assert crud.student_cache.hits == hits + 2
+        await engine.dispose()
+
+    asyncio.run(scenario())
+
+
+def test_update_student_sign_count_guard(db_path: pathlib.Path, session: Session):
+    import asyncio
+    from app.models import StudentUpdateModel
+    session.add(Student(matric_number="21CG029886", password="hash", sign_count=3))
+    session.commit()
+
+    async def scenario():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{db_path}")
+        async with AsyncSession(engine, expire_on_commit=False) as async_session:
+            updated = await crud.async_update_student(async_session, "21cg029886", StudentUpdateModel(sign_count=4), expected_sign_count=3)
+            assert updated.sign_count == 4
+            # the counter already moved past 3 so this one lost the race
+            assert await crud.async_update_student(async_session, "21cg029886", StudentUpdateModel(sign_count=5), expected_sign_count=3) is None
+            assert await crud.async_update_student(async_session, "21cg000000", StudentUpdateModel(sign_count=1)) is None
+        await engine.dispose()
+
+    asyncio.run(scenario())
+    session.expire_all()
+    assert session.get(Student, "21CG029886").sign_count == 4
+
+
+def test_credential_sign_count_only_moves_forward(db_path: pathlib.Path, session: Session):
+    import asyncio
+    from app.models import CredentialSnapshot
+    session.add(Student(matric_number="21CG029887", password="hash", device_registered=True))
+    session.add(Student(matric_number="21CG029888", password="hash", device_registered=True))
+    session.commit()
+    counting = Credential(credential_id=b"counting", matric_number="21CG029887", public_key=b"key", sign_count=3, transports="internal")
+    not_counting = Credential(credential_id=b"not-counting", matric_number="21CG029888", public_key=b"key", sign_count=0, transports="internal")
+    session.add(counting)
+    session.add(not_counting)
+    session.commit()
+    # what a worker still has cached after another worker accepted the counts 2 and 3
+    stale = CredentialSnapshot(id=counting.id, credential_id=b"counting", matric_number="21CG029887", public_key=b"key", sign_count=1, transports="internal")
+    not_counting = CredentialSnapshot.from_credential(not_counting)
+
+    async def scenario():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{db_path}")
+        async with AsyncSession(engine, expire_on_commit=False) as async_session:
+            assert await crud.async_update_credential_sign_count(async_session, stale, 4)
+            # a count the database has already seen is refused, whatever the cache says
+            assert not await crud.async_update_credential_sign_count(async_session, stale, 4)
+            assert not await crud.async_update_credential_sign_count(async_session, stale, 2)
+            assert await crud.async_update_credential_sign_count(async_session, not_counting, 0)
+            assert await crud.async_update_credential_sign_count(async_session, not_counting, 0)
+        await engine.dispose()
+
+    asyncio.run(scenario())
+    session.expire_all()
+    assert session.get(Credential, stale.id).sign_count == 4
+
+
+def test_generate_registration_options_unknown_student(client: TestClient):
+    response = client.get(
+        url="/generate-registration-options?matric_number=21CG000000",
+        headers={"Authorization": f"Bearer {authorization_token_for_create_student}"}
+    )
+    assert response.status_code == 404
+
+
+def test_create_lecture_session(client: TestClient):
+    response = client.post(
+        url="/lecture-sessions",
+        headers={"Authorization": f"Bearer {authorization_token_for_create_student}"},
+        json={"course_code": "csc411", "title": "Compilers", "duration_minutes": 90}
+    )
+    assert response.status_code == 200
+    lecture_session = response.json()
+    assert lecture_session["course_code"] == "CSC411"
+
+    response = client.get(
+        url=f"/lecture-sessions/{lecture_session['id']}",
+        headers={"Authorization": "Bearer " + test_access_token}
+    )
+    assert response.status_code == 200
+    assert response.json()["title"] == "Compilers"
+
+
+def test_lecture_check_in_is_a_single_request(session: Session, client: TestClient):
+    for matric_number in ("21CG029882", "21CG029883"):
+        session.add(Student(matric_number=matric_number,
+                    password=get_password_hash("password")))
+    session.commit()
+    authenticator = register_soft_authenticator(client, "21CG029882")
+    admin_headers = {
+        "Authorization": f"Bearer {authorization_token_for_create_student}"}
+    response = client.post(url="/lecture-sessions", headers=admin_headers,
+                           json={"course_code": "CSC411", "roster": ["21cg029882", "21CG029883", "21CG000000"]})
+    assert response.status_code == 200
+    # only the student with a device gets a check-in prepared
+    assert response.json()["prepared_check_ins"] == 1
+    lecture_session_id = response.json()["id"]
+
+    headers = login_headers(client, "21CG029882")
+    lecture_session = client.get(
+        url=f"/lecture-sessions/{lecture_session_id}", headers=headers).json()
+    assert lecture_session["course_code"] == "CSC411"
+    options = lecture_session["authentication_options"]
+    assert authenticator.allowed_by(options)
+    # asking again before checking in hands out the same challenge
+    assert client.get(url=f"/lecture-sessions/{lecture_session_id}",
+                      headers=headers).json()["authentication_options"] == options
+    credential = authenticator.authenticate(options)
+    response = client.post(url=f"/verify-authentication-response?lecture_session_id={lecture_session_id}",
+                           headers=headers, json=credential)
+    assert response.status_code == 200
+    assert response.json() == {"verified": True,
+                               "checked_in": True, "already_checked_in": False}
+    # the challenge is used up
+    assert client.post(url=f"/verify-authentication-response?lecture_session_id={lecture_session_id}",
+                       headers=headers, json=credential).status_code == 400
+
+    # the next lecture prepares check-ins for whoever attended this course before
+    response = client.post(url="/lecture-sessions", headers=admin_headers, json={"course_code": "CSC411"})
+    assert response.json()["prepared_check_ins"] == 1
+
+
+def test_lecture_check_in_with_requested_options(session: Session, client: TestClient):
+    session.add(Student(matric_number="21CG029882",
+                password=get_password_hash("password")))
+    session.commit()
+    authenticator = register_soft_authenticator(client, "21CG029882")
+    lecture_session_id = client.post(url="/lecture-sessions", headers={"Authorization": f"Bearer {authorization_token_for_create_student}"},
+                                     json={"course_code": "CSC411", "roster": ["21CG029882"]}).json()["id"]
+    headers = login_headers(client, "21CG029882")
+    # an app that still asks for options first signs that challenge, not the one prepared for the lecture
+    options = client.get(url="/generate-authentication-options", headers=headers).json()
+    response = client.post(url=f"/verify-authentication-response?lecture_session_id={lecture_session_id}",
+                           headers=headers, json=authenticator.authenticate(options))
+    assert response.status_code == 200
+    assert response.json() == {"verified": True,
+                               "checked_in": True, "already_checked_in": False}
+
+    # and the prepared challenge wasn't used up by it
+    options = client.get(url=f"/lecture-sessions/{lecture_session_id}", headers=headers).json()["authentication_options"]
+    response = client.post(url=f"/verify-authentication-response?lecture_session_id={lecture_session_id}",
+                           headers=headers, json=authenticator.authenticate(options))
+    assert response.status_code == 200
+    assert response.json()["already_checked_in"] is True
+
+
+def test_lecture_stream_fans_out_to_listeners(client: TestClient, tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch):
+    from starlette.websockets import WebSocketDisconnect
+    from app import recording
+    monkeypatch.setattr(recording, "RECORDINGS_DIR", str(tmp_path))
+    admin_headers = {
+        "Authorization": f"Bearer {authorization_token_for_create_student}"}
+    lecture_session_id = client.post(url="/lecture-sessions", headers=admin_headers,
+                                     json={"course_code": "CSC411"}).json()["id"]
+    stream_url = f"/lecture-sessions/{lecture_session_id}/stream"
+    # entering the client runs every websocket on the same event loop, the way uvicorn would
+    with client:
+        with pytest.raises(WebSocketDisconnect):
+            with client.websocket_connect(stream_url) as listener:
+                listener.receive_bytes()
+        with client.websocket_connect(f"{stream_url}/publish?token={authorization_token_for_create_student}") as publisher:
+            with pytest.raises(WebSocketDisconnect):
+                with client.websocket_connect(f"{stream_url}/publish?token={authorization_token_for_create_student}") as second_publisher:
+                    second_publisher.receive_bytes()
+            for message in (b"\x01key-1", b"\x00delta-1", b"\x01key-2", b"\x00delta-2"):
+                publisher.send_bytes(message)
+            with client.websocket_connect(f"{stream_url}?token={test_access_token}") as late_listener, \
+                    client.websocket_connect(stream_url, headers={"Authorization": f"Bearer {test_access_token}"}) as other_listener:
+                # a listener who joins late starts at the last keyframe
+                assert [late_listener.receive_bytes() for _ in range(2)] == [b"\x01key-2", b"\x00delta-2"]
+                assert [other_listener.receive_bytes() for _ in range(2)] == [b"\x01key-2", b"\x00delta-2"]
+                publisher.send_bytes(b"\x00delta-3")
+                assert late_listener.receive_bytes() == other_listener.receive_bytes() == b"\x00delta-3"
+    stats = client.get(url="/metrics/streaming").json()
+    assert stats["chunks_published"] == 5 and stats["chunks_sent"] == 6 and stats["streams"] == 0
+
+
+def test_slow_stream_listener_skips_to_the_next_keyframe():
+    from app.streaming import LectureStream
+    stream = LectureStream(1, ring_chunks=8, subscriber_queue_chunks=3)
+    listener = stream.subscribe()
+    for message in (b"\x01key-1", b"\x00delta-1", b"\x00delta-2", b"\x00delta-3", b"\x00delta-4", b"\x01key-2", b"\x00delta-5"):
+        stream.publish(message)
+    # the queue filled up at delta-3, so everything queued is dropped and nothing is queued again until key-2
+    assert [bytes(chunk.data) for chunk in listener.queue] == [b"\x01key-2", b"\x00delta-5"]
+    assert listener.dropped == 5 and listener.skips == 1
+    # every listener's queue shares the chunk the publisher sent instead of a copy
+    other_listener = stream.subscribe()
+    assert other_listener.queue[0].data.obj is listener.queue[0].data.obj
+
+
+def test_lecture_recorder_segments_and_index(tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch):
+    from app import recording
+    from fastapi import HTTPException
+    monkeypatch.setattr(recording, "RECORDINGS_DIR", str(tmp_path))
+    recording.manifest_cache.clear()
+    now = [1000.0]
+    messages = [b"\x01" + bytes(20), b"\x00" + bytes(20), b"\x00" + bytes(20), b"\x01" + bytes(20), b"\x00" + bytes(20)]
+    recorder = recording.LectureRecorder(recording.recording_directory(7), segment_bytes=60, clock=lambda: now[0])
+    for message in messages[:3]:
+        recorder.append(message)
+        now[0] += 0.04
+    recorder.close()
+    # what a crash between flushing the segment and flushing the index leaves behind: bytes in the next segment that nothing points at
+    recording.segment_path(recording.recording_directory(7), 2).write_bytes(b"orphan")
+    # a publisher that reconnects carries on with the same recording
+    recorder = recording.LectureRecorder(recording.recording_directory(7), segment_bytes=60, clock=lambda: now[0])
+    for message in messages[3:]:
+        recorder.append(message)
+        now[0] += 0.04
+    recorder.close()
+
+    manifest = recording.read_manifest(7)
+    # 25 bytes a chunk with its length prefix, so two fit in a 60 byte segment
+    assert manifest["segments"] == [{"segment": 0, "bytes": 50}, {"segment": 1, "bytes": 50}, {"segment": 2, "bytes": 25}]
+    assert manifest["keyframes"] == [[0, 0, 0], [120, 1, 25]]
+    assert manifest["chunks"] == 5 and manifest["duration_ms"] == 160
+    recorded = b"".join(recording.segment_path(recording.recording_directory(7), segment).read_bytes() for segment in range(3))
+    assert recorded == b"".join(len(message).to_bytes(4, "big") + message for message in messages)
+    with pytest.raises(HTTPException):
+        recording.read_manifest(8)
+
+
+def test_recorded_lecture_playback_with_ranges(client: TestClient, tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch):
+    from app import recording
+    monkeypatch.setattr(recording, "RECORDINGS_DIR", str(tmp_path))
+    recording.manifest_cache.clear()
+    admin_headers = {
+        "Authorization": f"Bearer {authorization_token_for_create_student}"}
+    lecture_session_id = client.post(url="/lecture-sessions", headers=admin_headers,
+                                     json={"course_code": "CSC411"}).json()["id"]
+    messages = [b"\x01" + os.urandom(100), b"\x00" + os.urandom(100)]
+    with client:
+        with client.websocket_connect(f"/lecture-sessions/{lecture_session_id}/stream/publish?token={authorization_token_for_create_student}") as publisher:
+            for message in messages:
+                publisher.send_bytes(message)
+    segment = b"".join(len(message).to_bytes(4, "big") + message for message in messages)
+    headers = {"Authorization": "Bearer " + test_access_token}
+    assert client.get(url=f"/lecture-sessions/{lecture_session_id}/recording").status_code == 401
+    manifest = client.get(url=f"/lecture-sessions/{lecture_session_id}/recording", headers=headers).json()
+    assert manifest["segments"] == [{"segment": 0, "bytes": len(segment)}]
+
+    segment_url = f"/lecture-sessions/{lecture_session_id}/recording/segments/0"
+    response = client.get(url=segment_url, headers=headers)
+    assert response.status_code == 200 and response.content == segment
+    assert response.headers["accept-ranges"] == "bytes"
+    response = client.get(url=segment_url, headers={**headers, "Range": "bytes=105-"})
+    assert response.status_code == 206 and response.content == segment[105:]
+    assert response.headers["content-range"] == f"bytes 105-{len(segment) - 1}/{len(segment)}"
+    response = client.get(url=segment_url, headers={**headers, "Range": "bytes=-10"})
+    assert response.status_code == 206 and response.content == segment[-10:]
+    response = client.get(url=segment_url, headers={**headers, "Range": f"bytes={len(segment)}-"})
+    assert response.status_code == 416 and response.headers["content-range"] == f"bytes */{len(segment)}"
+    assert client.get(url=f"/lecture-sessions/{lecture_session_id}/recording/segments/1", headers=headers).status_code == 404
+
+
+def test_attendance_writer_batches_check_ins(db_path: pathlib.Path, session: Session):
+    import asyncio
+    from app.attendance import AttendanceWriter
+    from app.models import AttendanceRecord, LectureSession
+    from datetime import datetime
+    from sqlmodel import select
+    session.add(LectureSession(id=1, course_code="CSC411", closes_at=datetime.utcnow()))
+    session.commit()
+
+    async def scenario():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{db_path}")
+        writer = AttendanceWriter(max_batch_size=3, max_delay_ms=10,
+                                  session_factory=lambda: AsyncSession(engine, expire_on_commit=False))
+        matric_numbers = ["21CG000001", "21CG000002", "21CG000001", "21CG000003", "21CG000004"]
+        results = await asyncio.gather(*(writer.record(1, matric_number) for matric_number in matric_numbers))
+        # a second check-in for the same lecture is not recorded again, whether it lands in the same batch or a later one
+        assert results == [True, True, False, True, True]
+        assert await writer.record(1, "21cg000002") is False
+        assert writer.stats()["batches"] == 3
+        await engine.dispose()
+
+    asyncio.run(scenario())
+    assert len(session.exec(select(AttendanceRecord)).all()) == 4
+
+
+def test_attendance_reports(db_path: pathlib.Path, client: TestClient):
+    import asyncio
+    from app.attendance import AttendanceWriter
+    headers = {"Authorization": f"Bearer {authorization_token_for_create_student}"}
+    lecture_session_ids = [client.post(url="/lecture-sessions", headers=headers, json={"course_code": "CSC411"}).json()["id"]
+                           for _ in range(4)]
+
+    async def scenario():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{db_path}")
+        writer = AttendanceWriter(max_batch_size=100, max_delay_ms=10,
+                                  session_factory=lambda: AsyncSession(engine, expire_on_commit=False))
+        await asyncio.gather(*(writer.record(lecture_session_id, "21CG029882") for lecture_session_id in lecture_session_ids[:3]),
+                             writer.record(lecture_session_ids[0], "21CG029883"),
+                             writer.record(lecture_session_ids[0], "21CG029883"))
+        await engine.dispose()
+
+    asyncio.run(scenario())
+
+    response = client.get("/reports/courses/csc411", headers=headers)
+    assert response.json() == {"course_code": "CSC411", "sessions_held": 4,
+                               "check_ins": 4, "average_check_ins_per_session": 1.0}
+
+    response = client.get("/reports/courses/CSC411/students/21cg029883", headers=headers)
+    assert response.json()["attendance_percentage"] == 25.0
+
+    response = client.get("/reports/me", headers={"Authorization": "Bearer " + test_access_token})
+    assert [(row["course_code"], row["sessions_attended"], row["attendance_percentage"]) for row in response.json()] == [("CSC411", 3, 75.0)]
+
+    response = client.get("/reports/courses/CSC411/export.csv", headers=headers)
+    assert response.status_code == 200
+    rows = response.text.splitlines()
+    assert rows[0].startswith("matric_number,")
+    assert [row.split(",")[:4] for row in rows[1:]] == [["21CG029882", "3", "4", "75.0"], ["21CG029883", "1", "4", "25.0"]]
+
+    assert client.get("/reports/courses/MTH101", headers=headers).status_code == 404
+
+
+def test_instrumented_pool_counts_checkouts_and_timeouts(db_path: pathlib.Path):
+    from app.database import InstrumentedQueuePool, PoolMetrics
+    from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+
+    class TestPool(InstrumentedQueuePool):
+        metrics = PoolMetrics()
+
+    engine = create_engine(f"sqlite:///{db_path}", poolclass=TestPool,
+                           pool_size=1, max_overflow=0, pool_timeout=0.05)
+    connection = engine.connect()
+    with pytest.raises(PoolTimeoutError):
+        engine.connect()
+    stats = TestPool.metrics.stats(engine.pool)
+    connection.close()
+
+    assert stats["checkouts"] == 2 and stats["timeouts"] == 1 and stats["in_use"] == 1
+    assert stats["checkout_seconds_max"] >= 0.05
+
+
+def test_db_pool_metrics(client: TestClient):
+    from app.database import get_engine, get_async_engine
+    # an engine only shows up once something has created it
+    get_engine()
+    get_async_engine()
+    response = client.get("/metrics/db-pool")
+    assert response.status_code == 200
+    assert set(response.json()) == {"async", "sync"}
+
+
+def test_startup_report(client: TestClient):
+    # entering the client runs the lifespan, the same as uvicorn starting a worker
+    with TestClient(app) as started_client:
+        response = started_client.get("/metrics/startup")
+
+    assert response.status_code == 200
+    report = response.json()
+    assert report["import_seconds"] > 0 and report["lifespan_startup_seconds"] >= 0
+    assert report["seconds_to_ready"] >= report["import_seconds"]
+    assert report["seconds_to_first_request"] is not None and report["slowest_imports"]
+    assert 'startup_import_seconds' in client.get("/metrics").text
+
+
+def test_pool_workers_dont_profile_imports():
+    import subprocess
+    # what a hashing or webauthn worker imports. Only main starts the import profiler
+    code = ("import builtins, sys; original_import = builtins.__import__; import app.verification, app.hashing; "
+            "print(builtins.__import__ is original_import, 'app.startup' in sys.modules)")
+    result = subprocess.run([sys.executable, "-c", code], cwd=pathlib.Path(__file__).parent.parent,
+                            capture_output=True, text=True, check=True)
+    assert result.stdout.split() == ["True", "False"]
+
+
+def test_main_defers_heavy_imports():
+    import subprocess
+    # a fresh interpreter, this one has long since imported all of them
+    code = "import sys, main; print(sorted(name for name in ('webauthn', 'jose', 'passlib', 'uvicorn') if name in sys.modules))"
+    result = subprocess.run([sys.executable, "-c", code], cwd=pathlib.Path(__file__).parent.parent,
+                            capture_output=True, text=True, check=True)
+    assert result.stdout.strip() == "[]"
+
+
+def test_metrics(session: Session, client: TestClient):
+    student = Student(
+        matric_number="21CG029883", password=get_password_hash("password"), device_registered=True)
+    session.add(student)
+    session.commit()
+    client.post("/verify-student", json={"matric_number": "21cg029883", "password": "password"})
+    client.get(url="/lecture-sessions/1", headers={"Authorization": "Bearer " + test_access_token})
+
+    response = client.get("/metrics")
+
+    assert response.status_code == 200
+    text = response.text
+    # the registry is shared by every test in the run so only the presence of the samples is checked
+    assert 'http_requests_total{method="POST",route="/verify-student",status="200"}' in text
+    assert 'http_request_duration_seconds_count{method="GET",route="/lecture-sessions/{lecture_session_id}"}' in text
+    assert 'password_hash_duration_seconds_count{operation="verify"}' in text
+    assert 'crud_duration_seconds_count{operation="get_student"}' in text
+    assert 'jwt_decode_duration_seconds_count' in text
+    assert 'db_pool_' in text and 'cache_hits{cache="student"}' in text
+
 
 # So i am not going to be testing those webauthn endpoints because i need the front end for it to work really well